@@ -1,20 +1,37 @@
+import io
 import os
 import time
 import json
 import threading
 import tempfile
 import datetime
+import zoneinfo
 import sqlite3
 from pathlib import Path
 import hashlib
 import random
 import hmac
+import shutil
+import zipfile
+import atexit
+import traceback
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 from typing import Optional
 
 from flask import Flask, request, jsonify
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
+
+import extract
+import similarity
+import stylometry
 #start of code
 load_dotenv()
 
@@ -29,11 +46,40 @@ TURNITIN_PASSWORD = os.getenv("TURNITIN_PASSWORD")
 PAYSTACK_PUBLIC_KEY = os.getenv("PAYSTACK_PUBLIC_KEY")
 PAYSTACK_SECRET_KEY = os.getenv("PAYSTACK_SECRET_KEY")
 PAYSTACK_CURRENCY = os.getenv("PAYSTACK_CURRENCY", "USD")
+PAYSTACK_API_BASE = os.getenv("PAYSTACK_API_BASE", "https://api.paystack.co").rstrip("/")
+PAYSTACK_TRANSFER_CURRENCY = os.getenv("PAYSTACK_TRANSFER_CURRENCY", "GHS")  # referral payouts are in cedis
+PAYSTACK_MAX_RETRIES = int(os.getenv("PAYSTACK_MAX_RETRIES", "3"))
+PAYSTACK_BULK_SIZE = 100  # Paystack's limit per /transfer/bulk request
+PAYOUT_INTERVAL_MINUTES = int(os.getenv("PAYOUT_INTERVAL_MINUTES", "5"))
+PAYOUT_RETRY_SECONDS = 3600  # wait between attempts at a failed payout
+PAYOUT_MAX_ATTEMPTS = 5  # then the amount goes back to the user's balance
+PAYSTACK_EVENT_MAX_ATTEMPTS = 8  # a webhook event that keeps failing is parked as 'failed' for replay
+
+# Telegram API client settings
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # messages/sec across all chats
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # messages/sec within one chat
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "4"))
+OUTBOUND_SENDERS = int(os.getenv("OUTBOUND_SENDERS", "4"))
 
 # Other settings
 WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
 DATABASE = os.getenv("DATABASE_URL", "bot_db.sqlite")
 SECRET_KEY = os.getenv("SECRET_KEY", "secret")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16000"))
+# Set BACKGROUND_JOBS=0 for one-off scripts (benchmarks, maintenance) that import the app
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "1") == "1"
+# Set by asgi.py, whose event loop sends outgoing messages in place of the outbound sender threads
+ASYNC_OUTBOUND = os.getenv("ASYNC_OUTBOUND", "0") == "1"
+# Shared secret for the /admin endpoints (they are disabled while unset)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Batch API keys for institutions, "name:key,name:key" (the batch API is disabled while unset)
+BATCH_API_KEYS = dict(
+    entry.strip().split(":", 1) for entry in os.getenv("BATCH_API_KEYS", "").split(",") if ":" in entry
+)
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "500"))
+BATCH_MAX_FILE_MB = int(os.getenv("BATCH_MAX_FILE_MB", "25"))
 
 if not TELEGRAM_BOT_TOKEN:
     raise SystemExit("❌ TELEGRAM_BOT_TOKEN not set")
@@ -44,17 +90,128 @@ print(f"💰 Paystack enabled: {PAYSTACK_PUBLIC_KEY[:10]}...")
 
 TEMP_DIR = Path(os.getenv("TEMP_DIR", "/tmp/turnitq"))
 TEMP_DIR.mkdir(parents=True, exist_ok=True)
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", str(256 * 1024)))
+# Reports are rendered in memory; set PERSIST_REPORTS=1 to also keep a copy on disk
+PERSIST_REPORTS = os.getenv("PERSIST_REPORTS", "0") == "1"
+REPORTS_DIR = TEMP_DIR / "reports"
+# Scratch storage limits for uploads waiting to be processed
+SCRATCH_QUOTA_MB = int(os.getenv("SCRATCH_QUOTA_MB", "1024"))
+SCRATCH_MIN_FREE_MB = int(os.getenv("SCRATCH_MIN_FREE_MB", "200"))
+SCRATCH_ORPHAN_HOURS = int(os.getenv("SCRATCH_ORPHAN_HOURS", "6"))
+PERSISTED_REPORT_DAYS = int(os.getenv("PERSISTED_REPORT_DAYS", "7"))
+
+# Processing engine settings
+PROCESSING_WORKERS = int(os.getenv("PROCESSING_WORKERS", "4"))
+PROCESSING_QUEUE_SIZE = int(os.getenv("PROCESSING_QUEUE_SIZE", "100"))  # queued submissions before uploads are turned away
+PROCESSING_BACKEND = os.getenv("PROCESSING_BACKEND", "thread")  # "thread" or "process"
+QUEUE_LEASE_SECONDS = int(os.getenv("QUEUE_LEASE_SECONDS", "900"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+
+# Processes extracting large PDFs in parallel; 1 extracts in the calling worker
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "1"))
+
+# Similarity index (memory-mapped postings segments) lives next to the database by default
+SIMILARITY_INDEX_DIR = os.getenv("SIMILARITY_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(DATABASE)), "similarity_index"))
+
+# Daily quotas reset at midnight in the user's timezone (/timezone), this one by default
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Africa/Accra")
+
+# Daily processing budget across all users (stored in meta.global_max; set to override it)
+GLOBAL_DAILY_CAPACITY = int(os.getenv("GLOBAL_DAILY_CAPACITY", "0"))
+
+# Users and sessions kept in memory (write-through); 0 disables the cache
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+
+# Report cache settings
+REPORT_CACHE_TTL_HOURS = int(os.getenv("REPORT_CACHE_TTL_HOURS", "72"))
+REPORT_CACHE_MAX_MB = int(os.getenv("REPORT_CACHE_MAX_MB", "64"))
+
+# Fork the page extraction pool while this is still the only thread. In process
+# mode extraction runs inside the engine's processes (sequentially), so only the
+# engine's pool is forked there
+if PROCESSING_BACKEND != "process":
+    extract.start_pool(EXTRACT_WORKERS)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
 
 # Database setup
+_db_local = threading.local()
+
 def get_db():
-    conn = sqlite3.connect(DATABASE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    """Return the calling thread's SQLite connection, opening it on first use.
+
+    Each thread (gunicorn request threads, processing workers, the dispatcher
+    and scheduler jobs) gets its own connection so cursors and transactions
+    never interleave. WAL lets readers proceed while a writer commits.
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _db_local.conn = conn
+        _db_local.tx_depth = 0
     return conn
 
-db = get_db()
+class ThreadLocalDB:
+    """Connection-like handle that routes every call to the calling thread's connection"""
+
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+db = ThreadLocalDB()
+
+@contextmanager
+def db_transaction():
+    """Explicit write transaction scope.
+
+    Takes the write lock up front (BEGIN IMMEDIATE) so the transaction cannot
+    fail half-way on a lock upgrade, commits on success and rolls back on any
+    exception. Nested scopes join the outermost transaction. Uncommitted
+    writes the thread left open beforehand are rolled back (and logged),
+    never committed on its behalf.
+    """
+    conn = get_db()
+    if _db_local.tx_depth:
+        _db_local.tx_depth += 1
+        try:
+            yield conn
+        finally:
+            _db_local.tx_depth -= 1
+        return
+    if conn.in_transaction:
+        # Writes this thread issued without committing: they were never meant to be
+        # durable on their own, so discard them rather than fold them into this block
+        caller = traceback.extract_stack(limit=3)[0]
+        conn.rollback()
+        print(f"⚠️ Rolled back an uncommitted transaction left open before db_transaction() "
+              f"(entered from {os.path.basename(caller.filename)}:{caller.lineno})")
+    conn.execute("BEGIN IMMEDIATE")
+    _db_local.tx_depth = 1
+    _db_local.commit_hooks = []
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _db_local.tx_depth = 0
+        hooks, _db_local.commit_hooks = _db_local.commit_hooks, []
+    for hook in hooks:
+        hook()
+
+def in_transaction():
+    return bool(getattr(_db_local, "tx_depth", 0))
+
+def after_commit(hook):
+    """Run hook once the enclosing db_transaction commits (dropped on rollback)"""
+    _db_local.commit_hooks.append(hook)
 
 def init_db():
     cur = db.cursor()
@@ -145,6 +302,255 @@ def init_db():
     """)
     db.commit()
 
+    run_migrations()
+
+# Schema Migrations
+def ensure_columns(conn, table, columns):
+    """Add any missing columns to an existing table"""
+    existing = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    for name, ddl in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+def _migrate_submission_queue(conn):
+    ensure_columns(conn, "submissions", {
+        "file_path": "TEXT",
+        "priority": "INTEGER DEFAULT 3",
+        "attempts": "INTEGER DEFAULT 0",
+        "lease_expires_at": "INTEGER"
+    })
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_queue ON submissions(status, priority, created_at)")
+
+def _migrate_usage_windows(conn):
+    ensure_columns(conn, "users", {"usage_window_start": "INTEGER", "timezone": "TEXT"})
+    # Counts so far belong to the server-local day the midnight reset started
+    conn.execute("UPDATE users SET usage_window_start = CAST(strftime('%s', 'now', 'localtime', 'start of day', 'utc') AS INTEGER)")
+
+def _migrate_paystack_transfers(conn):
+    # Withdrawal payouts have always written paystack_reference; the column was never created
+    ensure_columns(conn, "withdrawals", {"paystack_reference": "TEXT", "transfer_code": "TEXT"})
+    conn.execute("""CREATE TABLE IF NOT EXISTS paystack_recipients (
+        account_number TEXT,
+        bank_code TEXT,
+        recipient_code TEXT,
+        created_at INTEGER,
+        PRIMARY KEY (account_number, bank_code)
+    )""")
+
+def _migrate_ledger(conn):
+    # Amounts are in pesewas; the entries of one txn always sum to zero
+    conn.execute("""CREATE TABLE IF NOT EXISTS ledger_entries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        txn TEXT NOT NULL,
+        account TEXT NOT NULL,
+        user_id INTEGER,
+        amount INTEGER NOT NULL,
+        created_at INTEGER
+    )""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_ledger_txn_account ON ledger_entries(txn, account)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_account_user ON ledger_entries(account, user_id)")
+    ensure_columns(conn, "withdrawals", {"attempts": "INTEGER DEFAULT 0", "sent_at": "INTEGER", "last_error": "TEXT"})
+    # Open the books with today's balances and the withdrawals still waiting to be paid
+    now = int(time.time())
+    for prefix, account, source in (
+        ("opening", "referral_balance", "SELECT user_id, user_id AS id, amount FROM referral_earnings WHERE amount > 0"),
+        ("opening-withdrawal", "payouts_pending", "SELECT NULL AS user_id, id, amount FROM withdrawals WHERE status IN ('pending', 'failed')"),
+    ):
+        for r in conn.execute(source).fetchall():
+            pesewas = int(round(r["amount"] * 100))
+            conn.execute("INSERT INTO ledger_entries(txn, account, user_id, amount, created_at) VALUES(?, ?, ?, ?, ?)",
+                         (f"{prefix}:{r['id']}", account, r["user_id"], pesewas, now))
+            conn.execute("INSERT INTO ledger_entries(txn, account, user_id, amount, created_at) VALUES(?, 'referral_rewards', NULL, ?, ?)",
+                         (f"{prefix}:{r['id']}", -pesewas, now))
+
+def _migrate_paystack_event_entities(conn):
+    # Events are ordered per charge/transfer reference instead of globally
+    ensure_columns(conn, "paystack_events", {"entity": "TEXT"})
+    conn.execute("UPDATE paystack_events SET entity=COALESCE(reference, dedup_key) WHERE entity IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_paystack_events_entity ON paystack_events(entity, id)")
+
+def _migrate_expiry_ts(conn):
+    ensure_columns(conn, "users", {"expiry_ts": "INTEGER"})
+    # expiry_date was written in server local time
+    conn.execute("UPDATE users SET expiry_ts = CAST(strftime('%s', expiry_date, 'utc') AS INTEGER) WHERE expiry_date IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_expiry ON users(expiry_ts) WHERE subscription_active=1")
+
+# Applied in order; each entry is (version, description, list of SQL statements or a callable(conn)).
+# Never edit a released migration - append a new one instead.
+MIGRATIONS = [
+    (1, "submission queue columns", _migrate_submission_queue),
+    (2, "indexes for hot query paths", [
+        "DROP INDEX IF EXISTS idx_submissions_user_status",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_user_status_created ON submissions(user_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id, reward_credited)",
+        "CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id, reward_credited)",
+        "CREATE INDEX IF NOT EXISTS idx_referral_earnings_user ON referral_earnings(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_turnitin_logs_source ON turnitin_logs(source)",
+        "CREATE INDEX IF NOT EXISTS idx_turnitin_logs_submission ON turnitin_logs(submission_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_reference ON payments(reference)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_status_created ON withdrawals(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_user_status ON withdrawals(user_id, status)",
+    ]),
+    (3, "webhook idempotency keys", [
+        "CREATE TABLE IF NOT EXISTS processed_events (key TEXT PRIMARY KEY, created_at INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_processed_events_created ON processed_events(created_at)",
+    ]),
+    (4, "ingest digest columns", lambda conn: ensure_columns(conn, "submissions", {
+        "file_hash": "TEXT",
+        "file_size": "INTEGER",
+        "file_type": "TEXT"
+    })),
+    (5, "content-addressed report cache", [
+        """CREATE TABLE IF NOT EXISTS report_cache (
+            file_hash TEXT,
+            options_key TEXT,
+            file_size INTEGER,
+            analysis TEXT,
+            size_bytes INTEGER,
+            created_at INTEGER,
+            last_hit_at INTEGER,
+            hits INTEGER DEFAULT 0,
+            PRIMARY KEY (file_hash, options_key)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_report_cache_last_hit ON report_cache(last_hit_at)",
+        "CREATE INDEX IF NOT EXISTS idx_report_cache_created ON report_cache(created_at)",
+    ]),
+    (6, "telegram file_id cache", [
+        """CREATE TABLE IF NOT EXISTS telegram_files (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT,
+            size_bytes INTEGER,
+            created_at INTEGER,
+            last_used_at INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_telegram_files_last_used ON telegram_files(last_used_at)",
+    ]),
+    (7, "similarity corpus and index", [
+        """CREATE TABLE IF NOT EXISTS corpus_documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_hash TEXT UNIQUE,
+            submission_id INTEGER,
+            fingerprints INTEGER,
+            signature BLOB,
+            created_at INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS lsh_buckets (
+            band INTEGER,
+            bucket INTEGER,
+            doc_id INTEGER,
+            PRIMARY KEY (band, bucket, doc_id)
+        ) WITHOUT ROWID""",
+        "CREATE TABLE IF NOT EXISTS fingerprint_delta (fp INTEGER, doc_id INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_fingerprint_delta_fp ON fingerprint_delta(fp)",
+        """CREATE TABLE IF NOT EXISTS similarity_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE,
+            postings INTEGER,
+            created_at INTEGER
+        )""",
+    ]),
+    (8, "batch submissions", [
+        """CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client TEXT,
+            status TEXT,
+            options TEXT,
+            total INTEGER DEFAULT 0,
+            created_at INTEGER,
+            finished_at INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS batch_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id INTEGER,
+            filename TEXT,
+            file_path TEXT,
+            file_hash TEXT,
+            file_size INTEGER,
+            file_type TEXT,
+            status TEXT,
+            duplicate_of INTEGER,
+            attempts INTEGER DEFAULT 0,
+            lease_expires_at INTEGER,
+            similarity_score INTEGER,
+            ai_score INTEGER,
+            analysis TEXT,
+            batch_matches TEXT,
+            error TEXT,
+            created_at INTEGER,
+            finished_at INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_batch_items_queue ON batch_items(status, batch_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_batch_items_batch ON batch_items(batch_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_batch_items_duplicate ON batch_items(duplicate_of)",
+    ]),
+    (9, "numeric subscription expiry", _migrate_expiry_ts),
+    (10, "per-user daily usage windows", _migrate_usage_windows),
+    (11, "capacity reservations", [
+        """CREATE TABLE IF NOT EXISTS capacity_reservations (
+            submission_id INTEGER PRIMARY KEY,
+            window_start INTEGER,
+            status TEXT,
+            created_at INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_capacity_reservations_status ON capacity_reservations(status, window_start)",
+    ]),
+    (12, "paystack transfer recipients", _migrate_paystack_transfers),
+    (13, "referral ledger", _migrate_ledger),
+    (14, "paystack event inbox", [
+        """CREATE TABLE IF NOT EXISTS paystack_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT UNIQUE,
+            event TEXT,
+            reference TEXT,
+            payload TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at INTEGER DEFAULT 0,
+            lease_expires_at INTEGER,
+            result TEXT,
+            error TEXT,
+            received_at INTEGER,
+            applied_at INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_paystack_events_queue ON paystack_events(status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_paystack_events_received ON paystack_events(received_at, event)",
+    ]),
+    (15, "withdrawal transfer reference index", [
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_reference ON withdrawals(paystack_reference)",
+    ]),
+    (16, "per-entity paystack event ordering", _migrate_paystack_event_entities),
+    (17, "corpus documents by submission", [
+        "CREATE INDEX IF NOT EXISTS idx_corpus_documents_submission ON corpus_documents(submission_id)",
+    ]),
+]
+
+def get_schema_version(conn):
+    r = conn.execute("SELECT v FROM meta WHERE k='schema_version'").fetchone()
+    return int(r["v"]) if r else 0
+
+def run_migrations():
+    """Apply pending migrations, one transaction per version, recording progress in meta.
+
+    BEGIN IMMEDIATE serialises concurrent starters: a second process waits for
+    the lock, re-reads the version and skips what was already applied.
+    """
+    for version, description, step in MIGRATIONS:
+        with db_transaction() as conn:
+            if get_schema_version(conn) >= version:
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for statement in step:
+                    conn.execute(statement)
+            conn.execute(
+                "INSERT INTO meta(k, v) VALUES('schema_version', ?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+                (str(version),)
+            )
+        print(f"🗄️ Applied migration {version}: {description}")
+    db.execute("PRAGMA optimize")
+
 # Initialize database
 init_db()
 
@@ -153,6 +559,137 @@ if not db.execute("SELECT 1 FROM meta WHERE k='global_alloc'").fetchone():
     db.execute("INSERT INTO meta(k,v) VALUES('global_alloc','0')")
     db.execute("INSERT INTO meta(k,v) VALUES('global_max','50')")
     db.commit()
+if GLOBAL_DAILY_CAPACITY:
+    db.execute("UPDATE meta SET v=? WHERE k='global_max'", (str(GLOBAL_DAILY_CAPACITY),))
+    db.commit()
+
+class CapacityExhausted(Exception):
+    pass
+
+# Capacity Allocator
+class CapacityAllocator:
+    """Global daily processing budget: meta.global_alloc of meta.global_max.
+
+    Every Telegram submission reserves one unit before it is charged or
+    queued (capacity_reservations). A reservation is released - the unit
+    goes back to the pool - when the submission fails, is cancelled or is
+    answered from the report cache, and becomes 'used' when processing
+    succeeds. The pool rolls over lazily at midnight in DEFAULT_TIMEZONE:
+    the first reservation of a new day zeroes global_alloc, so no
+    scheduled reset is needed. sweep() releases reservations whose
+    submission ended without releasing them (crashes, lease failures).
+    """
+
+    def __init__(self, timezone_name=None):
+        self.timezone_name = timezone_name
+        self.rejected = 0
+
+    def _rollover(self, conn):
+        window = usage_window_start(self.timezone_name)
+        rolled = conn.execute(
+            "INSERT INTO meta(k, v) VALUES('global_window', ?) "
+            "ON CONFLICT(k) DO UPDATE SET v=excluded.v WHERE CAST(meta.v AS INTEGER) < CAST(excluded.v AS INTEGER)",
+            (str(window),)
+        ).rowcount
+        if rolled:
+            conn.execute("UPDATE meta SET v='0' WHERE k='global_alloc'")
+        return window
+
+    def reserve(self, submission_id):
+        """Take one unit for a submission (joins the caller's transaction); False when the day's budget is spent"""
+        with db_transaction() as conn:
+            window = self._rollover(conn)
+            new = conn.execute(
+                "INSERT INTO capacity_reservations(submission_id, window_start, status, created_at) VALUES(?, ?, 'held', ?) "
+                "ON CONFLICT(submission_id) DO NOTHING RETURNING submission_id",
+                (submission_id, window, now_ts())
+            ).fetchone()
+            if not new:
+                return True  # already holds a unit
+            taken = conn.execute(
+                "UPDATE meta SET v = CAST(v AS INTEGER) + 1 "
+                "WHERE k='global_alloc' AND CAST(v AS INTEGER) < (SELECT CAST(v AS INTEGER) FROM meta WHERE k='global_max') "
+                "RETURNING v"
+            ).fetchone()
+            if not taken:
+                conn.execute("DELETE FROM capacity_reservations WHERE submission_id=?", (submission_id,))
+                self.rejected += 1
+                return False
+        return True
+
+    def release(self, submission_id):
+        """Give a held unit back (no-op if the submission holds none)"""
+        with db_transaction() as conn:
+            window = self._rollover(conn)
+            r = conn.execute(
+                "DELETE FROM capacity_reservations WHERE submission_id=? AND status='held' RETURNING window_start", (submission_id,)
+            ).fetchone()
+            # Units from an earlier day were already returned by the rollover
+            if r and r["window_start"] >= window:
+                conn.execute("UPDATE meta SET v = MAX(0, CAST(v AS INTEGER) - 1) WHERE k='global_alloc'")
+
+    def consume(self, submission_id, conn=None):
+        (conn or db).execute("UPDATE capacity_reservations SET status='used' WHERE submission_id=?", (submission_id,))
+        if conn is None:
+            db.commit()
+
+    def available(self):
+        """Units left today (read-only; a new day counts as a full pool)"""
+        rows = {r["k"]: int(r["v"]) for r in db.execute(
+            "SELECT k, v FROM meta WHERE k IN ('global_alloc', 'global_max', 'global_window')"
+        )}
+        if rows.get("global_window", 0) < usage_window_start(self.timezone_name):
+            return rows.get("global_max", 0)
+        return max(0, rows.get("global_max", 0) - rows.get("global_alloc", 0))
+
+    def sweep(self):
+        """Release or settle reservations whose submission already ended"""
+        stale = db.execute("""
+        SELECT r.submission_id, s.status FROM capacity_reservations r
+        LEFT JOIN submissions s ON s.id = r.submission_id
+        WHERE r.status='held' AND (s.id IS NULL OR s.status IN ('done', 'failed', 'cancelled'))
+        """).fetchall()
+        for r in stale:
+            if r["status"] == "done":
+                self.consume(r["submission_id"])
+            else:
+                self.release(r["submission_id"])
+        db.execute("DELETE FROM capacity_reservations WHERE status='used' AND window_start < ?",
+                   (usage_window_start(self.timezone_name) - 7 * 86400,))
+        db.commit()
+        if stale:
+            print(f"🧮 Capacity sweep settled {len(stale)} stale reservations")
+
+    def stats(self):
+        rows = {r["k"]: int(r["v"]) for r in db.execute(
+            "SELECT k, v FROM meta WHERE k IN ('global_alloc', 'global_max')"
+        )}
+        held = db.execute("SELECT COUNT(*) FROM capacity_reservations WHERE status='held'").fetchone()[0]
+        return {
+            "allocated": rows.get("global_alloc", 0),
+            "max": rows.get("global_max", 0),
+            "available": self.available(),
+            "held": held,
+            "rejected": self.rejected
+        }
+
+capacity = CapacityAllocator()
+
+CAPACITY_EXHAUSTED_MESSAGE = "⏳ We've reached today's processing capacity. Please send your document again tomorrow."
+
+def admission_refusal():
+    """Message to turn a new submission away with, or None to accept it.
+
+    Checked before anything is charged: no capacity left today, or a queue
+    already as long as PROCESSING_QUEUE_SIZE (the workers could not start
+    on it for a while anyway).
+    """
+    if capacity.available() <= 0:
+        return CAPACITY_EXHAUSTED_MESSAGE
+    queued = db.execute("SELECT COUNT(*) FROM submissions WHERE status='queued'").fetchone()[0]
+    if queued >= PROCESSING_QUEUE_SIZE:
+        return "⏳ We're receiving a lot of documents right now. Please send your document again in a few minutes."
+    return None
 
 # Plan Configuration
 PLANS = {
@@ -194,6 +731,14 @@ PLANS = {
     }
 }
 
+# Queue priority per plan (lower runs first) - Elite gets priority processing
+PLAN_PRIORITY = {
+    "elite": 0,
+    "pro": 1,
+    "premium": 2,
+    "free": 3
+}
+
 # Referral System Configuration
 REFERRAL_REWARD = 10  # ₵10 per successful referral
 MIN_WITHDRAWAL = 50   # ₵50 minimum withdrawal
@@ -202,50 +747,761 @@ MIN_WITHDRAWAL = 50   # ₵50 minimum withdrawal
 def now_ts():
     return int(time.time())
 
+# Webhook Idempotency
+class IdempotencyStore:
+    """Remembers which webhook deliveries were already handled.
+
+    Keys (Telegram update_ids) are checked against a bounded in-memory LRU
+    first and then claimed in the processed_events table with a single
+    INSERT OR IGNORE, so retried deliveries short-circuit without re-running
+    any handler logic, including across restarts.
+    """
+
+    def __init__(self, max_memory=50000):
+        self.max_memory = max_memory
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def claim(self, key):
+        """Return True the first time a key is seen, False for duplicates"""
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                self.duplicates += 1
+                return False
+        with db_transaction() as conn:
+            first = conn.execute(
+                "INSERT OR IGNORE INTO processed_events(key, created_at) VALUES(?, ?)", (key, now_ts())
+            ).rowcount == 1
+        with self._lock:
+            self._recent[key] = True
+            if len(self._recent) > self.max_memory:
+                self._recent.popitem(last=False)
+            if not first:
+                self.duplicates += 1
+        return first
+
+    def release(self, key):
+        """Forget a key whose handling failed so the sender's retry is processed"""
+        with self._lock:
+            self._recent.pop(key, None)
+        with db_transaction() as conn:
+            conn.execute("DELETE FROM processed_events WHERE key=?", (key,))
+
+    def prune(self, max_age_days=7):
+        with db_transaction() as conn:
+            removed = conn.execute(
+                "DELETE FROM processed_events WHERE created_at < ?", (now_ts() - max_age_days * 86400,)
+            ).rowcount
+        print(f"🧹 Pruned {removed} old webhook idempotency keys")
+
+idempotency = IdempotencyStore()
+
+# User State Cache
+class UserStateCache:
+    """Write-through LRU cache of users and user_sessions rows.
+
+    Rows are loaded once and then served from memory. Every mutation goes
+    through update_user()/update_session(), which write with
+    UPDATE ... RETURNING and store the returned row, so the cache holds
+    what the database holds. Writes made inside a db_transaction drop the
+    entry once it commits (nothing changes if it rolls back). Loads and
+    cache updates for one user run under that user's lock (striped), so a
+    concurrent load can never put a stale row back after a write.
+    max_users=0 disables caching (every read goes to the database).
+    """
+
+    LOCK_STRIPES = 256
+
+    def __init__(self, max_users=50000):
+        self.max_users = max_users
+        self._entries = OrderedDict()  # user_id -> {"user": row dict, "session": row dict}
+        self._lock = threading.Lock()
+        self._user_locks = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+        self.hits = 0
+        self.misses = 0
+
+    def lock(self, user_id):
+        return self._user_locks[hash(user_id) % self.LOCK_STRIPES]
+
+    def _cached(self, user_id, kind):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry.get(kind) is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return dict(entry[kind])
+            self.misses += 1
+        return None
+
+    def _store(self, user_id, kind, row):
+        if not self.max_users:
+            return
+        with self._lock:
+            entry = self._entries.setdefault(user_id, {})
+            entry[kind] = dict(row)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def _load(self, user_id, kind):
+        table = "users" if kind == "user" else "user_sessions"
+        r = db.execute(f"SELECT * FROM {table} WHERE user_id=?", (user_id,)).fetchone()
+        if r:
+            return r
+        # First contact: create both rows at once; the other one is cached too
+        rows = provision_user(user_id)
+        for other, row in rows.items():
+            if other != kind and row:
+                self._store(user_id, other, row)
+        return rows[kind] or db.execute(f"SELECT * FROM {table} WHERE user_id=?", (user_id,)).fetchone()
+
+    def user(self, user_id):
+        row = self._cached(user_id, "user")
+        if row is None:
+            with self.lock(user_id):
+                row = self._load(user_id, "user")
+                self._store(user_id, "user", row)
+        return dict(row) if row else None
+
+    def session(self, user_id):
+        row = self._cached(user_id, "session")
+        if row is None:
+            with self.lock(user_id):
+                row = self._load(user_id, "session")
+                self._store(user_id, "session", row)
+        return dict(row) if row else None
+
+    def _write(self, user_id, kind, sql, params, conn):
+        if in_transaction():
+            # Not holding the user lock here: we already own the write lock,
+            # and a load for this user may be waiting on it
+            row = (conn or db).execute(sql, params).fetchone()
+            after_commit(lambda: self.invalidate(user_id))
+            return dict(row) if row else None
+        with self.lock(user_id):
+            try:
+                row = db.execute(sql, params).fetchone()
+                db.commit()
+            except Exception:
+                self.invalidate(user_id)
+                raise
+            if row:
+                self._store(user_id, kind, row)
+            else:
+                self.invalidate(user_id)
+        return dict(row) if row else None
+
+    def update_user(self, user_id, assignments, params=(), conn=None):
+        """UPDATE users SET <assignments> for one user; returns the new row (None if there is no such user)"""
+        return self._write(user_id, "user", f"UPDATE users SET {assignments} WHERE user_id=? RETURNING *",
+                           (*params, user_id), conn)
+
+    def update_session(self, user_id, conn=None, **values):
+        assignments = ", ".join(f"{k}=?" for k in values)
+        return self._write(user_id, "session", f"UPDATE user_sessions SET {assignments} WHERE user_id=? RETURNING *",
+                           (*values.values(), user_id), conn)
+
+    def invalidate(self, user_id=None):
+        """Forget one user, or everyone after a bulk UPDATE"""
+        if user_id is None:
+            # Take every stripe so no load in flight can store a pre-update row afterwards
+            for lock in self._user_locks:
+                lock.acquire()
+            try:
+                with self._lock:
+                    self._entries.clear()
+            finally:
+                for lock in self._user_locks:
+                    lock.release()
+            return
+        with self.lock(user_id), self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "users": len(self._entries),
+                "max_users": self.max_users,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+# User Provisioning
+def provision_user(user_id):
+    """Create a user's users and user_sessions rows if missing, in one transaction.
+
+    Upserts make this safe against concurrent first contacts (Telegram often
+    delivers /start and a message together): whoever loses the race simply
+    gets no row back instead of an IntegrityError. Returns the newly created
+    rows as {"user": row or None, "session": row or None}.
+    """
+    with db_transaction() as conn:
+        user = conn.execute(
+            "INSERT INTO users(user_id) VALUES(?) ON CONFLICT(user_id) DO NOTHING RETURNING *", (user_id,)
+        ).fetchone()
+        session = conn.execute(
+            "INSERT INTO user_sessions(user_id) VALUES(?) ON CONFLICT(user_id) DO NOTHING RETURNING *", (user_id,)
+        ).fetchone()
+    return {"user": user, "session": session}
+
+def provision_users(user_ids, chunk_size=5000):
+    """Bulk provisioning for backfills and imports; returns how many users were new"""
+    user_ids = [int(u) for u in user_ids]
+    created = 0
+    with db_transaction() as conn:
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = json.dumps(user_ids[i:i + chunk_size])
+            # "WHERE true" keeps SQLite from reading ON CONFLICT as a join constraint
+            created += conn.execute(
+                "INSERT INTO users(user_id) SELECT value FROM json_each(?) WHERE true ON CONFLICT(user_id) DO NOTHING", (chunk,)
+            ).rowcount
+            conn.execute(
+                "INSERT INTO user_sessions(user_id) SELECT value FROM json_each(?) WHERE true ON CONFLICT(user_id) DO NOTHING", (chunk,)
+            )
+    return created
+
+user_cache = UserStateCache(USER_CACHE_SIZE)
+
+# Daily Usage Windows
+def get_timezone(name):
+    try:
+        return zoneinfo.ZoneInfo(name or DEFAULT_TIMEZONE)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return datetime.timezone.utc
+
+def valid_timezone(name):
+    try:
+        zoneinfo.ZoneInfo(name)
+        return True
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return False
+
+def usage_window_start(timezone_name=None, now=None):
+    """Epoch of the most recent midnight in the given timezone"""
+    local = datetime.datetime.fromtimestamp(now or time.time(), get_timezone(timezone_name))
+    return int(local.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
 def user_get(user_id):
-    cur = db.cursor()
-    r = cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
-    if not r:
-        cur.execute("INSERT INTO users(user_id) VALUES(?)", (user_id,))
-        db.commit()
-        r = cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
-    return dict(r) if r else None
+    """User row with used_today as of the user's current day.
+
+    Quotas reset lazily: a count from an earlier window reads as 0 here,
+    and the next charge (see charge_daily_usage) starts the new window.
+    """
+    u = user_cache.user(user_id)
+    if u and (u.get('usage_window_start') or 0) < usage_window_start(u.get('timezone')):
+        u['used_today'] = 0
+    return u
+
+def charge_daily_usage(user, created, is_free_check, conn=None):
+    """Count one check against today's quota, opening a new window if the last one has passed"""
+    window = usage_window_start(user.get('timezone'), created)
+    return user_cache.update_user(
+        user['user_id'],
+        "last_submission=?, used_today=CASE WHEN usage_window_start >= ? THEN used_today + 1 ELSE 1 END, "
+        "usage_window_start=MAX(COALESCE(usage_window_start, 0), ?), free_checks_used=free_checks_used+?",
+        (created, window, window, 1 if is_free_check else 0), conn=conn
+    )
 
 def get_user_session(user_id):
-    cur = db.cursor()
-    r = cur.execute("SELECT * FROM user_sessions WHERE user_id=?", (user_id,)).fetchone()
-    if not r:
-        cur.execute("INSERT INTO user_sessions(user_id) VALUES(?)", (user_id,))
-        db.commit()
-        r = cur.execute("SELECT * FROM user_sessions WHERE user_id=?", (user_id,)).fetchone()
-    return dict(r) if r else None
+    return user_cache.session(user_id)
 
 def update_user_session(user_id, **kwargs):
-    cur = db.cursor()
-    set_clause = ", ".join([f"{k}=?" for k in kwargs.keys()])
-    values = list(kwargs.values()) + [user_id]
-    cur.execute(f"UPDATE user_sessions SET {set_clause} WHERE user_id=?", values)
-    db.commit()
+    user_cache.update_session(user_id, **kwargs)
 
 def allowed_file(filename):
     return filename.lower().endswith((".pdf", ".docx"))
 
-# Telegram API
-def send_telegram_message(chat_id, text, reply_markup=None):
-    """Send message using direct HTTP requests"""
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": chat_id,
-            "text": text,
-            "parse_mode": "HTML"
+# File Ingest
+def sniff_file_type(head):
+    """Identify a document from its leading bytes"""
+    if head.startswith(b"%PDF-"):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        return "docx"  # OOXML documents are zip containers
+    return "unknown"
+
+class IngestDigest:
+    """Single-pass digest of a file as its bytes arrive: MD5, size and sniffed type"""
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._head = b""
+        self.size = 0
+
+    def update(self, chunk):
+        self._md5.update(chunk)
+        self.size += len(chunk)
+        if len(self._head) < 8:
+            self._head += chunk[:8 - len(self._head)]
+
+    def result(self):
+        return {
+            "file_hash": self._md5.hexdigest(),
+            "file_size": self.size,
+            "file_type": sniff_file_type(self._head)
         }
-        
+
+def digest_file(file_path):
+    """Digest a file already on disk (streamed, never fully loaded)"""
+    digest = IngestDigest()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(INGEST_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.result()
+
+def ingest_matches_extension(ingest, filename):
+    return ingest["file_type"] == os.path.splitext(filename)[1].lower().lstrip(".")
+
+# Scratch Storage
+class ScratchStorage:
+    """Owns TEMP_DIR: one directory per submission, a byte quota and a disk-space floor.
+
+    Uploads live in TEMP_DIR/submissions/<submission id>/ (batch-<batch id>/
+    for the batch API) and are removed as soon as the submission reaches a
+    final state. The janitor sweep removes
+    whatever still slips through (crashes, legacy loose files, old persisted
+    reports). has_room() is the ingest admission check: new uploads are
+    turned away while the quota is used up or the disk is nearly full.
+
+    Usage is a byte counter: uploads are added with reserve() and dropped
+    again by release(). Files written without a reserve() (fingerprints,
+    persisted reports) are picked up when the sweep recounts from disk.
+    """
+
+    FINAL_STATUSES = ("done", "failed", "cancelled")  # submissions and batches alike
+
+    def __init__(self, root, quota_bytes, min_free_bytes, orphan_seconds):
+        self.root = Path(root)
+        self.submissions_dir = self.root / "submissions"
+        self.submissions_dir.mkdir(parents=True, exist_ok=True)
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.orphan_seconds = orphan_seconds
+        self.rejected = 0
+        self.swept_bytes = 0
+        self._lock = threading.Lock()
+        self._used = 0
+        self._dir_bytes = {}  # submission directory name -> bytes reserved in it
+        self.reconcile()
+
+    def path_for(self, submission_id, filename):
+        directory = self.submissions_dir / str(submission_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        return str(directory / os.path.basename(filename))
+
+    def reserve(self, submission_id, nbytes):
+        """Count bytes written to a submission's scratch directory"""
+        key = str(submission_id)
+        with self._lock:
+            self._dir_bytes[key] = self._dir_bytes.get(key, 0) + nbytes
+            self._used += nbytes
+
+    def release(self, submission_id, file_path=None):
+        """Delete a submission's scratch directory (and a pre-scratch loose upload)"""
+        key = str(submission_id)
+        shutil.rmtree(self.submissions_dir / key, ignore_errors=True)
+        with self._lock:
+            self._used -= self._dir_bytes.pop(key, 0)
+        if file_path and Path(file_path).parent == self.root:
+            try:
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+                with self._lock:
+                    self._used -= size
+            except OSError:
+                pass
+
+    @staticmethod
+    def _size(path):
+        if not path.is_dir():
+            try:
+                return path.stat().st_size
+            except OSError:
+                return 0
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def reconcile(self):
+        """Recount usage from disk; the sweep calls this to correct the counter"""
+        dir_bytes = {p.name: self._size(p) for p in self.submissions_dir.iterdir() if p.is_dir()}
+        other = sum(self._size(p) for p in self.root.iterdir() if p != self.submissions_dir)
+        with self._lock:
+            # Leave out directories released while we were walking
+            self._dir_bytes = {name: size for name, size in dir_bytes.items() if (self.submissions_dir / name).exists()}
+            self._used = sum(self._dir_bytes.values()) + other
+            return self._used
+
+    def usage(self):
+        return max(0, self._used)
+
+    def free_bytes(self):
+        return shutil.disk_usage(self.root).free
+
+    def has_room(self, expected_bytes=0):
+        expected_bytes = expected_bytes or 0
+        ok = (self.usage() + expected_bytes <= self.quota_bytes
+              and self.free_bytes() - expected_bytes >= self.min_free_bytes)
+        if not ok:
+            self.rejected += 1
+            print(f"⚠️ Scratch storage full, turning away a {expected_bytes} byte upload")
+        return ok
+
+    def _remove(self, path):
+        size = self._size(path)
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink()
+        self.swept_bytes += size
+        return size
+
+    def sweep(self):
+        """Janitor job: remove scratch files no live submission needs"""
+        now = time.time()
+        removed = 0
+        freed = 0
+        try:
+            entries = list(self.submissions_dir.iterdir())
+            ids = [int(p.name) for p in entries if p.name.isdigit()]
+            statuses = {}
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = db.execute(
+                    f"SELECT id, status FROM submissions WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                statuses.update((r["id"], r["status"]) for r in rows)
+            batch_ids = [int(p.name[6:]) for p in entries if p.name.startswith("batch-") and p.name[6:].isdigit()]
+            batch_statuses = {}
+            for i in range(0, len(batch_ids), 500):
+                chunk = batch_ids[i:i + 500]
+                rows = db.execute(
+                    f"SELECT id, status FROM batches WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                batch_statuses.update((r["id"], r["status"]) for r in rows)
+
+            for path in entries:
+                if path.name.isdigit():
+                    status = statuses.get(int(path.name))
+                elif path.name.startswith("batch-") and path.name[6:].isdigit():
+                    # A batch still receiving files counts as 'created'
+                    status = batch_statuses.get(int(path.name[6:]))
+                    status = {"uploading": "created", "matching": "processing"}.get(status, status)
+                else:
+                    status = None
+                stale = now - path.stat().st_mtime > self.orphan_seconds
+                # Finished or unknown submissions go at once; live ones only if abandoned for too long
+                if status in self.FINAL_STATUSES or (status is None and stale) or (status == "created" and stale):
+                    freed += self._remove(path)
+                    removed += 1
+
+            # Loose files from before per-submission directories
+            for path in self.root.iterdir():
+                if path.is_file() and now - path.stat().st_mtime > self.orphan_seconds:
+                    freed += self._remove(path)
+                    removed += 1
+
+            if REPORTS_DIR.exists():
+                for path in REPORTS_DIR.iterdir():
+                    if path.is_file() and now - path.stat().st_mtime > PERSISTED_REPORT_DAYS * 86400:
+                        freed += self._remove(path)
+                        removed += 1
+        except Exception as e:
+            print(f"❌ Scratch sweep error: {e}")
+
+        usage = self.reconcile()
+        print(f"🧹 Scratch sweep removed {removed} entries ({freed} bytes); {usage} bytes in use")
+        if usage > self.quota_bytes:
+            print(f"⚠️ Scratch storage over quota: {usage}/{self.quota_bytes} bytes")
+
+    def stats(self):
+        return {
+            "used_bytes": self.usage(),
+            "quota_bytes": self.quota_bytes,
+            "free_bytes": self.free_bytes(),
+            "min_free_bytes": self.min_free_bytes,
+            "rejected": self.rejected,
+            "swept_bytes": self.swept_bytes
+        }
+
+scratch = ScratchStorage(TEMP_DIR, SCRATCH_QUOTA_MB * 1024 * 1024, SCRATCH_MIN_FREE_MB * 1024 * 1024, SCRATCH_ORPHAN_HOURS * 3600)
+
+# Telegram API
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available.
+
+    try_acquire() never blocks, so event-loop code (asgi.py) can share a
+    bucket with sender threads and sleep on its own terms.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available; returns 0, or the seconds until one will be"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def delay(self):
+        """Seconds until a token is available (0 if one is now), without taking it"""
+        with self._lock:
+            self._refill()
+            return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """Empty the bucket so no token is handed out for `seconds`"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+class TelegramClient:
+    """Bot API client with a pooled keep-alive session, timeouts, retries and rate limiting.
+
+    Every send waits on a global bucket (Telegram allows ~30 msg/s per bot)
+    and a per-chat bucket (~1 msg/s with a small burst), so broadcasts are
+    paced rather than rejected. A 429 pauses the global bucket (and the
+    chat's) for the `retry_after` Telegram asks for, so every sender holds
+    off, and is retried while attempts remain; network errors and 5xx use
+    exponential backoff with jitter.
+    """
+
+    def __init__(self, token, base_url=TELEGRAM_API_BASE, global_rate=TELEGRAM_GLOBAL_RATE,
+                 chat_rate=TELEGRAM_CHAT_RATE, max_retries=TELEGRAM_MAX_RETRIES, pool_size=20):
+        self.token = token
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = OrderedDict()
+        self._chat_lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        with self._chat_lock:
+            bucket = self._chat_buckets.pop(chat_id, None) or TokenBucket(self.chat_rate, 3)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets.popitem(last=False)
+            return bucket
+
+    def chat_delay(self, chat_id):
+        """Seconds before the next send to this chat would go out without waiting"""
+        return self._chat_bucket(chat_id).delay()
+
+    def buckets(self, chat_id):
+        """Token buckets a send to chat_id takes from, in order"""
+        return (self._chat_bucket(chat_id), self._global_bucket)
+
+    def _backoff_delay(self, attempt):
+        return min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _backoff(self, attempt):
+        time.sleep(self._backoff_delay(attempt))
+
+    def retry_delay(self, method, attempt, status_code, result, chat_id=None):
+        """Seconds to wait before retrying a send, or None when `result` is final.
+
+        status_code is None for network errors and undecodable responses.
+        Shared with asgi.AsyncTelegramClient so both modes retry alike.
+        """
+        last = attempt >= self.max_retries
+        if status_code == 429:
+            retry_after = result.get("parameters", {}).get("retry_after", 1)
+            self._global_bucket.pause(retry_after)
+            if chat_id is not None:
+                self._chat_bucket(chat_id).pause(retry_after)
+            if last:
+                print(f"❌ Telegram rate limit on {method}, giving up after {attempt + 1} attempts")
+                return None
+            print(f"⏳ Telegram rate limit on {method}, retrying in {retry_after}s")
+            return 0 if chat_id is not None else retry_after  # paced calls wait out the pause in the buckets
+        if (status_code is None or status_code >= 500) and not last:
+            return self._backoff_delay(attempt)
+        return None
+
+    def call(self, method, payload=None, files=None, chat_id=None, timeout=(5, 30)):
+        """POST a Bot API method and return the decoded response ({"ok": False, ...} on failure)"""
+        url = f"{self.base_url}/bot{self.token}/{method}"
+        result = {"ok": False, "description": "no attempt made"}
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                for bucket in self.buckets(chat_id):
+                    bucket.acquire()
+            try:
+                if files:
+                    for f in files.values():
+                        f[1].seek(0)
+                    response = self.session.post(url, data=payload, files=files, timeout=timeout)
+                else:
+                    response = self.session.post(url, json=payload, timeout=timeout)
+                result = response.json()
+                status_code = response.status_code
+            except (requests.exceptions.RequestException, ValueError) as e:
+                result = {"ok": False, "description": str(e)}
+                status_code = None
+
+            delay = self.retry_delay(method, attempt, status_code, result, chat_id)
+            if delay is None:
+                return result
+            time.sleep(delay)
+        return result
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
         if reply_markup:
             payload["reply_markup"] = json.dumps(reply_markup)
-        
-        response = requests.post(url, json=payload, timeout=10)
-        result = response.json()
+        return self.call("sendMessage", payload, chat_id=chat_id)
+
+    def send_document(self, chat_id, document, filename=None, caption=None):
+        """Upload a file object, or re-send a stored document when `document` is a file_id string"""
+        data = {"chat_id": chat_id}
+        if caption:
+            data["caption"] = caption
+        if isinstance(document, str):
+            data["document"] = document
+            return self.call("sendDocument", data, chat_id=chat_id)
+        return self.call("sendDocument", data, files={"document": (filename, document)}, chat_id=chat_id, timeout=(5, 60))
+
+    def get_file(self, file_id):
+        return self.call("getFile", {"file_id": file_id})
+
+    def download(self, file_path, destination_path, timeout=(5, 60)):
+        """Stream a file from Telegram's file storage to disk, digesting it on the way.
+
+        Returns the ingest digest (hash, size, sniffed type) or None on failure.
+        """
+        url = f"{self.base_url}/file/bot{self.token}/{file_path}"
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.session.get(url, stream=True, timeout=timeout) as response:
+                    if response.status_code != 200:
+                        if response.status_code >= 500 and attempt < self.max_retries:
+                            self._backoff(attempt)
+                            continue
+                        print(f"❌ Failed to download file: {response.status_code}")
+                        return None
+                    digest = IngestDigest()
+                    with open(destination_path, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=INGEST_CHUNK_SIZE):
+                            digest.update(chunk)
+                            f.write(chunk)
+                return digest.result()
+            except requests.exceptions.RequestException as e:
+                print(f"❌ Download attempt {attempt + 1} failed: {e}")
+                if attempt < self.max_retries:
+                    self._backoff(attempt)
+        return None
+
+telegram = TelegramClient(TELEGRAM_BOT_TOKEN)
+
+class TelegramFileCache:
+    """file_ids Telegram returned for documents we uploaded, keyed by content hash.
+
+    Telegram keeps every uploaded document and lets the bot send it again by
+    file_id, so identical report bytes (re-sends, cache hits, admin
+    re-deliveries) go out as a short sendDocument call instead of another
+    multipart upload. Hashes cover the display filename too, because a
+    re-sent document keeps the name it was uploaded with.
+    """
+
+    def __init__(self, max_memory=10000):
+        self.max_memory = max_memory
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.reuses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def content_hash(content, filename):
+        return hashlib.sha256(filename.encode("utf-8") + b"\0" + content).hexdigest()
+
+    def get(self, content_hash):
+        with self._lock:
+            if content_hash in self._recent:
+                self._recent.move_to_end(content_hash)
+                return self._recent[content_hash]
+        r = db.execute("SELECT file_id FROM telegram_files WHERE content_hash=?", (content_hash,)).fetchone()
+        if not r:
+            return None
+        self._remember(content_hash, r["file_id"])
+        return r["file_id"]
+
+    def put(self, content_hash, file_id, size_bytes):
+        with self._lock:
+            self.uploads += 1
+        if not file_id:
+            return
+        with db_transaction() as conn:
+            conn.execute(
+                "INSERT INTO telegram_files(content_hash, file_id, size_bytes, created_at, last_used_at) VALUES(?,?,?,?,?) "
+                "ON CONFLICT(content_hash) DO UPDATE SET file_id=excluded.file_id, last_used_at=excluded.last_used_at",
+                (content_hash, file_id, size_bytes, now_ts(), now_ts())
+            )
+        self._remember(content_hash, file_id)
+
+    def reused(self, content_hash, size_bytes):
+        with self._lock:
+            self.reuses += 1
+            self.bytes_saved += size_bytes
+        with db_transaction() as conn:
+            conn.execute("UPDATE telegram_files SET last_used_at=? WHERE content_hash=?", (now_ts(), content_hash))
+
+    def forget(self, content_hash):
+        with self._lock:
+            self._recent.pop(content_hash, None)
+        with db_transaction() as conn:
+            conn.execute("DELETE FROM telegram_files WHERE content_hash=?", (content_hash,))
+
+    def _remember(self, content_hash, file_id):
+        with self._lock:
+            self._recent[content_hash] = file_id
+            self._recent.move_to_end(content_hash)
+            if len(self._recent) > self.max_memory:
+                self._recent.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"uploads": self.uploads, "reuses": self.reuses, "bytes_saved": self.bytes_saved}
+
+telegram_files = TelegramFileCache()
+
+def deliver_telegram_message(chat_id, text, reply_markup=None):
+    """Send message through the shared Telegram client (blocks for the round trip)"""
+    try:
+        result = telegram.send_message(chat_id, text, reply_markup)
         
         if result.get("ok"):
             print(f"✅ Message sent to {chat_id}")
@@ -259,12 +1515,10 @@ def send_telegram_message(chat_id, text, reply_markup=None):
         return False
 
 def download_telegram_file(file_id, destination_path):
-    """Download file from Telegram using direct HTTP requests"""
+    """Download file from Telegram through the shared client; returns its ingest digest or False"""
     try:
         # Get file path
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getFile"
-        response = requests.post(url, json={"file_id": file_id})
-        result = response.json()
+        result = telegram.get_file(file_id)
         
         if not result.get("ok"):
             print(f"❌ Failed to get file path: {result}")
@@ -273,48 +1527,200 @@ def download_telegram_file(file_id, destination_path):
         file_path = result["result"]["file_path"]
         
         # Download file
-        download_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}"
-        response = requests.get(download_url, stream=True)
-        
-        if response.status_code == 200:
-            with open(destination_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            print(f"✅ File downloaded to: {destination_path}")
-            return True
-        else:
-            print(f"❌ Failed to download file: {response.status_code}")
-            return False
+        ingest = telegram.download(file_path, destination_path)
+        if ingest:
+            print(f"✅ File downloaded to: {destination_path} ({ingest['file_size']} bytes, {ingest['file_type']})")
+            return ingest
+        return False
             
     except Exception as e:
         print(f"❌ Error downloading file: {e}")
         return False
 
-def send_telegram_document(chat_id, document_path, caption=None, filename=None):
-    """Send document using direct HTTP requests"""
+def deliver_telegram_document(chat_id, document_path, caption=None, filename=None):
+    """Send document through the shared Telegram client (blocks for the upload).
+
+    document_path may also be the document's contents as bytes. Documents
+    Telegram already has are re-sent by file_id instead of uploaded again.
+    """
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendDocument"
-        
-        with open(document_path, 'rb') as document:
-            files = {'document': (filename or os.path.basename(document_path), document)}
-            data = {'chat_id': chat_id}
-            if caption:
-                data['caption'] = caption
-                
-            response = requests.post(url, files=files, data=data)
-            result = response.json()
-            
+        if isinstance(document_path, bytes):
+            content = document_path
+            filename = filename or "document.txt"
+        else:
+            with open(document_path, 'rb') as document:
+                content = document.read()
+            filename = filename or os.path.basename(document_path)
+
+        content_hash = telegram_files.content_hash(content, filename)
+        file_id = telegram_files.get(content_hash)
+        if file_id:
+            result = telegram.send_document(chat_id, file_id, caption=caption)
             if result.get("ok"):
-                print(f"✅ Document sent to {chat_id}")
+                telegram_files.reused(content_hash, len(content))
+                print(f"✅ Document re-sent to {chat_id} by file_id")
                 return True
-            else:
+            if result.get("error_code") != 400:
                 print(f"❌ Failed to send document: {result}")
                 return False
+            # Telegram no longer accepts this file_id - upload the bytes again
+            telegram_files.forget(content_hash)
+
+        result = telegram.send_document(chat_id, io.BytesIO(content), filename, caption)
+            
+        if result.get("ok"):
+            telegram_files.put(content_hash, (result["result"].get("document") or {}).get("file_id"), len(content))
+            print(f"✅ Document sent to {chat_id}")
+            return True
+        else:
+            print(f"❌ Failed to send document: {result}")
+            return False
                 
     except Exception as e:
         print(f"❌ Error sending document: {e}")
         return False
 
+# Outbound Delivery
+class OutboundQueue:
+    """Background delivery of outgoing Telegram messages and documents.
+
+    Handlers enqueue and return immediately; sender threads do the network
+    round trips. Each chat is pinned to one sender shard, which keeps a FIFO
+    per chat: messages to the same chat keep their order, and a chat whose
+    rate limit is used up waits without holding back the other chats on its
+    shard. Senders take one message per ready chat in turn, up to
+    `batch_size` per pass.
+    """
+
+    def __init__(self, senders=4, batch_size=20, client=None):
+        self.senders = max(1, senders)
+        self.batch_size = batch_size
+        self.client = client
+        self._queues = [queue.Queue() for _ in range(self.senders)]
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._held = 0  # taken off a shard queue, waiting in a chat FIFO or being sent
+        self.delivered = 0
+        self.failed = 0
+
+    def start(self):
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"outbound-sender-{i}", daemon=True)
+            t.start()
+
+    def enqueue(self, chat_id, fn, *args, **kwargs):
+        shard = self._queues[hash(chat_id) % self.senders]
+        shard.put((time.monotonic(), fn, chat_id, args, kwargs))
+        return True
+
+    def _chat_delay(self, chat_id):
+        return self.client.chat_delay(chat_id) if self.client else 0
+
+    def _run(self, q):
+        chats = OrderedDict()  # chat_id -> deque of items, chats in round-robin order
+        wait = None
+        while True:
+            try:
+                items = [q.get(timeout=wait)] if wait != 0 else []
+            except queue.Empty:
+                items = []
+            while len(items) < self.batch_size:
+                try:
+                    items.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            self._hold(chats, items)
+            for item in items:
+                q.task_done()
+            ready, wait = self._take_ready(chats)
+            for item in ready:
+                self._deliver(*item)
+
+    def _hold(self, chats, items):
+        for item in items:
+            chats.setdefault(item[2], deque()).append(item)
+        with self._lock:
+            self._held += len(items)
+
+    def _take_ready(self, chats):
+        """One item from each chat that can send now, up to batch_size.
+
+        Returns (items, wait): wait is 0 when more can go out straight away,
+        the seconds until the next chat is ready, or None when nothing is held.
+        """
+        ready, wait = [], None
+        for chat_id in list(chats):
+            if len(ready) >= self.batch_size:
+                break
+            delay = self._chat_delay(chat_id)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            pending = chats[chat_id]
+            ready.append(pending.popleft())
+            if pending:
+                chats.move_to_end(chat_id)
+            else:
+                del chats[chat_id]
+        if ready and chats:
+            wait = 0
+        return ready, wait
+
+    def _delivered(self, enqueued_at, ok):
+        self._record(enqueued_at, ok)
+        with self._lock:
+            self._held -= 1
+
+    def _deliver(self, enqueued_at, fn, chat_id, args, kwargs):
+        try:
+            ok = fn(chat_id, *args, **kwargs)
+        except Exception as e:
+            print(f"❌ Outbound delivery error: {e}")
+            ok = False
+        self._delivered(enqueued_at, ok)
+
+    def _record(self, enqueued_at, ok):
+        with self._lock:
+            if ok:
+                self.delivered += 1
+            else:
+                self.failed += 1
+            self._latencies.append((time.monotonic() - enqueued_at) * 1000)
+            if len(self._latencies) > 1000:
+                del self._latencies[:500]
+
+    def flush(self, timeout=5):
+        """Wait (bounded) for queued deliveries, e.g. on shutdown"""
+        deadline = time.monotonic() + timeout
+        while self.backlog() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def backlog(self):
+        return sum(q.qsize() for q in self._queues) + self._held
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            delivered, failed = self.delivered, self.failed
+        return {
+            "senders": self.senders,
+            "backlog": self.backlog(),
+            "delivered": delivered,
+            "failed": failed,
+            "latency_ms_p50": round(latencies[len(latencies) // 2], 1) if latencies else None,
+            "latency_ms_p95": round(latencies[int(len(latencies) * 0.95) - 1], 1) if latencies else None
+        }
+
+outbound = OutboundQueue(OUTBOUND_SENDERS, client=telegram)  # started with the engine, after its pool is forked
+
+def send_telegram_message(chat_id, text, reply_markup=None):
+    """Queue a message for background delivery"""
+    return outbound.enqueue(chat_id, deliver_telegram_message, text, reply_markup)
+
+def send_telegram_document(chat_id, document_path, caption=None, filename=None):
+    """Queue a document for background delivery"""
+    return outbound.enqueue(chat_id, deliver_telegram_document, document_path, caption=caption, filename=filename)
+
 # Inline Keyboard Helper
 def create_inline_keyboard(buttons):
     """Create inline keyboard markup"""
@@ -392,23 +1798,22 @@ def handle_payment_selection(user_id, plan):
     else:
         send_telegram_message(user_id, "❌ Payment system temporarily unavailable. Please try again later.")
 
-def activate_user_subscription(user_id, plan):
+def activate_user_subscription(user_id, plan, conn=None):
     """Activate user's subscription after successful payment"""
     try:
-        cur = db.cursor()
         plan_data = PLANS[plan]
         
-        # Calculate expiry date
-        expiry_date = (datetime.datetime.now() + datetime.timedelta(days=plan_data['duration_days'])).strftime('%Y-%m-%d %H:%M:%S')
+        # Calculate expiry (expiry_ts drives the expiry job, expiry_date is for display)
+        expiry_ts = now_ts() + plan_data['duration_days'] * 86400
+        expiry_date = datetime.datetime.fromtimestamp(expiry_ts).strftime('%Y-%m-%d %H:%M:%S')
         
         # Update user plan
-        cur.execute(
-            "UPDATE users SET plan=?, daily_limit=?, expiry_date=?, used_today=0, subscription_active=1 WHERE user_id=?",
-            (plan, plan_data['daily_limit'], expiry_date, user_id)
+        user_cache.update_user(
+            user_id,
+            "plan=?, daily_limit=?, expiry_date=?, expiry_ts=?, used_today=0, subscription_active=1",
+            (plan, plan_data['daily_limit'], expiry_date, expiry_ts), conn=conn
         )
         
-        db.commit()
-        
         print(f"✅ Subscription activated for user {user_id}, plan {plan}")
         return expiry_date
         
@@ -416,84 +1821,164 @@ def activate_user_subscription(user_id, plan):
         print(f"❌ Subscription activation error: {e}")
         return None
     
-def process_withdrawal_payment(user_id, amount, mobile_money_number):
-    """Process withdrawal payment to user's mobile money using Paystack API"""
-    try:
-        print(f"💰 Processing withdrawal: User {user_id}, Amount: ₵{amount}, Mobile: {mobile_money_number}")
-        
-        # Paystack API endpoint for mobile money transfers
-        url = "https://api.paystack.co/transfer"
-        
-        # Prepare the request headers
-        headers = {
-            "Authorization": f"Bearer {PAYSTACK_SECRET_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # Prepare the transfer data
-        transfer_data = {
-            "source": "balance",  # Transfer from your balance
-            "amount": int(amount * 100),  # Convert to kobo (Paystack uses smallest currency unit)
-            "recipient": mobile_money_number,
-            "reason": f"TurnitQ Referral Withdrawal - User {user_id}",
-            "reference": f"TQ_WD_{user_id}_{now_ts()}"
+# Paystack API client
+class PaystackClient:
+    """Paystack REST client with a pooled keep-alive session, timeouts and retries.
+
+    Transfers go to recipient codes, which Paystack wants created once per
+    account: recipient() keeps them in paystack_recipients so each mobile
+    money number costs one /transferrecipient call ever. bulk_transfer()
+    sends up to 100 transfers per request (needs OTP disabled on the
+    Paystack account, like any API transfer). PAYSTACK_API_BASE points the
+    client at a local stub server for testing.
+    """
+
+    def __init__(self, secret_key, base_url=PAYSTACK_API_BASE, max_retries=PAYSTACK_MAX_RETRIES, pool_size=10):
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {secret_key}", "Content-Type": "application/json"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.requests = 0
+        self.errors = 0
+        self.recipients_created = 0
+
+    def _backoff(self, attempt):
+        time.sleep(min(10, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def call(self, method, path, payload=None, timeout=(5, 30)):
+        """Send one API request and return the decoded body ({"status": False, ...} on failure)"""
+        url = f"{self.base_url}{path}"
+        result = {"status": False, "message": "no attempt made"}
+        for attempt in range(self.max_retries + 1):
+            self.requests += 1
+            try:
+                response = self.session.request(method, url, json=payload, timeout=timeout)
+                result = response.json()
+                result["http_status"] = response.status_code
+            except (requests.exceptions.RequestException, ValueError, TypeError) as e:
+                result = {"status": False, "message": str(e)}
+                if attempt < self.max_retries:
+                    self._backoff(attempt)
+                continue
+            # 4xx other than rate limiting is a real answer (bad number, low balance...)
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < self.max_retries:
+                self._backoff(attempt)
+                continue
+            break
+        if not result.get("status"):
+            self.errors += 1
+        return result
+
+    def recipient(self, account_number, bank_code, name):
+        """Transfer recipient code for a mobile money account, created on first use"""
+        r = db.execute(
+            "SELECT recipient_code FROM paystack_recipients WHERE account_number=? AND bank_code=?",
+            (account_number, bank_code)
+        ).fetchone()
+        if r:
+            return r["recipient_code"]
+        result = self.call("POST", "/transferrecipient", {
+            "type": "mobile_money",
+            "name": name,
+            "account_number": account_number,
+            "bank_code": bank_code,
+            "currency": PAYSTACK_TRANSFER_CURRENCY
+        })
+        if not result.get("status"):
+            print(f"❌ Could not create Paystack recipient for {account_number}: {result.get('message')}")
+            return None
+        code = result["data"]["recipient_code"]
+        db.execute(
+            "INSERT INTO paystack_recipients(account_number, bank_code, recipient_code, created_at) VALUES(?, ?, ?, ?) "
+            "ON CONFLICT(account_number, bank_code) DO UPDATE SET recipient_code=excluded.recipient_code",
+            (account_number, bank_code, code, now_ts())
+        )
+        db.commit()
+        self.recipients_created += 1
+        return code
+
+    def verify_transfer(self, reference):
+        """Transfer data for a reference we sent before, or None if Paystack never got it.
+
+        Raises when Paystack can't be asked, since "unknown" must not be
+        mistaken for "never sent".
+        """
+        result = self.call("GET", f"/transfer/verify/{reference}")
+        if result.get("status"):
+            return result.get("data")
+        if result.get("http_status") == 404:
+            return None
+        raise RuntimeError(f"could not verify transfer {reference}: {result.get('message')}")
+
+    def bulk_transfer(self, transfers):
+        """Send (amount, recipient_code, reference, reason) tuples in as few requests as possible.
+
+        Returns {reference: transfer data} for the transfers Paystack accepted.
+        """
+        accepted = {}
+        for start in range(0, len(transfers), PAYSTACK_BULK_SIZE):
+            chunk = transfers[start:start + PAYSTACK_BULK_SIZE]
+            result = self.call("POST", "/transfer/bulk", {
+                "currency": PAYSTACK_TRANSFER_CURRENCY,
+                "source": "balance",
+                "transfers": [
+                    {"amount": int(round(amount * 100)), "recipient": code, "reference": reference, "reason": reason}
+                    for amount, code, reference, reason in chunk
+                ]
+            }, timeout=(5, 60))
+            if not result.get("status"):
+                print(f"❌ Paystack bulk transfer of {len(chunk)} failed: {result.get('message')}")
+                continue
+            for item in result.get("data") or []:
+                accepted[item.get("reference")] = item
+        return accepted
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "recipients_created": self.recipients_created
         }
-        
-        # Make the API request to Paystack
-        response = requests.post(url, json=transfer_data, headers=headers, timeout=30)
-        result = response.json()
-        
-        print(f"🔍 Paystack API Response: {result}")
-        
-        if result.get('status') == True:
-            # Transfer was successful
-            transfer_reference = result['data']['reference']
-            transfer_code = result['data']['transfer_code']
-            
-            print(f"✅ Withdrawal payment successful! Reference: {transfer_reference}")
-            
-            # Update withdrawal record with Paystack reference
-            cur = db.cursor()
-            cur.execute(
-                "UPDATE withdrawals SET status='processed', processed_at=?, paystack_reference=? WHERE user_id=? AND status='pending' AND mobile_money_number=?",
-                (now_ts(), transfer_reference, user_id, mobile_money_number)
-            )
-            db.commit()
-            
-            return True, f"✅ Withdrawal of ₵{amount} processed successfully! Payment sent to {mobile_money_number}. Paystack Reference: {transfer_reference}"
-        
-        else:
-            # Transfer failed
-            error_message = result.get('message', 'Unknown error occurred')
-            print(f"❌ Paystack transfer failed: {error_message}")
-            
-            # Update withdrawal record as failed
-            cur = db.cursor()
-            cur.execute(
-                "UPDATE withdrawals SET status='failed' WHERE user_id=? AND status='pending' AND mobile_money_number=?",
-                (user_id, mobile_money_number)
-            )
-            db.commit()
-            
-            return False, f"❌ Withdrawal failed: {error_message}. Please try again or contact support."
-            
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Network error during Paystack transfer: {e}")
-        return False, f"❌ Network error during payment processing. Please try again later."
-    except Exception as e:
-        print(f"❌ Unexpected error during withdrawal processing: {e}")
-        return False, f"❌ Unexpected error occurred. Please contact support."
+
+paystack = PaystackClient(PAYSTACK_SECRET_KEY)
+
+# Ghana mobile money prefixes -> Paystack bank codes
+MOBILE_MONEY_PROVIDERS = {
+    "024": "MTN", "025": "MTN", "053": "MTN", "054": "MTN", "055": "MTN", "059": "MTN",
+    "020": "VOD", "050": "VOD",
+    "026": "ATL", "027": "ATL", "056": "ATL", "057": "ATL",
+}
+
+def mobile_money_provider(mobile_money_number):
+    return MOBILE_MONEY_PROVIDERS.get(mobile_money_number[:3])
+
+def withdrawal_reference(withdrawal_id, attempt):
+    # Paystack references are lowercase alphanumerics, '-' and '_', and can't be reused
+    # after a failed transfer, so every attempt gets its own; the one sent is kept on the row
+    return f"tq-wd-{withdrawal_id}-{attempt}"
+
+def withdrawal_recipient(user_id, mobile_money_number):
+    bank_code = mobile_money_provider(mobile_money_number)
+    if not bank_code:
+        return None
+    return paystack.recipient(mobile_money_number, bank_code, f"TurnitQ user {user_id}")
+
+# Similarity index shared by all workers
+similarity_index = similarity.SimilarityIndex(SIMILARITY_INDEX_DIR, get_db, db_transaction)
 
 # SIMULATION helpers
-def analyze_document_content(file_path, filename):
+def analyze_document_content(file_path, filename, ingest=None, options=None, submission_id=None):
     try:
-        file_size = os.path.getsize(file_path)
+        # The ingest digest is computed while downloading; only re-digest legacy rows
+        if not ingest or not ingest.get("file_hash"):
+            ingest = digest_file(file_path)
+        file_size = ingest["file_size"]
         file_extension = os.path.splitext(filename)[1].lower()
         
-        with open(file_path, 'rb') as f:
-            content = f.read()
-        
-        file_hash = hashlib.md5(content).hexdigest()
+        file_hash = ingest["file_hash"]
         hash_int = int(file_hash[:8], 16)
         
         if file_extension == '.pdf':
@@ -506,11 +1991,45 @@ def analyze_document_content(file_path, filename):
         size_factor = min(1.0, file_size / 100000)
         base_similarity = int(base_similarity * (0.8 + size_factor * 0.4))
         
+        # Real text statistics, stylometry and similarity fingerprints in one
+        # streaming pass; a document we cannot parse still gets the byte-level analysis
+        options = options or {}
+        text = match = index_fingerprints = style = None
+        try:
+            fingerprinter = similarity.DocumentFingerprinter(options)
+            profile = stylometry.StyleProfile()
+
+            def consume(block):
+                fingerprinter.feed(block)
+                profile.feed(block)
+
+            text = extract.text_stats(file_path, ingest.get("file_type") or file_extension.lstrip("."), on_block=consume)
+            print(f"📄 Extracted {text['words']} words from {text['pages']} pages in {text['elapsed']}s"
+                  f"{' (truncated)' if text['truncated'] else ''}")
+            style = profile.result()
+            if style:
+                readability_score = style["readability"]
+                print(f"✍️ Stylometry: readability {style['readability']}, AI likelihood {style['ai_score']}%")
+            index_fingerprints = fingerprinter.full.array()
+            if len(index_fingerprints):
+                match = similarity_index.match(
+                    fingerprinter.filtered.array(),
+                    exclude_submission_id=submission_id,
+                    exclude_small_matches=bool(options.get('exclude_small_matches'))
+                )
+                print(f"🔎 Corpus match: {match['similarity_score']}% across {len(match['sources'])} sources")
+        except Exception as e:
+            print(f"⚠️ Text extraction failed: {e}")
+        
         return {
             "base_similarity": min(45, base_similarity),
             "readability_score": readability_score,
             "file_complexity": size_factor,
-            "file_hash": file_hash[:12]
+            "file_hash": file_hash[:12],
+            "text": text,
+            "similarity": match,
+            "style": style,
+            "index_fingerprints": index_fingerprints
         }
         
     except Exception as e:
@@ -526,25 +2045,37 @@ def generate_realistic_scores(file_analysis, options, filename):
     base_similarity = file_analysis["base_similarity"]
     readability = file_analysis["readability_score"]
     
-    adjustments = 0
-    if options.get('exclude_bibliography'):
-        adjustments += random.randint(3, 8)
-    if options.get('exclude_quoted_text'):
-        adjustments += random.randint(2, 6)
-    if options.get('exclude_cited_text'):
-        adjustments += random.randint(2, 5)
-    if options.get('exclude_small_matches'):
-        adjustments += random.randint(1, 4)
-    
-    final_similarity = max(5, base_similarity - adjustments)
+    if file_analysis.get("similarity"):
+        # Corpus match - the report options were applied while fingerprinting
+        final_similarity = file_analysis["similarity"]["similarity_score"]
+    else:
+        adjustments = 0
+        if options.get('exclude_bibliography'):
+            adjustments += random.randint(3, 8)
+        if options.get('exclude_quoted_text'):
+            adjustments += random.randint(2, 6)
+        if options.get('exclude_cited_text'):
+            adjustments += random.randint(2, 5)
+        if options.get('exclude_small_matches'):
+            adjustments += random.randint(1, 4)
+        
+        final_similarity = max(5, base_similarity - adjustments)
     
-    ai_probability = max(5, min(80, 
-        (final_similarity * 0.6) + 
-        ((100 - readability) * 0.3) +
-        (random.randint(-10, 15))
-    ))
+    style = file_analysis.get("style")
+    if style:
+        ai_probability = max(1, min(99, style["ai_score"]))
+    else:
+        # Not enough extracted text for stylometry - fall back to the byte-level estimate
+        ai_probability = max(5, min(80, 
+            (final_similarity * 0.6) + 
+            ((100 - readability) * 0.3)
+        ))
     
-    writing_style = "Academic" if readability > 70 else "Mixed"
+    if style:
+        # Flesch reading ease: dense academic prose scores low
+        writing_style = "Academic" if readability < 50 else "Mixed"
+    else:
+        writing_style = "Academic" if readability > 70 else "Mixed"
     if final_similarity > 30:
         writing_style = "Derivative"
     
@@ -553,15 +2084,33 @@ def generate_realistic_scores(file_analysis, options, filename):
         "ai_score": int(ai_probability),
         "writing_style": writing_style,
         "readability_index": readability,
-        "word_count_estimate": int(file_analysis["file_complexity"] * 1500 + random.randint(200, 800))
+        "stylometry": style,
+        "word_count_estimate": (file_analysis["text"]["words"] if file_analysis.get("text")
+                                else int(file_analysis["file_complexity"] * 1500 + random.randint(200, 800)))
     }
 
-def generate_turnitin_report(filename, scores, options, file_analysis, source="ADVANCED_ANALYSIS"):
-    report_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+def generate_turnitin_report(filename, scores, options, file_analysis, source="ADVANCED_ANALYSIS", report_time=None):
+    report_time = report_time or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    internet_sources = scores["similarity_score"] // 2
-    publications = scores["similarity_score"] // 3
-    student_papers = scores["similarity_score"] // 4
+    match = file_analysis.get("similarity")
+    if match:
+        # The corpus holds previously submitted papers only
+        internet_sources = publications = 0
+        student_papers = scores["similarity_score"]
+        top_sources = "\n".join(
+            f"{i}. Student Paper #{m['document']} (submitted {m['submitted']}): {m['percent']}%"
+            for i, m in enumerate(match["sources"], 1)
+        ) or "No matching sources found."
+    else:
+        internet_sources = scores["similarity_score"] // 2
+        publications = scores["similarity_score"] // 3
+        student_papers = scores["similarity_score"] // 4
+        top_sources = (
+            f"1. Academic Journal (2023): {internet_sources}%\n"
+            f"2. Research Repository: {publications}%\n"
+            f"3. Online Database: {student_papers}%\n"
+            f"4. Conference Paper (2024): {max(1, scores['similarity_score'] // 6)}%"
+        )
     
     if scores["ai_score"] < 20:
         ai_analysis = "LOW probability of AI-generated content. Writing appears predominantly human."
@@ -602,10 +2151,7 @@ Exclude Small Matches: {'Yes' if options.get('exclude_small_matches') else 'No'}
 
 TOP MATCHING SOURCES:
 ---------------------
-1. Academic Journal (2023): {internet_sources}%
-2. Research Repository: {publications}%
-3. Online Database: {student_papers}%
-4. Conference Paper (2024): {max(1, scores['similarity_score'] // 6)}%
+{top_sources}
 
 AI DETECTION ANALYSIS:
 ----------------------
@@ -615,26 +2161,12 @@ Note: Analysis performed using advanced text pattern recognition.
 """
     return report
 
-def submit_to_turnitin_simulation(file_path, filename, options):
-    try:
-        print("🔍 Analyzing document with advanced simulation...")
-        
-        file_analysis = analyze_document_content(file_path, filename)
-        scores = generate_realistic_scores(file_analysis, options, filename)
-        detailed_report = generate_turnitin_report(filename, scores, options, file_analysis)
-        
-        timestamp = int(time.time())
-        report_path = str(TEMP_DIR / f"turnitin_report_{timestamp}.txt")
-        ai_analysis_path = str(TEMP_DIR / f"ai_analysis_{timestamp}.txt")
-        
-        with open(report_path, 'w', encoding='utf-8') as f:
-            f.write(detailed_report)
-        
-        ai_report = f"""
+def generate_ai_report(filename, scores, report_time=None):
+    return f"""
 AI WRITING DETECTION REPORT
 ============================
 Document: {filename}
-Analysis Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+Analysis Date: {report_time or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 
 AI PROBABILITY SCORE: {scores['ai_score']}%
 
@@ -645,18 +2177,41 @@ CLASSIFICATION:
  "HIGH AI probability - Likely AI-generated"}
 
 CONFIDENCE: {max(75, 100 - scores['ai_score'])}%
+{stylometry_section(scores.get('stylometry'))}"""
+
+def stylometry_section(style):
+    if not style:
+        return ""
+    return f"""
+STYLOMETRIC INDICATORS:
+-----------------------
+Sentence Length: {style['mean_sentence_length']} words (std {style['sentence_length_std']})
+Burstiness: {style['burstiness']}
+Lexical Diversity (TTR per 500 words): {style['segment_ttr']}
+Average Word Length: {style['mean_word_length']}
+Function Word Rate: {style['function_word_rate']}
 """
+
+def submit_to_turnitin_simulation(file_path, filename, options, ingest=None, submission_id=None):
+    try:
+        print("🔍 Analyzing document with advanced simulation...")
         
-        with open(ai_analysis_path, 'w', encoding='utf-8') as f:
-            f.write(ai_report)
+        file_analysis = analyze_document_content(file_path, filename, ingest, options, submission_id)
+        index_fingerprints = file_analysis.pop("index_fingerprints", None)
+        scores = generate_realistic_scores(file_analysis, options, filename)
+        report_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        detailed_report = generate_turnitin_report(filename, scores, options, file_analysis, report_time=report_time)
+        ai_report = generate_ai_report(filename, scores, report_time)
         
         print(f"✅ Generated realistic scores - Similarity: {scores['similarity_score']}%, AI: {scores['ai_score']}%")
         
         return {
             "similarity_score": scores["similarity_score"],
             "ai_score": scores["ai_score"],
-            "similarity_report_path": report_path,
-            "ai_report_path": ai_analysis_path,
+            "similarity_report": detailed_report.encode("utf-8"),
+            "ai_report": ai_report.encode("utf-8"),
+            "analysis": {"scores": scores, "file_analysis": file_analysis, "report_time": report_time},
+            "index_fingerprints": index_fingerprints,
             "success": True,
             "source": "ADVANCED_ANALYSIS"
         }
@@ -665,33 +2220,207 @@ CONFIDENCE: {max(75, 100 - scores['ai_score'])}%
         print(f"❌ Simulation error: {e}")
         return None
 
+# Report Cache
+REPORT_OPTIONS = ("exclude_bibliography", "exclude_quoted_text", "exclude_cited_text", "exclude_small_matches")
+
+def report_options_key(options):
+    """Stable cache key for the report options, e.g. '1011'"""
+    return "".join("1" if options.get(name) else "0" for name in REPORT_OPTIONS)
+
+class ReportCache:
+    """Content-addressed cache of finished analyses.
+
+    Entries are keyed by the full upload hash and the options used, so a
+    resubmitted document is answered without being analysed again. Only the
+    analysis (scores, document features and analysis time) is stored; the
+    report texts are rendered in memory for each hit so they carry the new
+    submission's filename. Entries expire after the TTL, and least recently hit
+    entries are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, ttl_seconds, max_bytes):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, file_hash, options):
+        """Return the cached analysis for this document and options, or None"""
+        if not file_hash:
+            return None
+        now = now_ts()
+        with db_transaction() as conn:
+            row = conn.execute(
+                "UPDATE report_cache SET hits=hits+1, last_hit_at=? "
+                "WHERE file_hash=? AND options_key=? AND created_at>=? RETURNING file_size, analysis",
+                (now, file_hash, report_options_key(options), now - self.ttl_seconds)
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bytes_saved += row["file_size"] or 0
+        return json.loads(row["analysis"])
+
+    def peek(self, file_hash, options):
+        """Cached analysis without counting a hit (re-deliveries)"""
+        r = db.execute(
+            "SELECT analysis FROM report_cache WHERE file_hash=? AND options_key=? AND created_at>=?",
+            (file_hash, report_options_key(options), now_ts() - self.ttl_seconds)
+        ).fetchone()
+        return json.loads(r["analysis"]) if r else None
+
+    def put(self, file_hash, options, file_size, analysis):
+        if not file_hash or not analysis:
+            return
+        payload = json.dumps(analysis)
+        now = now_ts()
+        try:
+            with db_transaction() as conn:
+                conn.execute(
+                    "INSERT INTO report_cache(file_hash, options_key, file_size, analysis, size_bytes, created_at, last_hit_at) "
+                    "VALUES(?,?,?,?,?,?,?) ON CONFLICT(file_hash, options_key) DO UPDATE SET "
+                    "analysis=excluded.analysis, size_bytes=excluded.size_bytes, created_at=excluded.created_at, last_hit_at=excluded.last_hit_at",
+                    (file_hash, report_options_key(options), file_size, payload, len(payload), now, now)
+                )
+                self._evict(conn, now)
+        except Exception as e:
+            print(f"⚠️ Report cache write failed: {e}")
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM report_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        excess = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM report_cache").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        stale = []
+        for row in conn.execute("SELECT file_hash, options_key, size_bytes FROM report_cache ORDER BY last_hit_at"):
+            stale.append((row["file_hash"], row["options_key"]))
+            excess -= row["size_bytes"]
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM report_cache WHERE file_hash=? AND options_key=?", stale)
+
+    def stats(self):
+        r = db.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS size FROM report_cache").fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "entries": r["entries"],
+                "size_bytes": r["size"],
+                "max_bytes": self.max_bytes
+            }
+
+report_cache = ReportCache(REPORT_CACHE_TTL_HOURS * 3600, REPORT_CACHE_MAX_MB * 1024 * 1024)
+
+def render_cached_result(filename, options, analysis):
+    """Build a submit_to_turnitin_simulation-style result from a cached analysis, in memory"""
+    scores = analysis["scores"]
+    report_time = analysis.get("report_time")
+    return {
+        "similarity_score": scores["similarity_score"],
+        "ai_score": scores["ai_score"],
+        "similarity_report": generate_turnitin_report(filename, scores, options, analysis["file_analysis"], report_time=report_time).encode("utf-8"),
+        "ai_report": generate_ai_report(filename, scores, report_time).encode("utf-8"),
+        "success": True,
+        "source": "REPORT_CACHE"
+    }
+
+def persist_reports(submission_id, result):
+    """Keep a copy of a submission's reports on disk; returns the similarity report path"""
+    REPORTS_DIR.mkdir(parents=True, exist_ok=True)
+    report_path = None
+    for key, prefix in (("similarity_report", "turnitin_report"), ("ai_report", "ai_analysis")):
+        if result.get(key):
+            path = REPORTS_DIR / f"{prefix}_{submission_id}.txt"
+            path.write_bytes(result[key])
+            if key == "similarity_report":
+                report_path = str(path)
+    return report_path
+
+def send_analysis_result(user_id, filename, options, result, is_free_check, source_text="Advanced Analysis", upsell=True):
+    """Send the scores, report documents and any free-check upsell to the user"""
+    caption = (
+        f"✅ {source_text} Complete!\n\n"
+        f"📊 Similarity Score: {result['similarity_score']}%\n"
+        f"🤖 AI Detection Score: {result['ai_score']}%\n\n"
+        f"Options used:\n"
+        f"• Exclude bibliography: {'Yes' if options.get('exclude_bibliography') else 'No'}\n"
+        f"• Exclude quoted text: {'Yes' if options.get('exclude_quoted_text') else 'No'}\n"
+        f"• Exclude cited text: {'Yes' if options.get('exclude_cited_text') else 'No'}\n"
+        f"• Exclude small matches: {'Yes' if options.get('exclude_small_matches') else 'No'}"
+    )
+    
+    similarity_report = result.get("similarity_report_path") or result.get("similarity_report")
+    if similarity_report:
+        send_telegram_document(
+            user_id, 
+            similarity_report, 
+            caption=caption,
+            filename=f"report_{filename}.txt"
+        )
+    
+    # Only send AI report to paid users (or to a free user if it was their free check)
+    u = user_get(user_id)
+    ai_report = result.get("ai_report_path") or result.get("ai_report")
+    if ai_report and (u['plan'] != 'free' or is_free_check):
+        send_telegram_document(
+            user_id,
+            ai_report,
+            caption="🤖 AI Writing Analysis",
+            filename=f"ai_analysis_{filename}.txt"
+        )
+    
+    if is_free_check and upsell:
+        upgrade_keyboard = create_inline_keyboard([
+            [("💎 Upgrade Plan", "upgrade_after_free")],
+            [("💰 Earn ₵10 per Referral", "show_referral")]
+        ])
+        send_telegram_message(
+            user_id,
+            "🎁 Your first check was free!\nUpgrade for more features or earn ₵10 for each friend you refer!",
+            reply_markup=upgrade_keyboard
+        )
+
 # MAIN PROCESSING
 def process_document(submission_id, file_path, options):
     """Main processing with automatic fallback and cancellation checks"""
-    user_id = None
+    user_id = attempts = None
     try:
         cur = db.cursor()
-        # mark processing (only if still queued)
+        # mark processing (only if still queued) and renew the queue lease
         cur.execute("UPDATE submissions SET status=? WHERE id=? AND status IN ('queued','created')", ("processing", submission_id))
+        cur.execute("UPDATE submissions SET lease_expires_at=? WHERE id=? AND status='processing'", (now_ts() + QUEUE_LEASE_SECONDS, submission_id))
         db.commit()
 
-        r = cur.execute("SELECT user_id, filename, is_free_check, status FROM submissions WHERE id=?", (submission_id,)).fetchone()
+        r = cur.execute("SELECT user_id, filename, is_free_check, status, attempts, file_hash, file_size, file_type FROM submissions WHERE id=?", (submission_id,)).fetchone()
         if not r:
             return
         user_id = r["user_id"]
+        # Our lease: a sweep that requeues the row and a new claim bump attempts
+        attempts = r["attempts"]
         filename = r["filename"]
         is_free_check = r["is_free_check"]
+        ingest = {"file_hash": r["file_hash"], "file_size": r["file_size"], "file_type": r["file_type"]}
 
         # Check if cancelled
         row = cur.execute("SELECT status FROM submissions WHERE id=?", (submission_id,)).fetchone()
         if row and row['status'] == 'cancelled':
+            scratch.release(submission_id, file_path)
+            capacity.release(submission_id)
             send_telegram_message(user_id, "❌ Your submission was cancelled before processing began.")
             return
 
         send_telegram_message(user_id, "🚀 Starting document analysis...")
 
-        # Use simulation approach
-        turnitin_result = submit_to_turnitin_simulation(file_path, filename, options)
+        # Use simulation approach (CPU-bound, runs in the engine's process pool if enabled)
+        turnitin_result = engine.run_cpu(submit_to_turnitin_simulation, file_path, filename, options, ingest, submission_id)
         source = "ADVANCED_ANALYSIS"
 
         # Check cancellation after attempt
@@ -699,99 +2428,465 @@ def process_document(submission_id, file_path, options):
         if row and row['status'] == 'cancelled':
             send_telegram_message(user_id, "❌ Your submission was cancelled during processing.")
             # ensure cleanup
-            try:
-                os.remove(file_path)
-            except:
-                pass
+            scratch.release(submission_id, file_path)
             cur.execute("INSERT INTO turnitin_logs (submission_id, success, source, error_message, created_at) VALUES (?, ?, ?, ?, ?)",
                         (submission_id, False, source, "Cancelled by user", now_ts()))
             db.commit()
+            capacity.release(submission_id)
             return
 
         if not turnitin_result:
-            send_telegram_message(user_id, "❌ Analysis failed. Please try again.")
-            cur.execute("UPDATE submissions SET status=? WHERE id=?", ("failed", submission_id))
+            owned = cur.execute("UPDATE submissions SET status=?, lease_expires_at=NULL WHERE id=? AND status='processing' AND attempts=?",
+                                ("failed", submission_id, attempts)).rowcount
             db.commit()
+            if not owned:
+                release_lost_submission(submission_id, file_path)
+                return
+            send_telegram_message(user_id, "❌ Analysis failed. Please try again.")
+            scratch.release(submission_id, file_path)
+            capacity.release(submission_id)
             return
 
+        report_path = persist_reports(submission_id, turnitin_result) if PERSIST_REPORTS else None
+
         # Update database
-        cur.execute(
-            "UPDATE submissions SET status=?, report_path=?, similarity_score=?, ai_score=?, source=? WHERE id=?",
-            ("done", turnitin_result.get("similarity_report_path"), turnitin_result["similarity_score"], 
-             turnitin_result["ai_score"], source, submission_id)
-        )
-        
-        # Log the attempt
-        cur.execute(
-            "INSERT INTO turnitin_logs (submission_id, success, source, error_message, created_at) VALUES (?, ?, ?, ?, ?)",
-            (submission_id, True, source, "Success", now_ts())
-        )
-        db.commit()
+        with db_transaction() as conn:
+            owned = conn.execute(
+                "UPDATE submissions SET status=?, report_path=?, similarity_score=?, ai_score=?, source=?, lease_expires_at=NULL "
+                "WHERE id=? AND status='processing' AND attempts=?",
+                ("done", report_path, turnitin_result["similarity_score"], 
+                 turnitin_result["ai_score"], source, submission_id, attempts)
+            ).rowcount
+            
+            if owned:
+                # Log the attempt
+                conn.execute(
+                    "INSERT INTO turnitin_logs (submission_id, success, source, error_message, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (submission_id, True, source, "Success", now_ts())
+                )
+                capacity.consume(submission_id, conn=conn)
+        if not owned:
+            release_lost_submission(submission_id, file_path)
+            return
 
-        source_text = "Advanced Analysis"
-        caption = (
-            f"✅ {source_text} Complete!\n\n"
-            f"📊 Similarity Score: {turnitin_result['similarity_score']}%\n"
-            f"🤖 AI Detection Score: {turnitin_result['ai_score']}%\n\n"
-            f"Options used:\n"
-            f"• Exclude bibliography: {'Yes' if options.get('exclude_bibliography') else 'No'}\n"
-            f"• Exclude quoted text: {'Yes' if options.get('exclude_quoted_text') else 'No'}\n"
-            f"• Exclude cited text: {'Yes' if options.get('exclude_cited_text') else 'No'}\n"
-            f"• Exclude small matches: {'Yes' if options.get('exclude_small_matches') else 'No'}"
-        )
-        
-        if turnitin_result.get("similarity_report_path"):
-            send_telegram_document(
-                user_id, 
-                turnitin_result["similarity_report_path"], 
-                caption=caption,
-                filename=f"report_{filename}.txt"
-            )
-        
-        # Only send AI report to paid users (or to a free user if it was their free check)
-        u = user_get(user_id)
-        if turnitin_result.get("ai_report_path") and (u['plan'] != 'free' or is_free_check):
-            send_telegram_document(
-                user_id,
-                turnitin_result["ai_report_path"],
-                caption="🤖 AI Writing Analysis",
-                filename=f"ai_analysis_{filename}.txt"
-            )
-        
-        if is_free_check:
-            upgrade_keyboard = create_inline_keyboard([
-                [("💎 Upgrade Plan", "upgrade_after_free")],
-                [("💰 Earn ₵10 per Referral", "show_referral")]
-            ])
-            send_telegram_message(
-                user_id,
-                "🎁 Your first check was free!\nUpgrade for more features or earn ₵10 for each friend you refer!",
-                reply_markup=upgrade_keyboard
-            )
+        report_cache.put(ingest["file_hash"], options, ingest["file_size"], turnitin_result.get("analysis"))
+        if turnitin_result.get("index_fingerprints") is not None:
+            try:
+                similarity_index.add(ingest["file_hash"], submission_id, turnitin_result["index_fingerprints"])
+            except Exception as e:
+                print(f"⚠️ Could not add submission {submission_id} to the similarity index: {e}")
+        send_analysis_result(user_id, filename, options, turnitin_result, is_free_check)
         
         # Clean up uploaded file
-        try:
-            os.remove(file_path)
-            print("🧹 Cleaned up uploaded file")
-        except Exception:
-            pass
+        scratch.release(submission_id, file_path)
+        print("🧹 Cleaned up uploaded file")
             
     except Exception as e:
         print(f"❌ Processing error: {e}")
+        try:
+            # mark as failed, unless the row was cancelled or re-leased meanwhile
+            cur = db.cursor()
+            owned = cur.execute("UPDATE submissions SET status=?, lease_expires_at=NULL WHERE id=? AND status='processing' AND attempts=COALESCE(?, attempts)",
+                                ("failed", submission_id, attempts)).rowcount
+            db.commit()
+            if not owned:
+                release_lost_submission(submission_id, file_path)
+                return
+            capacity.release(submission_id)
+        except:
+            pass
         if user_id:
             send_telegram_message(user_id, "❌ Processing error. Please try again.")
+        scratch.release(submission_id, file_path)
+
+def release_lost_submission(submission_id, file_path):
+    """After a guarded write matched nothing: clean up a cancelled row; a re-leased one belongs to its new worker"""
+    r = db.execute("SELECT status FROM submissions WHERE id=?", (submission_id,)).fetchone()
+    if r and r["status"] == "cancelled":
+        scratch.release(submission_id, file_path)
+        print(f"🚫 Submission {submission_id} was cancelled while processing; result dropped")
+    else:
+        print(f"♻️ Submission {submission_id} was re-leased to another worker; result dropped")
+
+# Processing Engine
+def _reset_db_after_fork():
+    """Process pool initializer: drop the SQLite connection inherited from the forking thread.
+
+    SQLite connections must not be used across fork(), so the child opens
+    its own on first use. The inherited one is kept referenced rather than
+    closed, so the child never touches the parent's handle at all.
+    """
+    inherited = getattr(_db_local, "conn", None)
+    if inherited is not None:
+        _inherited_connections.append(inherited)
+    _db_local.__dict__.clear()
+
+_inherited_connections = []
+
+class ProcessingEngine:
+    """Fixed pool of worker threads for document processing.
+
+    The durable submission queue (claim_next_submission) decides what runs
+    next, by plan priority; the dispatcher only hands a job over when
+    has_capacity() says a worker is free, so the hand-off here never holds
+    more than one job per worker. With backend="process" the CPU-heavy
+    analysis step is additionally run in a process pool via run_cpu(). Its
+    processes are forked once at start(), which the app calls before it
+    starts any other thread, and reset their inherited thread-local DB
+    state before running anything.
+    """
+
+    def __init__(self, workers=4, backend="thread"):
+        self.workers = max(1, workers)
+        self.backend = backend
+        self._queue = queue.Queue(maxsize=self.workers)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._cpu_pool = None
+        self.busy = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        if self.backend == "process" and self._cpu_pool is None:
+            if threading.active_count() > 1:
+                print("⚠️ Forking the processing pool while other threads are running")
+            self._cpu_pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_reset_db_after_fork
+            )
+            # With fork, the first submit starts every worker process: do it now, from this thread
+            self._cpu_pool.submit(int).result()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"processing-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f"⚙️ Processing engine started: {self.workers} workers ({self.backend})")
+
+    def submit(self, fn, *args, timeout=None):
+        """Hand a job to the workers. Returns False if none frees up within `timeout` seconds."""
         try:
-            # mark as failed
-            cur = db.cursor()
-            cur.execute("UPDATE submissions SET status=? WHERE id=?", ("failed", submission_id))
+            self._queue.put((fn, args), block=timeout is not None, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def run_cpu(self, fn, *args):
+        """Run a CPU-bound function in the process pool (or inline for the thread backend)"""
+        if self._cpu_pool is None:
+            return fn(*args)
+        return self._cpu_pool.submit(fn, *args).result()
+
+    def _worker(self):
+        while True:
+            fn, args = self._queue.get()
+            with self._lock:
+                self.busy += 1
+            try:
+                fn(*args)
+                with self._lock:
+                    self.completed += 1
+            except Exception as e:
+                print(f"❌ Processing worker error: {e}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "workers": self.workers,
+                "busy_workers": self.busy,
+                "utilisation": round(self.busy / self.workers, 2),
+                "handoff_depth": self._queue.qsize(),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected
+            }
+
+    def has_capacity(self):
+        """True when a worker is free to take another job right away"""
+        with self._lock:
+            return self._queue.qsize() + self.busy < self.workers
+
+engine = ProcessingEngine(PROCESSING_WORKERS, PROCESSING_BACKEND)
+if BACKGROUND_JOBS:
+    # The engine forks its process pool first, while this is still the only thread
+    engine.start()
+    if not ASYNC_OUTBOUND:
+        outbound.start()
+        atexit.register(outbound.flush)
+
+# Durable Submission Queue
+def claim_next_submission():
+    """Atomically lease the next queued submission.
+
+    Jobs are taken in priority/arrival order, but only a user's oldest queued
+    submission is eligible and only while that user has nothing processing,
+    so each user's files run one at a time in FIFO order.
+    """
+    with db_transaction() as conn:
+        row = conn.execute("""
+        UPDATE submissions
+        SET status='processing', lease_expires_at=?, attempts=attempts+1
+        WHERE id = (
+            SELECT s.id FROM submissions s
+            WHERE s.status='queued'
+              AND s.id = (SELECT MIN(q.id) FROM submissions q WHERE q.user_id=s.user_id AND q.status='queued')
+              AND NOT EXISTS (SELECT 1 FROM submissions p WHERE p.user_id=s.user_id AND p.status='processing')
+            ORDER BY s.priority, s.created_at, s.id
+            LIMIT 1
+        )
+        RETURNING id, user_id, file_path, options, priority
+        """, (now_ts() + QUEUE_LEASE_SECONDS,)).fetchone()
+    return dict(row) if row else None
+
+def release_submission(submission_id):
+    """Put a claimed submission back on the queue without counting the attempt"""
+    db.execute(
+        "UPDATE submissions SET status='queued', lease_expires_at=NULL, attempts=attempts-1 WHERE id=? AND status='processing'",
+        (submission_id,)
+    )
+    db.commit()
+
+def reclaim_expired_leases():
+    """Requeue submissions whose worker died mid-processing; fail them after too many attempts"""
+    now = now_ts()
+    with db_transaction() as conn:
+        # Rows left 'processing' by the old thread-per-submission code never got a lease
+        conn.execute("UPDATE submissions SET lease_expires_at=? WHERE status='processing' AND lease_expires_at IS NULL", (now,))
+        failed = conn.execute(
+            "UPDATE submissions SET status='failed', lease_expires_at=NULL WHERE status='processing' AND lease_expires_at < ? AND attempts >= ? RETURNING id, user_id",
+            (now, QUEUE_MAX_ATTEMPTS)
+        ).fetchall()
+        for r in failed:
+            capacity.release(r['id'])
+        requeued = conn.execute(
+            "UPDATE submissions SET status='queued', lease_expires_at=NULL WHERE status='processing' AND lease_expires_at < ?",
+            (now,)
+        ).rowcount
+        failed_items = conn.execute(
+            "UPDATE batch_items SET status='failed', error='processing failed after several attempts', lease_expires_at=NULL, finished_at=? "
+            "WHERE status='processing' AND lease_expires_at < ? AND attempts >= ? RETURNING id, batch_id",
+            (now, now, QUEUE_MAX_ATTEMPTS)
+        ).fetchall()
+        for r in failed_items:
+            conn.execute(
+                "UPDATE batch_items SET status='failed', error='processing failed after several attempts', finished_at=? "
+                "WHERE duplicate_of=? AND status='duplicate'", (now, r['id'])
+            )
+        requeued += conn.execute(
+            "UPDATE batch_items SET status='queued', lease_expires_at=NULL WHERE status='processing' AND lease_expires_at < ?",
+            (now,)
+        ).rowcount
+    for r in failed:
+        send_telegram_message(r['user_id'], "❌ Processing failed after several attempts. Please upload your document again.")
+    for batch_id in {r['batch_id'] for r in failed_items}:
+        finish_batch_if_complete(batch_id)
+    if requeued or failed or failed_items:
+        print(f"♻️ Lease sweep: {requeued} requeued, {len(failed) + len(failed_items)} failed")
+
+# Batch Queue
+def batch_scratch_key(batch_id):
+    return f"batch-{batch_id}"
+
+def claim_next_batch_item():
+    """Lease the next queued batch item (oldest batch first)"""
+    with db_transaction() as conn:
+        row = conn.execute("""
+        UPDATE batch_items
+        SET status='processing', lease_expires_at=?, attempts=attempts+1
+        WHERE id = (SELECT id FROM batch_items WHERE status='queued' ORDER BY batch_id, id LIMIT 1)
+        RETURNING id, batch_id, filename, file_path, file_hash, file_size, file_type
+        """, (now_ts() + QUEUE_LEASE_SECONDS,)).fetchone()
+        if not row:
+            return None
+        item = dict(row)
+        options = conn.execute("SELECT options FROM batches WHERE id=?", (item["batch_id"],)).fetchone()["options"]
+    item["options"] = json.loads(options) if options else {}
+    return item
+
+def release_batch_item(item_id):
+    db.execute(
+        "UPDATE batch_items SET status='queued', lease_expires_at=NULL, attempts=attempts-1 WHERE id=? AND status='processing'",
+        (item_id,)
+    )
+    db.commit()
+
+def batch_fingerprints_path(batch_id, item_id):
+    return scratch.path_for(batch_scratch_key(batch_id), f"{item_id}.fps.npy")
+
+def process_batch_item(item):
+    """Analyse one batch document; identical copies in the batch share the result"""
+    item_id, batch_id = item["id"], item["batch_id"]
+    try:
+        ingest = {"file_hash": item["file_hash"], "file_size": item["file_size"], "file_type": item["file_type"]}
+        result = engine.run_cpu(submit_to_turnitin_simulation, item["file_path"], item["filename"], item["options"], ingest)
+        if not result:
+            raise RuntimeError("analysis failed")
+
+        # Fingerprints wait on scratch for the in-batch cross-match
+        if result.get("index_fingerprints") is not None:
+            np.save(batch_fingerprints_path(batch_id, item_id), result["index_fingerprints"])
+        analysis = json.dumps(result["analysis"])
+        with db_transaction() as conn:
+            conn.execute(
+                "UPDATE batch_items SET status='done', similarity_score=?, ai_score=?, analysis=?, lease_expires_at=NULL, finished_at=? "
+                "WHERE id=? OR (duplicate_of=? AND status='duplicate')",
+                (result["similarity_score"], result["ai_score"], analysis, now_ts(), item_id, item_id)
+            )
+        report_cache.put(item["file_hash"], item["options"], item["file_size"], result["analysis"])
+    except Exception as e:
+        print(f"❌ Batch item {item_id} failed: {e}")
+        try:
+            db.execute(
+                "UPDATE batch_items SET status='failed', error=?, lease_expires_at=NULL, finished_at=? "
+                "WHERE id=? OR (duplicate_of=? AND status='duplicate')",
+                (str(e)[:200], now_ts(), item_id, item_id)
+            )
             db.commit()
         except:
             pass
+    finally:
+        try:
+            os.remove(item["file_path"])
+        except OSError:
+            pass
+        finish_batch_if_complete(batch_id)
+
+def finish_batch_if_complete(batch_id):
+    """Once every item is final: cross-match the batch, index it and mark it done (exactly once)"""
+    with db_transaction() as conn:
+        won = conn.execute("""
+        UPDATE batches SET status='matching'
+        WHERE id=? AND status='processing'
+          AND NOT EXISTS (SELECT 1 FROM batch_items WHERE batch_id=? AND status IN ('queued','processing','duplicate'))
+        RETURNING id
+        """, (batch_id, batch_id)).fetchone()
+    if not won:
+        return
+    try:
+        rows = db.execute(
+            "SELECT id, file_hash FROM batch_items WHERE batch_id=? AND status='done' AND duplicate_of IS NULL", (batch_id,)
+        ).fetchall()
+        documents = {}
+        for r in rows:
+            path = batch_fingerprints_path(batch_id, r["id"])
+            if os.path.exists(path):
+                documents[r["id"]] = np.load(path)
+        matches = similarity.cross_match(documents)
+
+        with db_transaction() as conn:
+            for item_id, peers in matches.items():
+                payload = json.dumps([{"item": other, "percent": percent} for other, percent in peers])
+                conn.execute("UPDATE batch_items SET batch_matches=? WHERE id=? OR duplicate_of=?", (payload, item_id, item_id))
+
+        # Index the batch only now, so its documents are scored against earlier work, not each other
+        for r in rows:
+            if r["id"] in documents:
+                try:
+                    similarity_index.add(r["file_hash"], None, documents[r["id"]])
+                except Exception as e:
+                    print(f"⚠️ Could not add batch item {r['id']} to the similarity index: {e}")
+        status = "done"
+        print(f"📦 Batch {batch_id} complete: {len(documents)} documents cross-matched")
+    except Exception as e:
+        print(f"❌ Batch {batch_id} cross-match error: {e}")
+        status = "failed"
+    db.execute("UPDATE batches SET status=?, finished_at=? WHERE id=?", (status, now_ts(), batch_id))
+    db.commit()
+    scratch.release(batch_scratch_key(batch_id))
+
+class SubmissionDispatcher:
+    """Background loop that feeds queued submissions from the DB into the processing engine"""
+
+    def __init__(self, poll_interval=2.0, sweep_interval=60):
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self._wake = threading.Event()
+        self._last_sweep = 0
+        self.dispatched = 0
+
+    def start(self):
+        t = threading.Thread(target=self._run, name="submission-dispatcher", daemon=True)
+        t.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                if time.time() - self._last_sweep >= self.sweep_interval:
+                    reclaim_expired_leases()
+                    self._last_sweep = time.time()
+                while engine.has_capacity():
+                    job = claim_next_submission()
+                    if job:
+                        self._dispatch(job)
+                        continue
+                    # Batch documents only fill capacity no chat user needs
+                    item = claim_next_batch_item()
+                    if not item:
+                        break
+                    self._dispatch_batch_item(item)
+            except Exception as e:
+                print(f"❌ Dispatcher error: {e}")
+
+    def _dispatch(self, job):
+        if not job['file_path'] or not os.path.exists(job['file_path']):
+            with db_transaction() as conn:
+                conn.execute("UPDATE submissions SET status='failed', lease_expires_at=NULL WHERE id=?", (job['id'],))
+                capacity.release(job['id'])
+            send_telegram_message(job['user_id'], "❌ Your queued file is no longer available. Please upload it again.")
+            return
+        options = json.loads(job['options']) if job['options'] else {}
+        if engine.submit(self._process, job['id'], job['file_path'], options, timeout=1):
+            self.dispatched += 1
+        else:
+            release_submission(job['id'])
+
+    def _process(self, submission_id, file_path, options):
+        try:
+            process_document(submission_id, file_path, options)
+        finally:
+            # A worker just freed up - pull the next job right away
+            self.wake()
+
+    def _dispatch_batch_item(self, item):
+        if engine.submit(self._process_batch_item, item, timeout=1):
+            self.dispatched += 1
+        else:
+            release_batch_item(item['id'])
+
+    def _process_batch_item(self, item):
+        try:
+            process_batch_item(item)
+        finally:
+            self.wake()
+
+    def stats(self):
+        pending = db.execute("SELECT COUNT(*) FROM submissions WHERE status='queued'").fetchone()[0]
+        batch_pending = db.execute("SELECT COUNT(*) FROM batch_items WHERE status='queued'").fetchone()[0]
+        return {"pending": pending, "batch_pending": batch_pending, "dispatched": self.dispatched}
 
-def start_processing(submission_id, file_path, options):
-    """Start processing in background thread"""
-    t = threading.Thread(target=process_document, args=(submission_id, file_path, options), daemon=True)
-    t.start()
+dispatcher = SubmissionDispatcher()
+if BACKGROUND_JOBS:
+    dispatcher.start()
 
 # Report Options
 def ask_for_report_options(user_id):
@@ -823,37 +2918,42 @@ def parse_options_response(text):
 # Scheduler
 scheduler = BackgroundScheduler()
 
-def reset_daily_usage():
-    db.execute("UPDATE users SET used_today=0")
-    db.execute("UPDATE meta SET v='0' WHERE k='global_alloc'")
-    db.commit()
-    print("🔄 Daily usage reset")
+def check_and_expire_subscriptions(batch_size=500):
+    """Downgrade subscriptions whose expiry has passed and queue the renewal notices.
 
-def check_and_expire_subscriptions():
-    """Daily job: find expired subscriptions and notify users"""
-    cur = db.cursor()
-    rows = cur.execute("SELECT user_id, plan, expiry_date FROM users WHERE subscription_active=1 AND expiry_date IS NOT NULL").fetchall()
-    now = datetime.datetime.now()
-    for r in rows:
-        try:
-            expiry_str = r['expiry_date']
-            if not expiry_str:
-                continue
-            expiry_dt = datetime.datetime.strptime(expiry_str, '%Y-%m-%d %H:%M:%S')
-            if expiry_dt < now:
-                user_id = r['user_id']
-                # Downgrade user to free and mark subscription inactive
-                cur.execute("UPDATE users SET plan='free', daily_limit=1, subscription_active=0, expiry_date=NULL WHERE user_id=?", (user_id,))
-                db.commit()
-                renew_keyboard = create_inline_keyboard([[("🔁 Renew Plan", "upgrade_after_free")]])
-                send_telegram_message(user_id, f"⏰ Your 28-day subscription has expired.\nRenew anytime to continue using TurnitQ.", reply_markup=renew_keyboard)
-                print(f"🔔 Notified user {user_id} of expiry")
-        except Exception as e:
-            print(f"❌ Expiry check error for row {r}: {e}")
+    Runs every minute off the partial expiry_ts index, so it only ever
+    touches the rows that just expired, in bounded set-based batches.
+    """
+    now = now_ts()
+    expired = 0
+    while True:
+        with db_transaction() as conn:
+            rows = conn.execute("""
+            UPDATE users SET plan='free', daily_limit=1, subscription_active=0, expiry_date=NULL, expiry_ts=NULL
+            WHERE user_id IN (
+                SELECT user_id FROM users WHERE subscription_active=1 AND expiry_ts <= ? LIMIT ?
+            )
+            RETURNING user_id
+            """, (now, batch_size)).fetchall()
+            for r in rows:
+                after_commit(lambda user_id=r['user_id']: user_cache.invalidate(user_id))
 
-scheduler.add_job(reset_daily_usage, 'cron', hour=0)
-scheduler.add_job(check_and_expire_subscriptions, 'cron', hour=1)
-scheduler.start()
+        # The outbound queue paces these through the Telegram rate limits
+        renew_keyboard = create_inline_keyboard([[("🔁 Renew Plan", "upgrade_after_free")]])
+        for r in rows:
+            send_telegram_message(r['user_id'], f"⏰ Your 28-day subscription has expired.\nRenew anytime to continue using TurnitQ.", reply_markup=renew_keyboard)
+        expired += len(rows)
+        if len(rows) < batch_size:
+            break
+    if expired:
+        print(f"🔔 Expired {expired} subscriptions and queued renewal notices")
+
+scheduler.add_job(capacity.sweep, 'interval', minutes=5)
+scheduler.add_job(check_and_expire_subscriptions, 'interval', minutes=1, max_instances=1, coalesce=True)
+scheduler.add_job(idempotency.prune, 'cron', hour=3)
+scheduler.add_job(scratch.sweep, 'interval', minutes=15)
+if BACKGROUND_JOBS:
+    scheduler.start()
 
 # Small helpers for queueing & cancellation
 def user_has_active_processing(user_id) -> bool:
@@ -879,14 +2979,56 @@ def cancel_user_submission(user_id):
         send_telegram_message(user_id, "⚠️ You have no active submissions to cancel.")
         return False
     sub_id = r['id']
-    cur.execute("UPDATE submissions SET status='cancelled' WHERE id=?", (sub_id,))
-    db.commit()
-    cur.execute("INSERT INTO turnitin_logs (submission_id, success, source, error_message, created_at) VALUES (?, ?, ?, ?, ?)",
-                (sub_id, False, "USER_CANCEL", "Cancelled by user", now_ts()))
-    db.commit()
+    with db_transaction() as conn:
+        conn.execute("UPDATE submissions SET status='cancelled' WHERE id=?", (sub_id,))
+        conn.execute("INSERT INTO turnitin_logs (submission_id, success, source, error_message, created_at) VALUES (?, ?, ?, ?, ?)",
+                     (sub_id, False, "USER_CANCEL", "Cancelled by user", now_ts()))
+        capacity.release(sub_id)
+    if r['status'] == 'queued':
+        # A processing worker still reads its file and cleans up itself
+        scratch.release(sub_id, r['file_path'])
     send_telegram_message(user_id, "❌ Your submission has been cancelled.")
     return True
 
+# Referral ledger
+# Double-entry, append-only: every movement of referral money is one txn of
+# entries (in pesewas) that sum to zero. referral_earnings.amount is a cache
+# of the user's referral_balance account, refreshed whenever it is posted to.
+LEDGER_BALANCE = "referral_balance"  # what we owe each user
+LEDGER_REWARDS = "referral_rewards"  # rewards granted (the contra account)
+LEDGER_PAYOUTS = "payouts_pending"  # withdrawn but not yet accepted by Paystack
+LEDGER_PAID = "paid_out"  # handed to Paystack
+
+def to_pesewas(cedis):
+    return int(round(cedis * 100))
+
+def post_ledger(conn, txn, entries):
+    """Append one balanced txn of (account, user_id, cedis) entries; False if it was already posted"""
+    entries = [(account, user_id, to_pesewas(amount)) for account, user_id, amount in entries]
+    if sum(amount for _, _, amount in entries) != 0:
+        raise ValueError(f"unbalanced ledger txn {txn}: {entries}")
+    if conn.execute("SELECT 1 FROM ledger_entries WHERE txn=? LIMIT 1", (txn,)).fetchone():
+        return False
+    now = now_ts()
+    conn.executemany(
+        "INSERT INTO ledger_entries(txn, account, user_id, amount, created_at) VALUES(?, ?, ?, ?, ?)",
+        [(txn, account, user_id, amount, now) for account, user_id, amount in entries]
+    )
+    for account, user_id, _ in entries:
+        if account == LEDGER_BALANCE:
+            conn.execute(
+                "UPDATE referral_earnings SET amount=(SELECT COALESCE(SUM(amount), 0) FROM ledger_entries WHERE account=? AND user_id=?) / 100.0 WHERE user_id=?",
+                (LEDGER_BALANCE, user_id, user_id)
+            )
+    return True
+
+def ledger_balance(user_id, conn=None):
+    """A user's referral balance in cedis, summed from the ledger"""
+    r = (conn or db).execute(
+        "SELECT COALESCE(SUM(amount), 0) FROM ledger_entries WHERE account=? AND user_id=?", (LEDGER_BALANCE, user_id)
+    ).fetchone()
+    return r[0] / 100
+
 # Referral System Functions
 def generate_referral_code(user_id):
     """Generate a unique referral code for user"""
@@ -961,19 +3103,23 @@ def process_referral_payment(referred_user_id):
     if referral:
         referrer_id = referral['referrer_id']
         
-        # Credit reward to referrer
-        cur.execute(
-            "UPDATE referral_earnings SET amount=amount+?, total_earned=total_earned+? WHERE user_id=?",
-            (REFERRAL_REWARD, REFERRAL_REWARD, referrer_id)
-        )
-        
-        # Mark referral as used and credited
-        cur.execute(
-            "UPDATE referrals SET reward_credited=1, used_at=? WHERE id=?",
-            (now_ts(), referral['id'])
-        )
-        
-        db.commit()
+        with db_transaction() as conn:
+            # Mark referral as used and credited - only the first caller gets to credit it
+            if not conn.execute(
+                "UPDATE referrals SET reward_credited=1, used_at=? WHERE id=? AND reward_credited=0",
+                (now_ts(), referral['id'])
+            ).rowcount:
+                return False
+
+            # Credit reward to referrer
+            post_ledger(conn, f"referral:{referral['id']}", [
+                (LEDGER_REWARDS, None, -REFERRAL_REWARD),
+                (LEDGER_BALANCE, referrer_id, REFERRAL_REWARD),
+            ])
+            conn.execute(
+                "UPDATE referral_earnings SET total_earned=total_earned+? WHERE user_id=?",
+                (REFERRAL_REWARD, referrer_id)
+            )
         
         # Notify referrer
         send_telegram_message(
@@ -1009,60 +3155,124 @@ def get_referral_info(user_id):
     }
 
 def handle_withdrawal_request(user_id, mobile_money_number):
-    """Process withdrawal request and automatically send payment"""
-    referral_info = get_referral_info(user_id)
-    balance = referral_info['balance']
-    
-    if balance < MIN_WITHDRAWAL:
-        return False, f"Withdrawal minimum is ₵{MIN_WITHDRAWAL}. Your balance: ₵{balance}"
-    
-    cur = db.cursor()
+    """Record a withdrawal of the user's whole balance; run_payouts sends it"""
+    get_or_create_referral_earnings(user_id)
+
+    if not mobile_money_provider(mobile_money_number):
+        return False, "⚠️ That doesn't look like an MTN, Telecel or AirtelTigo mobile money number. Please check it and try /withdraw again."
     
-    # Create withdrawal record
-    cur.execute(
-        "INSERT INTO withdrawals (user_id, amount, mobile_money_number, created_at) VALUES (?, ?, ?, ?)",
-        (user_id, balance, mobile_money_number, now_ts())
-    )
+    with db_transaction() as conn:
+        # The balance is read under the write lock, so two requests can't both withdraw it
+        balance = ledger_balance(user_id, conn)
+        if balance < MIN_WITHDRAWAL:
+            return False, f"Withdrawal minimum is ₵{MIN_WITHDRAWAL}. Your balance: ₵{balance}"
+
+        # Create withdrawal record
+        withdrawal_id = conn.execute(
+            "INSERT INTO withdrawals (user_id, amount, mobile_money_number, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, balance, mobile_money_number, now_ts())
+        ).lastrowid
+        
+        # Move the balance to the payout queue
+        post_ledger(conn, f"withdrawal:{withdrawal_id}", [
+            (LEDGER_BALANCE, user_id, -balance),
+            (LEDGER_PAYOUTS, None, balance),
+        ])
+        conn.execute(
+            "UPDATE referral_earnings SET total_withdrawn=total_withdrawn+? WHERE user_id=?",
+            (balance, user_id)
+        )
     
-    # Update referral earnings
-    cur.execute(
-        "UPDATE referral_earnings SET amount=0, total_withdrawn=total_withdrawn+? WHERE user_id=?",
-        (balance, user_id)
+    return True, (
+        f"✅ Withdrawal request for ₵{balance} submitted! "
+        f"It will be sent to {mobile_money_number} within {PAYOUT_INTERVAL_MINUTES} minutes - we'll message you when it's on its way."
     )
-    
-    db.commit()
-    
-    # AUTOMATICALLY PROCESS PAYMENT
-    success, message = process_withdrawal_payment(user_id, balance, mobile_money_number)
-    
-    if success:
-        return True, f"✅ Withdrawal request for ₵{balance} submitted and processed successfully! {message}"
-    else:
-        # If automatic payment fails, the withdrawal status will be 'failed'
-        return False, f"❌ Withdrawal request submitted but payment failed. {message}"
-def check_and_retry_failed_withdrawals():
-    """Check for failed withdrawals and retry them (can be called manually or scheduled)"""
-    cur = db.cursor()
-    failed_withdrawals = cur.execute(
-        "SELECT * FROM withdrawals WHERE status='failed' AND created_at > ?",
-        (now_ts() - 24 * 3600,)  # Only retry withdrawals from last 24 hours
-    ).fetchall()
-    
-    for withdrawal in failed_withdrawals:
-        user_id = withdrawal['user_id']
-        amount = withdrawal['amount']
-        mobile_money_number = withdrawal['mobile_money_number']
-        
-        print(f"🔄 Retrying failed withdrawal for user {user_id}, amount ₵{amount}")
-        success, message = process_withdrawal_payment(user_id, amount, mobile_money_number)
-        
-        if success:
-            print(f"✅ Retry successful for user {user_id}")
-        else:
-            print(f"❌ Retry failed for user {user_id}: {message}")
-            
-# Add to your scheduler section if you want automatic retries
-# scheduler.add_job(check_and_retry_failed_withdrawals, 'cron', hour=12)  # Run daily at noon
+
+def run_payouts(limit=PAYSTACK_BULK_SIZE * 5):
+    """Send waiting withdrawals to Paystack in bulk (scheduled, never on a request thread).
+
+    Withdrawals are claimed as 'sending' first, so an overlapping run skips
+    them. Each attempt goes out under a fresh reference, recorded on the
+    row before the request; a withdrawal sent before is first verified
+    under its last reference and only re-sent if Paystack never got it or
+    reports it failed. Accepted payouts move from payouts_pending to paid_out;
+    after PAYOUT_MAX_ATTEMPTS failures the amount returns to the user's
+    balance.
+    """
+    now = now_ts()
+    with db_transaction() as conn:
+        batch = conn.execute("""
+        UPDATE withdrawals SET status='sending', attempts=attempts+1, sent_at=?
+        WHERE id IN (
+            SELECT id FROM withdrawals
+            WHERE status='pending'
+               OR (status='failed' AND COALESCE(sent_at, 0) < ?)
+               OR (status='sending' AND sent_at < ?)
+            ORDER BY id LIMIT ?
+        )
+        RETURNING *
+        """, (now, now - PAYOUT_RETRY_SECONDS, now - 600, limit)).fetchall()
+    if not batch:
+        return 0
+
+    accepted, errors, transfers, references, unverified = {}, {}, [], {}, set()
+    for w in batch:
+        previous_reference = w['paystack_reference']
+        references[w['id']] = previous_reference
+        if previous_reference:
+            try:
+                previous = paystack.verify_transfer(previous_reference)
+            except Exception as e:
+                errors[w['id']] = str(e)  # try again next run rather than risk paying twice
+                unverified.add(w['id'])
+                continue
+            if previous and previous.get('status') not in ('failed', 'reversed'):
+                accepted[previous_reference] = previous
+                continue
+        recipient_code = withdrawal_recipient(w['user_id'], w['mobile_money_number'])
+        if not recipient_code:
+            errors[w['id']] = "could not register the mobile money number"
+            continue
+        reference = references[w['id']] = withdrawal_reference(w['id'], w['attempts'])
+        transfers.append((w['id'], w['amount'], recipient_code, reference, f"TurnitQ Referral Withdrawal - User {w['user_id']}"))
+    if transfers:
+        # Record what is about to be sent, so a crash mid-request is verified next run
+        with db_transaction() as conn:
+            conn.executemany("UPDATE withdrawals SET paystack_reference=? WHERE id=?",
+                             [(reference, withdrawal_id) for withdrawal_id, _, _, reference, _ in transfers])
+        accepted.update(paystack.bulk_transfer([t[1:] for t in transfers]))
+
+    sent, returned = [], []
+    with db_transaction() as conn:
+        for w in batch:
+            reference = references[w['id']]
+            item = accepted.get(reference)
+            if item:
+                conn.execute(
+                    "UPDATE withdrawals SET status='processed', processed_at=?, paystack_reference=?, transfer_code=?, last_error=NULL WHERE id=?",
+                    (now_ts(), reference, item.get('transfer_code'), w['id'])
+                )
+                post_ledger(conn, f"payout:{w['id']}", [(LEDGER_PAYOUTS, None, -w['amount']), (LEDGER_PAID, None, w['amount'])])
+                sent.append((w, reference))
+            elif w['attempts'] >= PAYOUT_MAX_ATTEMPTS and w['id'] not in unverified:
+                conn.execute("UPDATE withdrawals SET status='returned', last_error=? WHERE id=?",
+                             (errors.get(w['id'], "transfer not accepted"), w['id']))
+                post_ledger(conn, f"return:{w['id']}", [(LEDGER_PAYOUTS, None, -w['amount']), (LEDGER_BALANCE, w['user_id'], w['amount'])])
+                conn.execute("UPDATE referral_earnings SET total_withdrawn=total_withdrawn-? WHERE user_id=?", (w['amount'], w['user_id']))
+                returned.append(w)
+            else:
+                conn.execute("UPDATE withdrawals SET status='failed', last_error=? WHERE id=?",
+                             (errors.get(w['id'], "transfer not accepted"), w['id']))
+
+    for w, reference in sent:
+        send_telegram_message(w['user_id'], f"✅ Your withdrawal of ₵{w['amount']} has been sent to {w['mobile_money_number']}. Reference: {reference}")
+    for w in returned:
+        send_telegram_message(w['user_id'], f"❌ We couldn't send your withdrawal of ₵{w['amount']} to {w['mobile_money_number']}. The amount is back in your referral balance - please check the number and try /withdraw again.")
+    print(f"💸 Payout run: {len(sent)} sent, {len(returned)} returned, {len(batch) - len(sent) - len(returned)} to retry")
+    return len(sent)
+
+scheduler.add_job(run_payouts, 'interval', minutes=PAYOUT_INTERVAL_MINUTES, max_instances=1, coalesce=True)
+
 # Flask Routes
 @app.route("/")
 def home():
@@ -1079,15 +3289,352 @@ def debug():
     real_count = cur.execute("SELECT COUNT(*) FROM turnitin_logs WHERE source='REAL_TURNITIN'").fetchone()[0]
     sim_count = cur.execute("SELECT COUNT(*) FROM turnitin_logs WHERE source='ADVANCED_ANALYSIS'").fetchone()[0]
     payment_count = cur.execute("SELECT COUNT(*) FROM payments WHERE status='success'").fetchone()[0]
+    engine_stats = engine.stats()
+    queue_stats = dispatcher.stats()
+    duplicate_count = idempotency.duplicates
+    cache_stats = report_cache.stats()
+    scratch_stats = scratch.stats()
     
     return f"""
     <h1>Debug Information</h1>
     <p><strong>Real Turnitin Attempts:</strong> {real_count}</p>
     <p><strong>Advanced Analysis:</strong> {sim_count}</p>
     <p><strong>Successful Payments:</strong> {payment_count}</p>
+    <p><strong>Processing Queue Depth:</strong> {queue_stats['pending']}/{PROCESSING_QUEUE_SIZE}</p>
+    <p><strong>Worker Utilisation:</strong> {engine_stats['busy_workers']}/{engine_stats['workers']} busy</p>
+    <p><strong>Outbound Backlog:</strong> {outbound.backlog()}</p>
+    <p><strong>Duplicate Webhooks Skipped:</strong> {duplicate_count}</p>
+    <p><strong>Scratch Storage:</strong> {scratch_stats['used_bytes'] // 1048576}/{scratch_stats['quota_bytes'] // 1048576} MB used, {scratch_stats['free_bytes'] // 1048576} MB free on disk</p>
+    <p><strong>Report Uploads Skipped (file_id reuse):</strong> {telegram_files.reuses}</p>
+    <p><strong>Report Cache:</strong> {cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%}), {cache_stats['bytes_saved']} bytes not re-analysed</p>
     <p><strong>Status:</strong> 🟢 Automatic Fallback & Payments Active</p>
     """
 
+@app.route("/metrics")
+def metrics():
+    """Runtime metrics for capacity sizing"""
+    return jsonify({
+        "processing": engine.stats(),
+        "queue": dispatcher.stats(),
+        "outbound": outbound.stats(),
+        "report_cache": report_cache.stats(),
+        "telegram_files": telegram_files.stats(),
+        "scratch": scratch.stats(),
+        "similarity": similarity_index.stats(),
+        "user_cache": user_cache.stats(),
+        "capacity": capacity.stats(),
+        "paystack": paystack.stats(),
+        "paystack_events": paystack_inbox.stats()
+    })
+
+@app.route("/admin/redeliver/<int:submission_id>", methods=["POST"])
+def admin_redeliver(submission_id):
+    """Send a finished submission's reports to its owner again"""
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        return jsonify({"status": "forbidden"}), 403
+
+    r = db.execute(
+        "SELECT user_id, filename, options, is_free_check, status, report_path, similarity_score, ai_score, file_hash "
+        "FROM submissions WHERE id=?", (submission_id,)
+    ).fetchone()
+    if not r or r["status"] != "done":
+        return jsonify({"status": "not_found"}), 404
+
+    options = json.loads(r["options"] or "{}")
+    analysis = report_cache.peek(r["file_hash"], options) if r["file_hash"] else None
+    if analysis:
+        result = render_cached_result(r["filename"], options, analysis)
+    elif r["report_path"] and os.path.exists(r["report_path"]):
+        result = {"similarity_score": r["similarity_score"], "ai_score": r["ai_score"], "similarity_report_path": r["report_path"]}
+    else:
+        return jsonify({"status": "report_unavailable"}), 410
+
+    send_analysis_result(r["user_id"], r["filename"], options, result, r["is_free_check"], upsell=False)
+    return jsonify({"status": "queued", "user_id": r["user_id"]})
+
+@app.route("/admin/paystack-events")
+def admin_paystack_events():
+    """Stored Paystack events, newest first; filter with ?status=failed, ?event=, ?since=, ?until="""
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        return jsonify({"status": "forbidden"}), 403
+
+    query = "SELECT id, event, reference, status, attempts, result, error, received_at, applied_at FROM paystack_events WHERE received_at BETWEEN ? AND ?"
+    params = [request.args.get("since", 0, type=int), request.args.get("until", now_ts(), type=int)]
+    for column in ("status", "event"):
+        if request.args.get(column):
+            query += f" AND {column}=?"
+            params.append(request.args[column])
+    rows = db.execute(query + " ORDER BY id DESC LIMIT 200", params).fetchall()
+    return jsonify({"events": [dict(r) for r in rows]})
+
+@app.route("/admin/paystack-events/replay", methods=["POST"])
+def admin_replay_paystack_events():
+    """Apply the Paystack events received between `since` and `until` (epoch seconds) again, e.g. after an incident"""
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        return jsonify({"status": "forbidden"}), 403
+
+    body = request.get_json(silent=True) or request.form
+    try:
+        since = int(body["since"])
+        until = int(body.get("until") or now_ts())
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"status": "error", "message": "since (and optional until) must be epoch seconds"}), 400
+    count = paystack_inbox.replay(since, until, body.get("event"))
+    return jsonify({"status": "queued", "events": count})
+
+# Batch API
+def batch_client():
+    """Institution name for the request's X-API-Key, or None"""
+    key = request.headers.get("X-API-Key", "")
+    for name, secret in BATCH_API_KEYS.items():
+        if key and hmac.compare_digest(key, secret):
+            return name
+    return None
+
+def iter_batch_files(uploads):
+    """(filename, stream) for every uploaded document, looking inside .zip archives"""
+    for upload in uploads:
+        name = os.path.basename(upload.filename or "")
+        if not name.lower().endswith(".zip"):
+            yield name, upload.stream
+            continue
+        try:
+            archive = zipfile.ZipFile(upload.stream)
+        except zipfile.BadZipFile:
+            yield name, None
+            continue
+        with archive:
+            for info in archive.infolist():
+                member = os.path.basename(info.filename)
+                if info.is_dir() or not member or info.filename.startswith("__MACOSX/"):
+                    continue
+                with archive.open(info) as stream:
+                    yield member, stream
+
+def save_upload(stream, destination_path, max_bytes):
+    """Copy an upload to scratch, digesting it on the way; returns the ingest digest"""
+    digest = IngestDigest()
+    with open(destination_path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(INGEST_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            if digest.size > max_bytes:
+                raise ValueError(f"larger than {max_bytes // 1048576} MB")
+            f.write(chunk)
+    return digest.result()
+
+@app.route("/api/batch", methods=["POST"])
+def create_batch():
+    """Submit many documents at once.
+
+    Multipart form: one or more `files` (PDF, DOCX or .zip archives of them)
+    and optional report option fields (exclude_bibliography=yes, ...).
+    """
+    client = batch_client()
+    if not client:
+        return jsonify({"status": "unauthorized"}), 401
+    uploads = request.files.getlist("files")
+    if not uploads:
+        return jsonify({"status": "no_files"}), 400
+    if not scratch.has_room(request.content_length):
+        return jsonify({"status": "storage_full"}), 503
+
+    options = {name: request.form.get(name, "").lower() in ("1", "true", "yes", "on") for name in REPORT_OPTIONS}
+    batch_id = db.execute(
+        "INSERT INTO batches(client, status, options, created_at) VALUES(?, 'uploading', ?, ?) RETURNING id",
+        (client, json.dumps(options), now_ts())
+    ).fetchone()["id"]
+    db.commit()
+
+    accepted, rejected = [], []
+    room = scratch.quota_bytes - scratch.usage()
+    for n, (filename, stream) in enumerate(iter_batch_files(uploads)):
+        if stream is None:
+            rejected.append({"filename": filename, "error": "not a valid zip archive"})
+            continue
+        if not allowed_file(filename):
+            rejected.append({"filename": filename, "error": "only .pdf and .docx files are supported"})
+            continue
+        if len(accepted) >= BATCH_MAX_FILES or room <= 0:
+            rejected.append({"filename": filename, "error": "batch is full"})
+            continue
+        path = scratch.path_for(batch_scratch_key(batch_id), f"{n:05d}_{filename}")
+        try:
+            ingest = save_upload(stream, path, min(room, BATCH_MAX_FILE_MB * 1048576))
+        except ValueError as e:
+            os.remove(path)
+            rejected.append({"filename": filename, "error": str(e)})
+            continue
+        if not ingest_matches_extension(ingest, filename):
+            os.remove(path)
+            rejected.append({"filename": filename, "error": "file content does not match its extension"})
+            continue
+        room -= ingest["file_size"]
+        accepted.append((filename, path, ingest))
+
+    # Identical documents are analysed once and share the result
+    primaries = {}
+    duplicates = 0
+    kept_bytes = 0
+    with db_transaction() as conn:
+        for filename, path, ingest in accepted:
+            primary = primaries.get(ingest["file_hash"])
+            row = conn.execute(
+                "INSERT INTO batch_items(batch_id, filename, file_path, file_hash, file_size, file_type, status, duplicate_of, created_at) "
+                "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING id",
+                (batch_id, filename, None if primary else path, ingest["file_hash"], ingest["file_size"], ingest["file_type"],
+                 "duplicate" if primary else "queued", primary, now_ts())
+            ).fetchone()
+            if primary:
+                os.remove(path)
+                duplicates += 1
+            else:
+                primaries[ingest["file_hash"]] = row["id"]
+                kept_bytes += ingest["file_size"]
+        conn.execute("UPDATE batches SET status=?, total=? WHERE id=?",
+                     ("processing" if accepted else "failed", len(accepted), batch_id))
+    scratch.reserve(batch_scratch_key(batch_id), kept_bytes)
+
+    if not accepted:
+        scratch.release(batch_scratch_key(batch_id))
+        return jsonify({"status": "no_documents", "batch_id": batch_id, "rejected": rejected}), 400
+
+    dispatcher.wake()
+    print(f"📦 Batch {batch_id} from {client}: {len(accepted)} documents ({duplicates} duplicates), {len(rejected)} rejected")
+    return jsonify({
+        "status": "processing",
+        "batch_id": batch_id,
+        "documents": len(accepted),
+        "duplicates": duplicates,
+        "rejected": rejected,
+        "status_url": f"/api/batch/{batch_id}",
+        "report_url": f"/api/batch/{batch_id}/report"
+    }), 202
+
+def get_client_batch(batch_id):
+    client = batch_client()
+    if not client:
+        return None, (jsonify({"status": "unauthorized"}), 401)
+    batch = db.execute("SELECT * FROM batches WHERE id=? AND client=?", (batch_id, client)).fetchone()
+    if not batch:
+        return None, (jsonify({"status": "not_found"}), 404)
+    return batch, None
+
+def batch_progress(batch):
+    counts = {r["status"]: r["n"] for r in db.execute(
+        "SELECT status, COUNT(*) AS n FROM batch_items WHERE batch_id=? GROUP BY status", (batch["id"],)
+    )}
+    finished = counts.get("done", 0) + counts.get("failed", 0)
+    return {
+        "batch_id": batch["id"],
+        "status": batch["status"],
+        "total": batch["total"],
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0),
+        "pending": batch["total"] - finished,
+        "progress": round(100 * finished / batch["total"]) if batch["total"] else 100,
+        "created_at": batch["created_at"],
+        "finished_at": batch["finished_at"]
+    }
+
+@app.route("/api/batch/<int:batch_id>")
+def batch_status(batch_id):
+    """Progress of a batch, for polling"""
+    batch, error = get_client_batch(batch_id)
+    if error:
+        return error
+    progress = batch_progress(batch)
+    progress["items"] = [dict(r) for r in db.execute(
+        "SELECT id, filename, status, similarity_score, ai_score, error FROM batch_items WHERE batch_id=? ORDER BY id", (batch_id,)
+    )]
+    return jsonify(progress)
+
+def generate_batch_report(batch, items):
+    """One text report for a whole batch: summary, in-batch matches, then every document's reports"""
+    options = json.loads(batch["options"] or "{}")
+    names = {item["id"]: item["filename"] for item in items}
+    done = [item for item in items if item["status"] == "done"]
+    failed = [item for item in items if item["status"] == "failed"]
+    fmt = lambda ts: datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts else "-"
+
+    lines = []
+    matched = 0
+    for i, item in enumerate(done, 1):
+        peers = json.loads(item["batch_matches"] or "[]")
+        matched += bool(peers)
+        overlap = ", ".join(f"{names.get(p['item'], p['item'])} {p['percent']}%" for p in peers) or "none"
+        if item["duplicate_of"]:
+            overlap = f"identical to {names.get(item['duplicate_of'])}"
+        lines.append(f"{i}. {item['filename']} - Similarity {item['similarity_score']}% | AI {item['ai_score']}% | Batch overlap: {overlap}")
+    lines += [f"{item['filename']} - FAILED ({item['error'] or 'unknown error'})" for item in failed]
+
+    average = lambda key: round(sum(item[key] for item in done) / len(done)) if done else 0
+    report = f"""
+TURNITQ BATCH REPORT
+====================
+Batch: #{batch['id']}
+Institution: {batch['client']}
+Submitted: {fmt(batch['created_at'])}
+Completed: {fmt(batch['finished_at'])}
+Documents: {len(items)} ({len(done)} analysed, {len(failed)} failed)
+
+SUMMARY:
+--------
+Average Similarity Index: {average('similarity_score')}%
+Average AI Writing Probability: {average('ai_score')}%
+Documents Overlapping Others In This Batch: {matched}
+
+PROCESSING OPTIONS:
+-------------------
+Exclude Bibliography: {'Yes' if options.get('exclude_bibliography') else 'No'}
+Exclude Quoted Text: {'Yes' if options.get('exclude_quoted_text') else 'No'}
+Exclude Cited Text: {'Yes' if options.get('exclude_cited_text') else 'No'}
+Exclude Small Matches: {'Yes' if options.get('exclude_small_matches') else 'No'}
+
+DOCUMENTS:
+----------
+{chr(10).join(lines)}
+"""
+    for item in done:
+        analysis = json.loads(item["analysis"])
+        report += "\n" + "=" * 60 + "\n"
+        report += generate_turnitin_report(item["filename"], analysis["scores"], options, analysis["file_analysis"],
+                                           source="BATCH_API", report_time=analysis.get("report_time"))
+        report += generate_ai_report(item["filename"], analysis["scores"], analysis.get("report_time"))
+    return report
+
+@app.route("/api/batch/<int:batch_id>/report")
+def batch_report(batch_id):
+    """Combined report of a finished batch (?format=json for the per-document data)"""
+    batch, error = get_client_batch(batch_id)
+    if error:
+        return error
+    if batch["status"] not in ("done", "failed"):
+        return jsonify(batch_progress(batch)), 409
+
+    items = [dict(r) for r in db.execute(
+        "SELECT id, filename, status, duplicate_of, similarity_score, ai_score, analysis, batch_matches, error FROM batch_items "
+        "WHERE batch_id=? ORDER BY id",
+        (batch_id,)
+    )]
+    if request.args.get("format") == "json":
+        names = {item["id"]: item["filename"] for item in items}
+        documents = []
+        for item in items:
+            analysis = json.loads(item.pop("analysis") or "null")
+            peers = json.loads(item.pop("batch_matches") or "[]")
+            item["batch_matches"] = [{"filename": names.get(p["item"]), "percent": p["percent"]} for p in peers]
+            item["duplicate_of"] = names.get(item["duplicate_of"])
+            item["corpus_sources"] = ((analysis or {}).get("file_analysis", {}).get("similarity") or {}).get("sources", [])
+            item["stylometry"] = (analysis or {}).get("scores", {}).get("stylometry")
+            documents.append(item)
+        return jsonify(dict(batch_progress(batch), documents=documents))
+
+    report = generate_batch_report(batch, items)
+    return report, 200, {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Content-Disposition": f"attachment; filename=batch_{batch_id}_report.txt"
+    }
+
 @app.route("/payment-success")
 def payment_success():
     """Ask user for Telegram ID and activate subscription based on plan from URL"""
@@ -1558,18 +4105,324 @@ def manual_activation():
     except Exception as e:
         return f"<h2>Error</h2><p>{str(e)}</p>", 500
 
-@app.route("/paystack-webhook", methods=["POST"])
-def paystack_webhook():
-    """Paystack webhook for automatic payment verification and activation"""
+# Paystack event inbox
+class EventNotReady(Exception):
+    """Raised by an event handler when the event can't be applied yet but isn't failing"""
+
+class PaystackInbox:
+    """Durable inbox between the Paystack webhook and the code that acts on it.
+
+    The webhook only verifies the signature and stores the event
+    (paystack_events, deduplicated on event + reference), so Paystack gets
+    its 200 in milliseconds. A consumer thread then applies events in
+    arrival order per entity (the charge or transfer reference): an event
+    is only claimed, under a lease, once every earlier event for the same
+    entity has finished, while events for other entities carry on. An
+    event that raises is retried with backoff; after
+    PAYSTACK_EVENT_MAX_ATTEMPTS it is parked as 'failed' and its entity
+    moves on. A handler raising EventNotReady (e.g. a transfer the payout
+    run is still sending) is deferred without using up an attempt.
+    Handlers are idempotent, so replay() can re-run any time range.
+    """
+
+    def __init__(self, poll_interval=2.0, lease_seconds=120, max_attempts=PAYSTACK_EVENT_MAX_ATTEMPTS, defer_seconds=30):
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.defer_seconds = defer_seconds
+        self._wake = threading.Event()
+        self.received = 0
+        self.duplicates = 0
+        self.applied = 0
+        self.errors = 0
+
+    def start(self):
+        t = threading.Thread(target=self._run, name="paystack-inbox", daemon=True)
+        t.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def store(self, data, raw_body):
+        """Persist a verified event; False if it was delivered before"""
+        event = data.get('event')
+        reference = (data.get('data') or {}).get('reference')
+        dedup_key = f"{event}:{reference}" if reference else "sha256:" + hashlib.sha256(raw_body).hexdigest()
+        with db_transaction() as conn:
+            new = conn.execute(
+                "INSERT INTO paystack_events(dedup_key, entity, event, reference, payload, received_at) VALUES(?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(dedup_key) DO NOTHING",
+                (dedup_key, reference or dedup_key, event, reference, raw_body.decode('utf-8'), now_ts())
+            ).rowcount == 1
+        if new:
+            self.received += 1
+            self.wake()
+        else:
+            self.duplicates += 1
+        return new
+
+    def _claim(self):
+        now = now_ts()
+        with db_transaction() as conn:
+            return conn.execute("""
+            UPDATE paystack_events SET status='processing', attempts=attempts+1, lease_expires_at=?
+            WHERE id = (
+                SELECT e.id FROM paystack_events e
+                WHERE (e.status='pending' OR (e.status='processing' AND e.lease_expires_at <= ?))
+                  AND e.next_attempt_at <= ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM paystack_events p
+                      WHERE p.entity = e.entity AND p.id < e.id AND p.status IN ('pending', 'processing')
+                  )
+                ORDER BY e.id LIMIT 1
+            )
+            RETURNING *
+            """, (now + self.lease_seconds, now, now)).fetchone()
+
+    def drain(self):
+        """Apply events until none is ready (the rest are waiting on a retry or an earlier event)"""
+        count = 0
+        while True:
+            row = self._claim()
+            if not row:
+                return count
+            self._apply(row)
+            count += 1
+
+    def _apply(self, row):
+        try:
+            data = json.loads(row['payload'])
+            status, result = apply_paystack_event(row['event'], data.get('data') or {})
+        except EventNotReady as e:
+            print(f"⏳ Paystack event {row['id']} ({row['event']}) deferred: {e}")
+            db.execute(
+                "UPDATE paystack_events SET status='pending', attempts=attempts-1, error=?, lease_expires_at=NULL, next_attempt_at=? "
+                "WHERE id=? AND status='processing'",
+                (str(e), now_ts() + self.defer_seconds, row['id'])
+            )
+            db.commit()
+            return
+        except Exception as e:
+            self.errors += 1
+            parked = row['attempts'] >= self.max_attempts
+            print(f"❌ Paystack event {row['id']} ({row['event']}) failed, attempt {row['attempts']}: {e}")
+            db.execute(
+                "UPDATE paystack_events SET status=?, error=?, lease_expires_at=NULL, next_attempt_at=? WHERE id=? AND status='processing'",
+                ("failed" if parked else "pending", str(e), now_ts() + min(60, 2 ** row['attempts']), row['id'])
+            )
+            db.commit()
+            return
+        self.applied += 1
+        db.execute(
+            "UPDATE paystack_events SET status=?, result=?, error=NULL, lease_expires_at=NULL, applied_at=? WHERE id=? AND status='processing'",
+            (status, json.dumps(result), now_ts(), row['id'])
+        )
+        db.commit()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self.drain()
+            except Exception as e:
+                print(f"❌ Paystack inbox error: {e}")
+
+    def replay(self, since, until, event=None):
+        """Queue every stored event received in [since, until] to be applied again, oldest first"""
+        query = "UPDATE paystack_events SET status='pending', attempts=0, next_attempt_at=0, error=NULL WHERE received_at BETWEEN ? AND ? AND status != 'processing'"
+        params = [since, until]
+        if event:
+            query += " AND event=?"
+            params.append(event)
+        with db_transaction() as conn:
+            count = conn.execute(query, params).rowcount
+        print(f"🔁 Replaying {count} Paystack events received {since}..{until}")
+        self.wake()
+        return count
+
+    def prune(self, max_age_days=90):
+        with db_transaction() as conn:
+            removed = conn.execute(
+                "DELETE FROM paystack_events WHERE received_at < ? AND status NOT IN ('pending', 'processing', 'failed')",
+                (now_ts() - max_age_days * 86400,)
+            ).rowcount
+        print(f"🧹 Pruned {removed} old Paystack events")
+
+    def stats(self):
+        counts = {r['status']: r['n'] for r in db.execute("SELECT status, COUNT(*) AS n FROM paystack_events GROUP BY status")}
+        return {
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "applied": self.applied,
+            "errors": self.errors,
+            "backlog": counts.get("pending", 0) + counts.get("processing", 0),
+            "failed": counts.get("failed", 0)
+        }
+
+paystack_inbox = PaystackInbox()
+scheduler.add_job(paystack_inbox.prune, 'cron', hour=3)
+if BACKGROUND_JOBS:
+    paystack_inbox.start()
+
+def apply_paystack_event(event, data):
+    """Act on one Paystack event; returns (status, result) where status is applied, ignored or rejected.
+
+    Raises for anything worth retrying. Safe to call again for an event
+    that was already applied.
+    """
+    if event == 'charge.success':
+        return apply_charge_success(data)
+    if event in ('transfer.success', 'transfer.failed', 'transfer.reversed'):
+        return apply_transfer_event(event, data)
+    if event == 'charge.failed':
+        print(f"❌ Payment failed: {data.get('reference')}")
+        return "applied", {"status": "payment_failed"}
+    print(f"ℹ️ Ignoring event: {event}")
+    return "ignored", {"status": "ignored"}
+
+def apply_charge_success(payment_data):
+    """Activate the plan a successful charge paid for"""
+    reference = payment_data.get('reference')
+    amount = payment_data.get('amount', 0) / 100  # Convert from kobo
+    customer_email = payment_data.get('customer', {}).get('email', '')
+    metadata = payment_data.get('metadata', {})
+    custom_fields = payment_data.get('custom_fields', [])
+    
+    print(f"💰 Payment successful - Reference: {reference}, Amount: ${amount}")
+    
+    # Extract user info from multiple sources
+    user_id = None
+    plan = None
+    
+    # METHOD 1: Extract from custom_fields
+    for field in custom_fields:
+        variable_name = field.get('variable_name', '').lower()
+        value = field.get('value', '')
+        
+        if 'telegram' in variable_name or 'telegram' in str(value):
+            user_id = value
+            print(f"✅ Found Telegram ID in custom field: {user_id}")
+        
+        if 'plan' in variable_name:
+            plan = value
+            print(f"✅ Found plan in custom field: {plan}")
+    
+    # METHOD 2: Check metadata
+    if not user_id:
+        user_id = metadata.get('telegram_id') or metadata.get('telegram_user_id')
+        if user_id:
+            print(f"✅ Found Telegram ID in metadata: {user_id}")
+    
+    if not plan:
+        plan = metadata.get('plan')
+        if plan:
+            print(f"✅ Found plan in metadata: {plan}")
+    
+    # METHOD 3: Extract from customer email (fallback)
+    if not user_id and customer_email:
+        if customer_email.startswith('user') and '@turnitq.com' in customer_email:
+            try:
+                user_id = int(customer_email.replace('user', '').replace('@turnitq.com', ''))
+                print(f"✅ Extracted Telegram ID from email: {user_id}")
+            except:
+                pass
+    
+    # METHOD 4: Try to determine plan from amount
+    if not plan:
+        plan_data = {8: 'premium', 29: 'pro', 79: 'elite'}
+        closest_plan = min(plan_data.keys(), key=lambda x: abs(x - amount))
+        if abs(amount - closest_plan) <= 5:
+            plan = plan_data[closest_plan]
+            print(f"💰 Inferred plan from amount: {plan} (${amount})")
+
+    print(f"🔍 Final extraction - User ID: {user_id}, Plan: {plan}")
+
+    if not user_id or not plan:
+        print(f"❌ Missing user_id or plan in webhook")
+        return "rejected", {"status": "missing_data"}
+    try:
+        user_id = int(user_id)
+    except (ValueError, TypeError) as e:
+        print(f"❌ Invalid user_id: {user_id}, error: {e}")
+        return "rejected", {"status": "invalid_user_id"}
+
+    # Verify this is a valid plan
+    if plan not in PLANS:
+        print(f"❌ Invalid plan: {plan}")
+        return "rejected", {"status": "invalid_plan", "plan": plan}
+
+    with db_transaction() as conn:
+        # Replays and re-deliveries find the payment already recorded
+        if reference and conn.execute("SELECT 1 FROM payments WHERE reference=? AND status='success'", (reference,)).fetchone():
+            return "ignored", {"status": "already_applied", "user_id": user_id}
+
+        # ACTIVATE SUBSCRIPTION AUTOMATICALLY (paying before ever messaging the bot still needs a row)
+        provision_user(user_id)
+        expiry_date = activate_user_subscription(user_id, plan, conn=conn)
+        if not expiry_date:
+            raise RuntimeError(f"could not activate {plan} for user {user_id}")
+
+        # Store payment record
+        conn.execute(
+            "INSERT INTO payments (user_id, plan, amount, reference, status, created_at, verified_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, plan, amount, reference, 'success', now_ts(), now_ts())
+        )
+
+    # Send automatic confirmation to user
+    plan_data = PLANS[plan]
+    success_message = (
+        f"🎉 Payment Verified & Activated!\n\n"
+        f"✅ Your {plan_data['name']} plan is now ACTIVE!\n"
+        f"📅 Expires: {expiry_date}\n"
+        f"🔓 Daily checks: {plan_data['daily_limit']}\n"
+        f"💰 Amount: ${amount}\n\n"
+        f"🚀 You can now use all premium features immediately!\n"
+        f"📄 Upload a document to get started."
+    )
+    send_telegram_message(user_id, success_message)
+    print(f"✅ Subscription auto-activated for user {user_id}, plan {plan}")
+    return "applied", {"status": "activated", "user_id": user_id, "plan": plan, "expiry_date": expiry_date}
+
+def apply_transfer_event(event, data):
+    """Settle a referral payout once Paystack reports how the transfer ended"""
+    reference = data.get('reference')
+    if not reference:
+        return "ignored", {"status": "unknown_reference"}
+
+    with db_transaction() as conn:
+        # Only the attempt last sent is on the row; events for superseded attempts don't match
+        w = conn.execute("SELECT * FROM withdrawals WHERE paystack_reference=?", (reference,)).fetchone()
+        if not w:
+            return "ignored", {"status": "unknown_reference"}
+        withdrawal_id = w['id']
+        if w['status'] == 'sending':
+            # The payout run hasn't recorded Paystack's answer yet - try again shortly
+            raise EventNotReady(f"withdrawal {withdrawal_id} is still being sent")
+        if event == 'transfer.success':
+            conn.execute("UPDATE withdrawals SET status='paid' WHERE id=? AND status='processed'", (withdrawal_id,))
+            return "applied", {"status": "paid", "withdrawal_id": withdrawal_id}
+        if w['status'] not in ('processed', 'paid'):
+            return "ignored", {"status": w['status'], "withdrawal_id": withdrawal_id}
+        # Failed or reversed after Paystack accepted it - the money goes back to the user
+        conn.execute("UPDATE withdrawals SET status='returned', last_error=? WHERE id=?",
+                     (data.get('reason') or event, withdrawal_id))
+        post_ledger(conn, f"reversal:{withdrawal_id}", [(LEDGER_PAID, None, -w['amount']), (LEDGER_BALANCE, w['user_id'], w['amount'])])
+        conn.execute("UPDATE referral_earnings SET total_withdrawn=total_withdrawn-? WHERE user_id=?", (w['amount'], w['user_id']))
+
+    send_telegram_message(w['user_id'], f"❌ Your withdrawal of ₵{w['amount']} to {w['mobile_money_number']} didn't go through. The amount is back in your referral balance - please check the number and try /withdraw again.")
+    return "applied", {"status": "returned", "withdrawal_id": withdrawal_id}
+
+def handle_paystack_webhook(raw_body, signature):
+    """Verify a Paystack webhook delivery and store it in the inbox; returns (response body, HTTP status)"""
     try:
         # Verify signature
-        signature = request.headers.get('x-paystack-signature')
         if not signature:
             print("❌ No signature in webhook")
-            return jsonify({"status": "error"}), 400
+            return {"status": "error"}, 400
         
         # Verify the signature
-        payload = request.get_data(as_text=True)
+        payload = raw_body.decode('utf-8')
         computed_signature = hmac.new(
             PAYSTACK_SECRET_KEY.encode('utf-8'),
             payload.encode('utf-8'),
@@ -1578,141 +4431,53 @@ def paystack_webhook():
         
         if not hmac.compare_digest(computed_signature, signature):
             print("❌ Invalid webhook signature")
-            return jsonify({"status": "error"}), 400
+            return {"status": "error"}, 400
         
-        data = request.get_json()
+        data = json.loads(payload)
         event = data.get('event')
-        
+
+        # Paystack re-sends events it thinks we missed - the inbox keeps each one once
+        if not paystack_inbox.store(data, raw_body):
+            print(f"♻️ Duplicate Paystack event {event} ignored")
+            return {"status": "duplicate"}, 200
+
         print(f"📨 Received Paystack webhook: {event}")
+        return {"status": "received"}, 200
         
-        if event == 'charge.success':
-            payment_data = data.get('data', {})
-            reference = payment_data.get('reference')
-            amount = payment_data.get('amount', 0) / 100  # Convert from kobo
-            customer_email = payment_data.get('customer', {}).get('email', '')
-            metadata = payment_data.get('metadata', {})
-            custom_fields = payment_data.get('custom_fields', [])
-            
-            print(f"💰 Payment successful - Reference: {reference}, Amount: ${amount}")
-            
-            # Extract user info from multiple sources
-            user_id = None
-            plan = None
-            
-            # METHOD 1: Extract from custom_fields
-            for field in custom_fields:
-                variable_name = field.get('variable_name', '').lower()
-                value = field.get('value', '')
-                
-                if 'telegram' in variable_name or 'telegram' in str(value):
-                    user_id = value
-                    print(f"✅ Found Telegram ID in custom field: {user_id}")
-                
-                if 'plan' in variable_name:
-                    plan = value
-                    print(f"✅ Found plan in custom field: {plan}")
-            
-            # METHOD 2: Check metadata
-            if not user_id:
-                user_id = metadata.get('telegram_id') or metadata.get('telegram_user_id')
-                if user_id:
-                    print(f"✅ Found Telegram ID in metadata: {user_id}")
-            
-            if not plan:
-                plan = metadata.get('plan')
-                if plan:
-                    print(f"✅ Found plan in metadata: {plan}")
-            
-            # METHOD 3: Extract from customer email (fallback)
-            if not user_id and customer_email:
-                if customer_email.startswith('user') and '@turnitq.com' in customer_email:
-                    try:
-                        user_id = int(customer_email.replace('user', '').replace('@turnitq.com', ''))
-                        print(f"✅ Extracted Telegram ID from email: {user_id}")
-                    except:
-                        pass
-            
-            # METHOD 4: Try to determine plan from amount
-            if not plan:
-                plan_data = {8: 'premium', 29: 'pro', 79: 'elite'}
-                closest_plan = min(plan_data.keys(), key=lambda x: abs(x - amount))
-                if abs(amount - closest_plan) <= 5:
-                    plan = plan_data[closest_plan]
-                    print(f"💰 Inferred plan from amount: {plan} (${amount})")
-            
-            print(f"🔍 Final extraction - User ID: {user_id}, Plan: {plan}")
-            
-            if user_id and plan:
-                try:
-                    user_id = int(user_id)
-                    
-                    # Verify this is a valid plan
-                    if plan not in PLANS:
-                        print(f"❌ Invalid plan: {plan}")
-                        return jsonify({"status": "error", "message": "Invalid plan"}), 400
-                    
-                    # ACTIVATE SUBSCRIPTION AUTOMATICALLY
-                    expiry_date = activate_user_subscription(user_id, plan)
-                    if expiry_date:
-                        # Store payment record
-                        cur = db.cursor()
-                        cur.execute(
-                            "INSERT INTO payments (user_id, plan, amount, reference, status, created_at, verified_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                            (user_id, plan, amount, reference, 'success', now_ts(), now_ts())
-                        )
-                        db.commit()
-                        
-                        # Send automatic confirmation to user
-                        plan_data = PLANS[plan]
-                        success_message = (
-                            f"🎉 Payment Verified & Activated!\n\n"
-                            f"✅ Your {plan_data['name']} plan is now ACTIVE!\n"
-                            f"📅 Expires: {expiry_date}\n"
-                            f"🔓 Daily checks: {plan_data['daily_limit']}\n"
-                            f"💰 Amount: ${amount}\n\n"
-                            f"🚀 You can now use all premium features immediately!\n"
-                            f"📄 Upload a document to get started."
-                        )
-                        send_telegram_message(user_id, success_message)
-                        print(f"✅ Subscription auto-activated for user {user_id}, plan {plan}")
-                        
-                        return jsonify({
-                            "status": "activated", 
-                            "user_id": user_id, 
-                            "plan": plan,
-                            "expiry_date": expiry_date
-                        }), 200
-                    else:
-                        print(f"❌ Failed to activate subscription for user {user_id}")
-                        return jsonify({"status": "activation_failed"}), 500
-                        
-                except (ValueError, TypeError) as e:
-                    print(f"❌ Invalid user_id: {user_id}, error: {e}")
-                    return jsonify({"status": "invalid_user_id"}), 400
-            else:
-                print(f"❌ Missing user_id or plan in webhook")
-                return jsonify({"status": "missing_data"}), 400
-        
-        elif event == 'charge.failed':
-            print(f"❌ Payment failed: {data}")
-            return jsonify({"status": "payment_failed"}), 200
-            
-        else:
-            print(f"ℹ️ Ignoring event: {event}")
-            return jsonify({"status": "ignored"}), 200
-        
+    except ValueError as e:
+        print(f"❌ Unreadable Paystack webhook: {e}")
+        return {"status": "error"}, 400
     except Exception as e:
         print(f"❌ Paystack webhook error: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({"status": "error"}), 500
+        return {"status": "error"}, 500
 
-@app.route('/webhook/<path:bot_token>', methods=['POST'])
-def telegram_webhook(bot_token):
-    """Main Telegram webhook handler"""
+@app.route("/paystack-webhook", methods=["POST"])
+def paystack_webhook():
+    """Paystack webhook for automatic payment verification and activation"""
+    body, status = handle_paystack_webhook(request.get_data(), request.headers.get('x-paystack-signature'))
+    return jsonify(body), status
+
+def handle_telegram_update(update_data):
+    """Handle one Telegram update once; returns (response body, HTTP status).
+
+    Telegram re-delivers updates when we answer slowly, so each update_id is
+    claimed first and duplicates are acknowledged without being processed.
+    """
+    update_id = update_data.get('update_id') if isinstance(update_data, dict) else None
+    key = f"tg:{update_id}" if update_id is not None else None
+    if key and not idempotency.claim(key):
+        print(f"♻️ Duplicate Telegram update {update_id} ignored")
+        return "ok", 200
+    body, status = process_telegram_update(update_data)
+    if key and status >= 500:
+        idempotency.release(key)
+    return body, status
+
+def process_telegram_update(update_data):
+    """Dispatch a Telegram update to the command/callback handlers"""
     try:
-        update_data = request.get_json(force=True)
-        
         if 'message' in update_data:
             message = update_data['message']
             user_id = message['from']['id']
@@ -1755,36 +4520,88 @@ def telegram_webhook(bot_token):
                         send_telegram_message(user_id, "⚠️ Daily limit reached. Upgrade for more.")
                         return "ok", 200
 
-                    # Create submission record
-                    cur.execute(
-                        "INSERT INTO submissions(user_id, filename, status, created_at, options, is_free_check) VALUES(?,?,?,?,?,?)",
-                        (user_id, session['current_filename'], "created", created, json.dumps(options), is_free_check)
-                    )
-                    sub_id = cur.lastrowid
+                    # Disk pressure - turn the upload away before charging a check
+                    if not scratch.has_room():
+                        update_user_session(user_id, waiting_for_options=1)
+                        send_telegram_message(user_id, "⏳ We're receiving a lot of documents right now. Please send your options again in a few minutes.")
+                        return "ok", 200
 
-                    # update counters
-                    cur.execute(
-                        "UPDATE users SET last_submission=?, used_today=used_today+1, free_checks_used=free_checks_used+? WHERE user_id=?",
-                        (created, 1 if is_free_check else 0, user_id)
-                    )
-                    db.commit()
+                    refusal = admission_refusal()
+                    if refusal:
+                        update_user_session(user_id, waiting_for_options=1)
+                        send_telegram_message(user_id, refusal)
+                        return "ok", 200
+
+                    try:
+                        with db_transaction() as conn:
+                            # Create submission record
+                            sub_id = conn.execute(
+                                "INSERT INTO submissions(user_id, filename, status, created_at, options, is_free_check) VALUES(?,?,?,?,?,?)",
+                                (user_id, session['current_filename'], "created", created, json.dumps(options), is_free_check)
+                            ).lastrowid
+
+                            # Take a unit of today's processing capacity - rolls back the submission if none is left
+                            if not capacity.reserve(sub_id):
+                                raise CapacityExhausted()
 
-                    local_path = str(TEMP_DIR / f"{user_id}_{now_ts()}_{session['current_filename']}")
-                    if download_telegram_file(session['current_file_id'], local_path):
+                            # update counters
+                            charge_daily_usage(user_data, created, is_free_check, conn=conn)
+                    except CapacityExhausted:
+                        update_user_session(user_id, waiting_for_options=1)
+                        send_telegram_message(user_id, CAPACITY_EXHAUSTED_MESSAGE)
+                        return "ok", 200
+
+                    local_path = scratch.path_for(sub_id, session['current_filename'])
+                    ingest = download_telegram_file(session['current_file_id'], local_path)
+                    if ingest:
+                        scratch.reserve(sub_id, ingest['file_size'])
+                    cached = report_cache.get(ingest['file_hash'], options) if ingest else None
+                    if not ingest or not ingest_matches_extension(ingest, session['current_filename']):
+                        # Failed download or renamed/corrupt upload - drop it and give the check back
+                        with db_transaction() as conn:
+                            conn.execute("UPDATE submissions SET status='failed', file_hash=?, file_size=?, file_type=? WHERE id=?",
+                                         ((ingest or {}).get('file_hash'), (ingest or {}).get('file_size'), (ingest or {}).get('file_type'), sub_id))
+                            user_cache.update_user(
+                                user_id, "used_today=MAX(0, used_today-1), free_checks_used=MAX(0, free_checks_used-?)",
+                                (1 if is_free_check else 0,), conn=conn
+                            )
+                            capacity.release(sub_id)
+                        scratch.release(sub_id)
+                        if not ingest:
+                            send_telegram_message(user_id, "❌ File download failed.")
+                        else:
+                            send_telegram_message(user_id, "⚠️ This file doesn't look like a valid .pdf or .docx document. Please check it and upload again.")
+                    elif cached:
+                        # Same document and options analysed recently - answer straight from the cache
+                        result = render_cached_result(session['current_filename'], options, cached)
+                        report_path = persist_reports(sub_id, result) if PERSIST_REPORTS else None
+                        with db_transaction() as conn:
+                            conn.execute(
+                                "UPDATE submissions SET status='done', report_path=?, similarity_score=?, ai_score=?, source=?, file_hash=?, file_size=?, file_type=? WHERE id=?",
+                                (report_path, result['similarity_score'], result['ai_score'], result['source'],
+                                 ingest['file_hash'], ingest['file_size'], ingest['file_type'], sub_id)
+                            )
+                            conn.execute(
+                                "INSERT INTO turnitin_logs (submission_id, success, source, error_message, created_at) VALUES (?, ?, ?, ?, ?)",
+                                (sub_id, True, result['source'], "Cache hit", now_ts())
+                            )
+                            capacity.release(sub_id)
+                        scratch.release(sub_id)
+                        send_analysis_result(user_id, session['current_filename'], options, result, is_free_check)
+                    elif ingest:
                         send_telegram_message(user_id, "✅ File received. Preparing analysis...")
 
-                        # Queue logic: if user already has a processing submission -> set this to queued and notify
-                        if user_has_active_processing(user_id):
-                            cur.execute("UPDATE submissions SET status='queued' WHERE id=?", (sub_id,))
-                            db.commit()
+                        # Queue logic: every submission goes through the durable queue; the plan decides priority
+                        busy = user_has_active_processing(user_id)
+                        cur.execute(
+                            "UPDATE submissions SET status='queued', file_path=?, priority=?, file_hash=?, file_size=?, file_type=? WHERE id=?",
+                            (local_path, PLAN_PRIORITY.get(user_data['plan'], PLAN_PRIORITY["free"]),
+                             ingest['file_hash'], ingest['file_size'], ingest['file_type'], sub_id)
+                        )
+                        db.commit()
+                        if busy:
                             queue_submission_notify(user_id)
-                        else:
-                            # start processing immediately
-                            cur.execute("UPDATE submissions SET status='processing' WHERE id=?", (sub_id,))
-                            db.commit()
-                            start_processing(sub_id, local_path, options)
-                    else:
-                        send_telegram_message(user_id, "❌ File download failed.")
+                        dispatcher.wake()
                     
                     return "ok", 200
                 else:
@@ -1831,8 +4648,23 @@ def telegram_webhook(bot_token):
                     f"📊 <b>Plan:</b> {plan_name}\n"
                     f"📈 <b>Daily Total Checks :</b> {daily_limit-used}\n"
                     f"📅 <b>Subscription Ends:</b> {expiry}\n"
+                    f"🕛 <b>Checks Reset:</b> midnight {u['timezone'] or DEFAULT_TIMEZONE}\n"
                 )
                 send_telegram_message(user_id, info_message)
+            elif text.startswith("/timezone"):
+                parts = text.split(maxsplit=1)
+                if len(parts) < 2:
+                    current = user_get(user_id)['timezone'] or DEFAULT_TIMEZONE
+                    send_telegram_message(user_id,
+                        f"🕛 Your daily checks reset at midnight <b>{current}</b>.\n"
+                        f"To change it, send e.g. <code>/timezone Europe/London</code>"
+                    )
+                elif not valid_timezone(parts[1].strip()):
+                    send_telegram_message(user_id, "⚠️ Unknown timezone. Use a name like <code>Africa/Lagos</code> or <code>America/New_York</code>.")
+                else:
+                    name = parts[1].strip()
+                    user_cache.update_user(user_id, "timezone=?", (name,))
+                    send_telegram_message(user_id, f"✅ Your daily checks will now reset at midnight {name}.")
             elif text.startswith("/upgrade"):
                 send_telegram_message(user_id, f"<b>🔓 Unlock More with TurnitQ Premium Plans</b>\n""Your first check was free — now take your writing game to the next level.\n""Choose the plan that fits your workload 👇")
                 keyboard = create_inline_keyboard([
@@ -1913,11 +4745,20 @@ def telegram_webhook(bot_token):
                     send_telegram_message(user_id, "⚠️ Only .pdf and .docx files allowed.")
                     return "ok", 200
 
+                if not scratch.has_room(doc.get('file_size', 0)):
+                    send_telegram_message(user_id, "⏳ We're receiving a lot of documents right now. Please upload your file again in a few minutes.")
+                    return "ok", 200
+
                 u = user_get(user_id)
                 if u["used_today"] >= u["daily_limit"]:
                     send_telegram_message(user_id, "⚠️ Daily limit reached. Upgrade for more.")
                     return "ok", 200
 
+                refusal = admission_refusal()
+                if refusal:
+                    send_telegram_message(user_id, refusal)
+                    return "ok", 200
+
                 # Check free-check usage: if free used, ask to upgrade (but allow paid users)
                 if u['plan'] == 'free' and u['free_checks_used'] > 0:
                     upgrade_keyboard = create_inline_keyboard([
@@ -1939,7 +4780,7 @@ def telegram_webhook(bot_token):
                 # invalid / unsupported plain text
                 invalid_msg = (
                     "⚠️ Please use one of the available commands:\n"
-                    " /check • /cancel • /upgrade • /id • /referral • /withdraw"
+                    " /check • /cancel • /upgrade • /id • /referral • /withdraw • /timezone"
                 )
                 send_telegram_message(user_id, invalid_msg)
 
@@ -2121,16 +4962,18 @@ def telegram_webhook(bot_token):
         traceback.print_exc()
         return "error", 500
 
+@app.route('/webhook/<path:bot_token>', methods=['POST'])
+def telegram_webhook(bot_token):
+    """Main Telegram webhook handler"""
+    return handle_telegram_update(request.get_json(force=True, silent=True))
+
 def setup_webhook():
     try:
         webhook_url = f"{WEBHOOK_BASE_URL}/webhook/{TELEGRAM_BOT_TOKEN}"
         print(f"🔗 Setting webhook: {webhook_url}")
         
-        response = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook",
-            json={"url": webhook_url, "drop_pending_updates": True}
-        )
-        print(f"📡 Webhook result: {response.json()}")
+        result = telegram.call("setWebhook", {"url": webhook_url, "drop_pending_updates": True})
+        print(f"📡 Webhook result: {result}")
     except Exception as e:
         print(f"❌ Webhook setup error: {e}")
 
@@ -0,0 +1,306 @@
+"""Asyncio serving mode for the TurnitQ webhook server.
+
+    uvicorn asgi:application --host 0.0.0.0 --port $PORT
+
+The Telegram and Paystack webhooks are served on the event loop: request
+bodies are read asynchronously, the SQLite-bound handlers run on a bounded
+thread pool, and outgoing Telegram messages are sent with an async httpx
+client. Every other route is handed to the Flask app through a small
+WSGI bridge, so behaviour matches the gunicorn mode.
+"""
+import io
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+# Outgoing messages are sent from the event loop, so the app must not start its sender threads
+os.environ["ASYNC_OUTBOUND"] = "1"
+import app as bot
+
+ASGI_HANDLER_THREADS = int(os.getenv("ASGI_HANDLER_THREADS", "32"))
+
+_handlers = ThreadPoolExecutor(max_workers=ASGI_HANDLER_THREADS, thread_name_prefix="webhook-handler")
+
+
+# Async Telegram client
+async def take_token(bucket):
+    """Wait, without blocking the loop, for a token from a (thread-safe) app.TokenBucket"""
+    while True:
+        wait = bucket.try_acquire()
+        if not wait:
+            return
+        await asyncio.sleep(wait)
+
+
+class AsyncTelegramClient:
+    """httpx-based counterpart of app.TelegramClient.
+
+    It takes from the sync client's token buckets and follows its
+    retry_delay() policy. Documents still go out through the sync client on
+    the handler pool, so both paths share one rate budget and one 429 pause.
+    """
+
+    def __init__(self, sync=bot.telegram):
+        self.sync = sync
+        self.client = httpx.AsyncClient(
+            base_url=sync.base_url,
+            timeout=httpx.Timeout(30, connect=5),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+
+    def chat_delay(self, chat_id):
+        return self.sync.chat_delay(chat_id)
+
+    async def call(self, method, payload, chat_id=None):
+        result = {"ok": False, "description": "no attempt made"}
+        for attempt in range(self.sync.max_retries + 1):
+            if chat_id is not None:
+                for bucket in self.sync.buckets(chat_id):
+                    await take_token(bucket)
+            try:
+                response = await self.client.post(f"/bot{self.sync.token}/{method}", json=payload)
+                result = response.json()
+                status_code = response.status_code
+            except (httpx.HTTPError, ValueError) as e:
+                result = {"ok": False, "description": str(e)}
+                status_code = None
+
+            delay = self.sync.retry_delay(method, attempt, status_code, result, chat_id)
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
+        return result
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
+        if reply_markup:
+            payload["reply_markup"] = json.dumps(reply_markup)
+        return await self.call("sendMessage", payload, chat_id=chat_id)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class AsyncOutboundQueue(bot.OutboundQueue):
+    """Event-loop replacement for app.outbound.
+
+    Keeps the same enqueue()/stats() interface and per-chat FIFOs. Text
+    messages go out through the async client; other deliveries (documents)
+    run their blocking deliverer on the handler pool.
+    """
+
+    def __init__(self, loop, client, senders=bot.OUTBOUND_SENDERS, batch_size=20):
+        super().__init__(senders, batch_size, client)
+        self.loop = loop
+        self._queues = [asyncio.Queue() for _ in range(self.senders)]
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [self.loop.create_task(self._run(q)) for q in self._queues]
+
+    def adopt(self, previous):
+        """Take over whatever was queued on the thread-based queue before the loop started"""
+        for q in previous._queues:
+            while True:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                self._queues[hash(item[2]) % self.senders].put_nowait(item)
+
+    def enqueue(self, chat_id, fn, *args, **kwargs):
+        shard = self._queues[hash(chat_id) % self.senders]
+        # Handlers call this from worker threads, so hand the item to the loop thread-safely
+        self.loop.call_soon_threadsafe(shard.put_nowait, (time.monotonic(), fn, chat_id, args, kwargs))
+        return True
+
+    async def _run(self, q):
+        chats = OrderedDict()
+        wait = None
+        while True:
+            try:
+                items = [await asyncio.wait_for(q.get(), wait)] if wait != 0 else []
+            except asyncio.TimeoutError:
+                items = []
+            while len(items) < self.batch_size and not q.empty():
+                items.append(q.get_nowait())
+            self._hold(chats, items)
+            for item in items:
+                q.task_done()
+            ready, wait = self._take_ready(chats)
+            for item in ready:
+                await self._deliver_async(*item)
+
+    async def _deliver_async(self, enqueued_at, fn, chat_id, args, kwargs):
+        try:
+            if fn is bot.deliver_telegram_message:
+                result = await self.client.send_message(chat_id, *args, **kwargs)
+                ok = bool(result.get("ok"))
+                if not ok:
+                    print(f"❌ Telegram API error: {result}")
+            else:
+                ok = await self.loop.run_in_executor(_handlers, functools.partial(fn, chat_id, *args, **kwargs))
+        except Exception as e:
+            print(f"❌ Outbound delivery error: {e}")
+            ok = False
+        self._delivered(enqueued_at, ok)
+
+    async def drain(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.backlog() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.backlog():
+            print(f"⚠️ Shutting down with {self.backlog()} undelivered messages")
+        for task in self._tasks:
+            task.cancel()
+
+
+# ASGI plumbing
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def respond(send, status, body, content_type):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def offload(fn, *args):
+    """Run a blocking (SQLite-bound) handler on the handler pool"""
+    return await asyncio.get_running_loop().run_in_executor(_handlers, fn, *args)
+
+
+async def telegram_webhook(scope, receive, send):
+    raw = await read_body(receive)
+    try:
+        update_data = json.loads(raw)
+    except ValueError:
+        update_data = None
+    body, status = await offload(bot.handle_telegram_update, update_data)
+    await respond(send, status, body, "text/html; charset=utf-8")
+
+
+async def paystack_webhook(scope, receive, send):
+    raw = await read_body(receive)
+    headers = dict(scope["headers"])
+    signature = headers.get(b"x-paystack-signature")
+    body, status = await offload(bot.handle_paystack_webhook, raw, signature.decode() if signature else None)
+    await respond(send, status, json.dumps(body), "application/json")
+
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def flask_app(scope, receive, send):
+    """Serve any other route with the Flask app on the handler pool"""
+    body = await read_body(receive)
+    environ = wsgi_environ(scope, body)
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+    def run():
+        chunks = bot.app(environ, start_response)
+        try:
+            return b"".join(chunks)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    out = await offload(run)
+    await send({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+    await send({"type": "http.response.body", "body": out})
+
+
+async def lifespan(receive, send):
+    client = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            client = AsyncTelegramClient()
+            outbound = AsyncOutboundQueue(asyncio.get_running_loop(), client)
+            outbound.adopt(bot.outbound)
+            bot.outbound = outbound
+            outbound.start()
+            print("⚡ Async webhook server ready")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if isinstance(bot.outbound, AsyncOutboundQueue):
+                await bot.outbound.drain()
+            if client:
+                await client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] == "http" and scope["method"] == "POST":
+        if scope["path"].startswith("/webhook/"):
+            await telegram_webhook(scope, receive, send)
+            return
+        if scope["path"] == "/paystack-webhook":
+            await paystack_webhook(scope, receive, send)
+            return
+    await flask_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    print("🚀 Starting TurnitQ Bot (asyncio mode)...")
+    bot.setup_webhook()
+    port = int(os.environ.get("PORT", 5000))
+    uvicorn.run(application, host="0.0.0.0", port=port, lifespan="on")
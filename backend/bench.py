@@ -0,0 +1,382 @@
+"""Benchmarks for TurnitQ hot paths.
+
+Runs against a throwaway SQLite database, never the live one:
+
+    python backend/bench.py db --rows 1000000
+    python backend/bench.py similarity --docs 200000
+    python backend/bench.py stylometry --words 3000
+    python backend/bench.py users --users 2000
+    python backend/bench.py onboarding --users 20000 --threads 8
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import sqlite3
+import itertools
+import threading
+import statistics
+
+# Point the app at a scratch database and keep its background threads off
+# before it is imported.
+_workdir = tempfile.mkdtemp(prefix="turnitq_bench_")
+os.environ["DATABASE_URL"] = os.path.join(_workdir, "bench.sqlite")
+os.environ["TEMP_DIR"] = os.path.join(_workdir, "tmp")
+os.environ["SIMILARITY_INDEX_DIR"] = os.path.join(_workdir, "similarity_index")
+os.environ["BACKGROUND_JOBS"] = "0"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+os.environ.setdefault("PAYSTACK_PUBLIC_KEY", "pk_bench")
+os.environ.setdefault("PAYSTACK_SECRET_KEY", "sk_bench")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app  # noqa: E402
+import similarity  # noqa: E402
+import stylometry  # noqa: E402
+import numpy as np  # noqa: E402
+
+
+def timed(fn, iterations):
+    """Run fn `iterations` times and return per-call latencies in ms"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1] if len(samples) > 1 else samples[0]
+    print(f"  {label:<34} median {statistics.median(samples):9.3f} ms   p95 {p95:9.3f} ms")
+
+
+# Database
+def seed_database(rows, users):
+    conn = app.get_db()
+    statuses = ["done"] * 90 + ["failed"] * 5 + ["cancelled"] * 3 + ["queued"] + ["processing"]
+    sources = ["ADVANCED_ANALYSIS", "ADVANCED_ANALYSIS", "USER_CANCEL", "REAL_TURNITIN"]
+    now = app.now_ts()
+    rnd = random.Random(42)
+
+    print(f"🌱 Seeding {rows:,} submissions for {users:,} users...")
+    start = time.time()
+    with app.db_transaction() as c:
+        c.executemany("INSERT INTO users(user_id) VALUES(?)", ((u,) for u in range(1, users + 1)))
+        c.executemany(
+            "INSERT INTO submissions(user_id, filename, status, created_at, priority) VALUES(?,?,?,?,?)",
+            ((rnd.randint(1, users), "essay.pdf", rnd.choice(statuses), now - rnd.randint(0, 90 * 86400), rnd.randint(0, 3))
+             for _ in range(rows))
+        )
+        c.executemany(
+            "INSERT INTO turnitin_logs(submission_id, success, source, created_at) VALUES(?,?,?,?)",
+            ((rnd.randint(1, rows), 1, rnd.choice(sources), now) for _ in range(rows))
+        )
+        c.executemany(
+            "INSERT INTO referrals(referrer_id, referred_id, referral_code, reward_credited, created_at) VALUES(?,?,?,?,?)",
+            ((rnd.randint(1, users), u, "TQCODE", rnd.randint(0, 1), now) for u in range(1, users + 1))
+        )
+        c.executemany(
+            "INSERT INTO payments(user_id, plan, amount, reference, status, created_at) VALUES(?,?,?,?,?,?)",
+            ((rnd.randint(1, users), "pro", 29, f"ref_{i}", rnd.choice(["success", "pending"]), now) for i in range(users))
+        )
+    conn.execute("ANALYZE")
+    print(f"   done in {time.time() - start:.1f}s")
+
+
+def db_queries(users):
+    conn = app.get_db()
+    rnd = random.Random(7)
+    uid = lambda: rnd.randint(1, users)
+    return [
+        ("user_has_active_processing", lambda: app.user_has_active_processing(uid())),
+        ("user_has_queued_or_processing", lambda: app.user_has_queued_or_processing(uid())),
+        ("cancel: latest active submission", lambda: conn.execute(
+            "SELECT * FROM submissions WHERE user_id=? AND status IN ('processing','queued') ORDER BY created_at DESC LIMIT 1",
+            (uid(),)).fetchone()),
+        ("referral: total referrals", lambda: conn.execute(
+            "SELECT COUNT(*) FROM referrals WHERE referrer_id=?", (uid(),)).fetchone()),
+        ("referral: successful referrals", lambda: conn.execute(
+            "SELECT COUNT(*) FROM referrals WHERE referrer_id=? AND reward_credited=1", (uid(),)).fetchone()),
+        ("referral signup: already referred", lambda: conn.execute(
+            "SELECT 1 FROM referrals WHERE referred_id=?", (uid(),)).fetchone()),
+        ("debug: analysis log count", lambda: conn.execute(
+            "SELECT COUNT(*) FROM turnitin_logs WHERE source='ADVANCED_ANALYSIS'").fetchone()),
+        ("debug: successful payments", lambda: conn.execute(
+            "SELECT COUNT(*) FROM payments WHERE status='success'").fetchone()),
+        ("queue: claim + release", lambda: _claim_and_release()),
+    ]
+
+
+def _claim_and_release():
+    job = app.claim_next_submission()
+    if job:
+        app.release_submission(job["id"])
+
+
+def bench_db(args):
+    seed_database(args.rows, args.users)
+    conn = app.get_db()
+    indexes = [r["name"] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_%'").fetchall()]
+
+    print(f"\n⚡ With migration indexes ({len(indexes)} indexes), {args.iterations} calls each:")
+    for label, fn in db_queries(args.users):
+        report(label, timed(fn, args.iterations))
+
+    index_sql = [r["sql"] for r in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type='index' AND name LIKE 'idx_%'").fetchall()]
+    for name in indexes:
+        conn.execute(f"DROP INDEX {name}")
+    conn.commit()
+
+    slow_iterations = max(3, args.iterations // 50)
+    print(f"\n🐢 Without indexes (full scans), {slow_iterations} calls each:")
+    for label, fn in db_queries(args.users):
+        if label.startswith("queue:"):
+            # The claim's per-user subqueries turn quadratic without indexes
+            print(f"  {label:<34} skipped (minutes per call at this size)")
+            continue
+        report(label, timed(fn, slow_iterations))
+
+    for sql in index_sql:
+        conn.execute(sql)
+    conn.commit()
+
+
+# Similarity
+def seed_corpus(docs, fingerprints, segments):
+    """Synthetic corpus: random fingerprints per document, written straight to segments"""
+    rng = np.random.default_rng(42)
+    index = app.similarity_index
+    corpus = []
+    print(f"🌱 Indexing {docs:,} documents x {fingerprints} fingerprints in {segments} segments...")
+    start = time.time()
+    per_segment = -(-docs // segments)
+    for seg in range(segments):
+        first, last = seg * per_segment + 1, min(docs, (seg + 1) * per_segment)
+        doc_ids = np.arange(first, last + 1, dtype=np.uint32)
+        fps = rng.integers(0, 1 << 61, size=(len(doc_ids), fingerprints), dtype=np.uint64)
+        corpus.append(fps)
+        rows, buckets = [], []
+        for doc_id, doc_fps in zip(doc_ids.tolist(), fps):
+            signature = similarity.minhash_signature(doc_fps)
+            rows.append((doc_id, f"bench{doc_id}", fingerprints, signature.tobytes(), app.now_ts()))
+            buckets.extend((band, bucket, doc_id) for band, bucket in similarity.lsh_buckets(signature))
+        name = f"bench_{seg}"
+        similarity.write_segment(index.directory, name, fps.ravel(), np.repeat(doc_ids, fingerprints))
+        with app.db_transaction() as c:
+            c.executemany("INSERT INTO corpus_documents(id, file_hash, fingerprints, signature, created_at) VALUES(?,?,?,?,?)", rows)
+            c.executemany("INSERT INTO lsh_buckets(band, bucket, doc_id) VALUES(?,?,?)", buckets)
+            c.execute("INSERT INTO similarity_segments(name, postings, created_at) VALUES(?,?,?)", (name, fps.size, app.now_ts()))
+    print(f"   done in {time.time() - start:.1f}s")
+    return np.concatenate(corpus)
+
+
+def bench_similarity(args):
+    corpus = seed_corpus(args.docs, args.fingerprints, args.segments)
+    rng = np.random.default_rng(7)
+    checks = []
+
+    def query():
+        # 40% copied from one document, 20% from another, 40% original
+        a, b = rng.integers(0, len(corpus), size=2)
+        n = args.fingerprints
+        fps = np.concatenate([corpus[a][:int(n * 0.4)], corpus[b][:int(n * 0.2)],
+                              rng.integers(0, 1 << 61, size=int(n * 0.4), dtype=np.uint64)])
+        result = app.similarity_index.match(fps)
+        checks.append(result["similarity_score"] == 60 and [s["document"] for s in result["sources"][:2]] == [a + 1, b + 1])
+
+    duplicate = corpus[0]
+    print(f"\n🔎 Corpus lookups ({args.iterations} queries of {args.fingerprints} fingerprints):")
+    report("partial copy from two sources", timed(query, args.iterations))
+    report("near-duplicate (LSH + postings)", timed(lambda: app.similarity_index.match(duplicate), args.iterations))
+    print(f"  {sum(checks)}/{len(checks)} queries scored 60% with the right top two sources")
+    print(f"  {app.similarity_index.stats()}")
+
+
+# Stylometry
+def synthetic_essay(rng, vocabulary, words):
+    """Zipf-distributed words mixed with function words, in page-sized blocks"""
+    picks = np.minimum(rng.zipf(1.3, size=words), len(vocabulary)) - 1
+    tokens = [vocabulary[i] for i in picks.tolist()]
+    sentences, i = [], 0
+    while i < len(tokens):
+        n = int(rng.integers(4, 35))
+        sentences.append(" ".join(tokens[i:i + n]).capitalize() + ".")
+        i += n
+    text = " ".join(sentences)
+    page = 3000  # characters, roughly one PDF page
+    return [text[j:j + page] for j in range(0, len(text), page)]
+
+
+def bench_stylometry(args):
+    rng = np.random.default_rng(11)
+    letters = np.array(list("abcdefghijklmnoprstuvwy"))
+    vocabulary = list(stylometry.FUNCTION_WORDS) + [
+        "".join(rng.choice(letters, size=int(rng.integers(3, 12)))) for _ in range(20000)
+    ]
+    docs = [synthetic_essay(rng, vocabulary, args.words) for _ in range(args.docs)]
+
+    def score(blocks):
+        profile = stylometry.StyleProfile()
+        for block in blocks:
+            profile.feed(block)
+        return profile.result()
+
+    print(f"\n✍️ Stylometric scoring ({args.docs} documents of ~{args.words} words, one core):")
+    samples = []
+    start = time.perf_counter()
+    for blocks in docs:
+        samples.extend(timed(lambda: score(blocks), 1))
+    elapsed = time.perf_counter() - start
+    report("per document", samples)
+    print(f"  throughput {args.docs / elapsed * 60:,.0f} docs/min ({args.docs * args.words / elapsed:,.0f} words/s)")
+    print(f"  sample: {score(docs[0])}")
+
+
+# User state
+USER_FLOW = ["/start", "/id", "document", "/check", "/id", "/referral", "/id"]
+
+
+def telegram_update(user_id, step, seq=itertools.count(1)):
+    if step == "document":
+        message = {"document": {"file_name": "essay.pdf", "file_id": f"F{user_id}", "file_size": 20000}}
+    else:
+        message = {"text": step}
+    message["from"] = {"id": user_id}
+    return {"update_id": next(seq), "message": message}
+
+
+def count_statements(conn):
+    """Install a trace callback; returns a dict counting statements and commits"""
+    counts = {"statements": 0, "commits": 0}
+
+    def trace(sql):
+        if sql.startswith("COMMIT"):
+            counts["commits"] += 1
+        elif not sql.startswith(("BEGIN", "PRAGMA")):
+            counts["statements"] += 1
+    conn.set_trace_callback(trace)
+    return counts
+
+
+def bench_users(args):
+    app.outbound.enqueue = lambda *a, **k: True  # no Telegram traffic
+    conn = app.get_db()
+    updates = args.users * len(USER_FLOW)
+    print(f"\n👤 Telegram updates per user flow {USER_FLOW} ({args.users} new users):")
+    for label, size, first_user in (("without user cache", 0, 1_000_000), ("with user cache", app.USER_CACHE_SIZE, 2_000_000)):
+        app.user_cache.max_users = size
+        app.user_cache.invalidate()
+        app.user_cache.hits = app.user_cache.misses = 0
+        counts = count_statements(conn)
+        samples = []
+        for user_id in range(first_user, first_user + args.users):
+            for step in USER_FLOW:
+                samples.extend(timed(lambda: app.process_telegram_update(telegram_update(user_id, step)), 1))
+        conn.set_trace_callback(None)
+        report(label, samples)
+        print(f"  {'':<34} {counts['statements'] / updates:6.2f} statements/update, {counts['commits'] / updates:5.2f} commits/update")
+        print(f"  {'':<34} {app.user_cache.stats()}")
+
+
+# Onboarding
+def legacy_provision(user_id):
+    """First contact as it used to be: SELECT -> INSERT -> commit -> SELECT, per table"""
+    for table in ("user_sessions", "users"):
+        cur = app.db.cursor()
+        r = cur.execute(f"SELECT * FROM {table} WHERE user_id=?", (user_id,)).fetchone()
+        if not r:
+            cur.execute(f"INSERT INTO {table}(user_id) VALUES(?)", (user_id,))
+            app.db.commit()
+            cur.execute(f"SELECT * FROM {table} WHERE user_id=?", (user_id,)).fetchone()
+
+
+def upsert_provision(user_id):
+    app.get_user_session(user_id)
+    app.user_get(user_id)
+
+
+def onboard(fn, user_ids, threads):
+    """Threads work in pairs on the same users, like /start and a message arriving together"""
+    errors = []
+    pairs = max(1, threads // 2)
+
+    def worker(ids):
+        for user_id in ids:
+            try:
+                fn(user_id)
+            except sqlite3.Error as e:
+                errors.append(e)
+                app.db.rollback()
+
+    workers = [threading.Thread(target=worker, args=(user_ids[p::pairs],)) for p in range(pairs) for _ in range(2)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - start, len(errors)
+
+
+def bench_onboarding(args):
+    print(f"\n🆕 First contacts ({args.users:,} new users, {args.threads} threads, every user contacted twice at once):")
+    first = 10_000_000
+    for label, fn in (("SELECT -> INSERT -> SELECT", legacy_provision), ("upsert provisioning", upsert_provision)):
+        app.user_cache.invalidate()
+        elapsed, errors = onboard(fn, list(range(first, first + args.users)), args.threads)
+        print(f"  {label:<34} {args.users / elapsed:10,.0f} users/s   {errors} errors")
+        first += args.users
+
+    ids = list(range(first, first + args.bulk))
+    start = time.perf_counter()
+    created = app.provision_users(ids + ids[:1000])
+    elapsed = time.perf_counter() - start
+    print(f"  {'bulk provision_users':<34} {args.bulk / elapsed:10,.0f} users/s   {created:,} created")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TurnitQ benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_db = sub.add_parser("db", help="hot query latency with and without the migration indexes")
+    p_db.add_argument("--rows", type=int, default=1_000_000)
+    p_db.add_argument("--users", type=int, default=100_000)
+    p_db.add_argument("--iterations", type=int, default=500)
+    p_db.set_defaults(func=bench_db)
+
+    p_sim = sub.add_parser("similarity", help="corpus lookup latency on a synthetic fingerprint index")
+    p_sim.add_argument("--docs", type=int, default=200_000)
+    p_sim.add_argument("--fingerprints", type=int, default=300, help="fingerprints per document")
+    p_sim.add_argument("--segments", type=int, default=4)
+    p_sim.add_argument("--iterations", type=int, default=200)
+    p_sim.set_defaults(func=bench_similarity)
+
+    p_style = sub.add_parser("stylometry", help="stylometric AI scorer throughput on synthetic essays")
+    p_style.add_argument("--docs", type=int, default=1000)
+    p_style.add_argument("--words", type=int, default=3000, help="words per document")
+    p_style.set_defaults(func=bench_stylometry)
+
+    p_users = sub.add_parser("users", help="SQL statements and commits per Telegram update, with and without the user cache")
+    p_users.add_argument("--users", type=int, default=2000)
+    p_users.set_defaults(func=bench_users)
+
+    p_onboard = sub.add_parser("onboarding", help="new-user provisioning throughput under concurrent first contacts")
+    p_onboard.add_argument("--users", type=int, default=20_000)
+    p_onboard.add_argument("--threads", type=int, default=8)
+    p_onboard.add_argument("--bulk", type=int, default=200_000)
+    p_onboard.set_defaults(func=bench_onboarding)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    finally:
+        shutil.rmtree(_workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Text extraction for uploaded .pdf and .docx documents.
+
+Text is streamed out block by block (a page for PDFs, a few paragraphs for
+DOCX), so callers can work through a 300-page thesis without holding all
+of it in memory. Extraction stops when the time budget runs out and the
+stream is marked as truncated.
+
+Parallel extraction of large PDFs is opt-in: start_pool() forks a process
+pool that must be created while the caller is still single-threaded (the
+app does it at import, before any background thread starts). Page ranges
+are then extracted in parallel, each worker keeping the reader of the
+document it is on, and blocks still come out in page order with only a
+bounded window of ranges in flight. Without a pool, if it breaks, or in
+a process forked after it (which inherits the pool object but not the
+thread that runs it), pages are extracted sequentially.
+"""
+import os
+import re
+import time
+import zipfile
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from xml.etree import ElementTree
+
+from pypdf import PdfReader
+
+EXTRACT_TIME_BUDGET = float(os.getenv("EXTRACT_TIME_BUDGET", "60"))  # seconds per document
+EXTRACT_PAGES_PER_TASK = 16
+EXTRACT_PARALLEL_MIN_PAGES = 32
+DOCX_BLOCK_CHARS = 4000
+
+WORD_RE = re.compile(r"[^\W\d_]+(?:['’-][^\W\d_]+)*")
+SENTENCE_RE = re.compile(r"[.!?]+(?=\s|$)")
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_TEXT_TAGS = {_W + "t", _W + "tab", _W + "br"}
+
+_pool = None
+_pool_workers = 0
+_pool_pid = None  # processes forked from this one later inherit _pool but not its manager thread
+_worker_reader = (None, None)  # (document key, PdfReader) of the range a pool worker last extracted
+
+
+def start_pool(workers):
+    """Fork the page extraction pool; call before the process starts any threads.
+
+    Forking a multi-threaded process can leave the children holding locks
+    that nobody will release, so every worker is forked here, up front,
+    and the pool never forks again. Does nothing for fewer than 2 workers,
+    inside a child process or where fork is unavailable.
+    """
+    global _pool, _pool_workers, _pool_pid
+    if (_pool is not None or workers < 2 or multiprocessing.parent_process() is not None
+            or "fork" not in multiprocessing.get_all_start_methods()):
+        return
+    if threading.active_count() > 1:
+        print("⚠️ Page extraction pool not started: threads are already running")
+        return
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(int).result()  # forks all workers now, before the pool's own manager thread
+    _pool, _pool_workers, _pool_pid = pool, workers, os.getpid()
+    print(f"📄 Page extraction pool started: {workers} processes")
+
+
+def _page_text(page):
+    try:
+        return page.extract_text() or ""
+    except Exception as e:
+        print(f"⚠️ Could not extract a PDF page: {e}")
+        return ""
+
+
+def _extract_pdf_range(path, start, stop):
+    """Pool task: text of pages [start, stop), reusing this worker's reader of the document"""
+    global _worker_reader
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if _worker_reader[0] != key:
+        _worker_reader = (key, PdfReader(path))
+    reader = _worker_reader[1]
+    return [_page_text(reader.pages[i]) for i in range(start, stop)]
+
+
+class TextStream:
+    """Iterable over a document's text blocks.
+
+    After iteration `blocks` is the number of blocks produced, `pages` the
+    page count when the format has one, `truncated` whether the time
+    budget cut extraction short and `elapsed` the time it took.
+    """
+
+    def __init__(self, path, file_type, budget=None):
+        self.path = path
+        self.file_type = file_type
+        self.budget = EXTRACT_TIME_BUDGET if budget is None else budget
+        self.blocks = 0
+        self.pages = None
+        self.truncated = False
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        start = time.monotonic()
+        deadline = start + self.budget
+        if self.file_type == "pdf":
+            source = self._iter_pdf(deadline)
+        elif self.file_type == "docx":
+            source = self._iter_docx(deadline)
+        else:
+            raise ValueError(f"unsupported document type: {self.file_type}")
+        try:
+            for text in source:
+                self.blocks += 1
+                yield text
+        finally:
+            self.elapsed = time.monotonic() - start
+
+    def _iter_pdf(self, deadline):
+        reader = PdfReader(self.path)
+        self.pages = len(reader.pages)
+        done = 0
+        if self.pages >= EXTRACT_PARALLEL_MIN_PAGES and _pool is not None and _pool_pid == os.getpid():
+            try:
+                for text in self._iter_pdf_parallel(deadline):
+                    done += 1
+                    yield text
+                return
+            except BrokenProcessPool:
+                print("⚠️ Page extraction pool broke, extracting sequentially")
+        for i in range(done, self.pages):
+            if time.monotonic() > deadline:
+                self.truncated = True
+                return
+            yield _page_text(reader.pages[i])
+
+    def _iter_pdf_parallel(self, deadline):
+        pool = _pool
+        ranges = ((s, min(s + EXTRACT_PAGES_PER_TASK, self.pages)) for s in range(0, self.pages, EXTRACT_PAGES_PER_TASK))
+        window = deque(pool.submit(_extract_pdf_range, self.path, s, e)
+                       for s, e in itertools.islice(ranges, _pool_workers * 2))
+        try:
+            while window:
+                try:
+                    texts = window.popleft().result(timeout=max(0, deadline - time.monotonic()))
+                except FutureTimeout:
+                    self.truncated = True
+                    return
+                for s, e in itertools.islice(ranges, 1):
+                    window.append(pool.submit(_extract_pdf_range, self.path, s, e))
+                yield from texts
+        finally:
+            for future in window:
+                future.cancel()
+
+    def _iter_docx(self, deadline):
+        with zipfile.ZipFile(self.path) as archive, archive.open("word/document.xml") as xml:
+            block, size = [], 0
+            for _, elem in ElementTree.iterparse(xml, events=("end",)):
+                if elem.tag != _W + "p":
+                    continue
+                text = "".join(
+                    (node.text or "") if node.tag == _W + "t" else " "
+                    for node in elem.iter() if node.tag in _TEXT_TAGS
+                ).strip()
+                elem.clear()
+                if text:
+                    block.append(text)
+                    size += len(text)
+                if size >= DOCX_BLOCK_CHARS:
+                    yield "\n".join(block)
+                    block, size = [], 0
+                    if time.monotonic() > deadline:
+                        self.truncated = True
+                        return
+            if block:
+                yield "\n".join(block)
+
+
+def text_stats(path, file_type, budget=None, on_block=None):
+    """Count words, sentences and characters of a document in one streaming pass.
+
+    `on_block` is called with each text block, so other consumers (such as
+    fingerprinting) can share the pass.
+    """
+    stream = TextStream(path, file_type, budget)
+    words = sentences = chars = 0
+    for block in stream:
+        if on_block:
+            on_block(block)
+        chars += len(block)
+        words += len(WORD_RE.findall(block))
+        sentences += len(SENTENCE_RE.findall(block))
+    return {
+        "words": words,
+        "sentences": sentences,
+        "chars": chars,
+        "pages": stream.pages or stream.blocks,
+        "truncated": stream.truncated,
+        "elapsed": round(stream.elapsed, 3)
+    }
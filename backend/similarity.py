@@ -0,0 +1,416 @@
+"""Local document similarity engine.
+
+Every processed document is reduced to winnowed fingerprints: hashes of
+overlapping word 5-grams, of which winnowing keeps the minimum in each
+sliding window, so any shared passage of SHINGLE_WORDS + WINNOW_WINDOW - 1
+words is guaranteed to share a fingerprint. Two structures index them:
+
+* an inverted index from fingerprint to documents. New postings land in
+  the fingerprint_delta table and are compacted into immutable sorted
+  segments (a pair of .npy files) that are memory-mapped and searched
+  with a vectorised binary search;
+* MinHash signatures with LSH banding (lsh_buckets table), which find
+  near-duplicate documents even when their fingerprints are too common
+  for the inverted index to keep.
+
+A new submission is matched against the corpus before it is added, giving
+the share of its fingerprints found elsewhere and the documents it
+overlaps most.
+"""
+import os
+import re
+import time
+import zlib
+import hashlib
+import threading
+from collections import deque
+
+import numpy as np
+
+from extract import WORD_RE
+
+SHINGLE_WORDS = 5
+WINNOW_WINDOW = 8
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 4 rows per band: near-duplicates from ~50% Jaccard similarity
+MAX_POSTINGS_PER_FINGERPRINT = 1000  # fingerprints shared by more documents are boilerplate
+SMALL_MATCH_FINGERPRINTS = 8  # "small match" = under ~8 fingerprints (a sentence or two)
+SIMILARITY_DELTA_MAX = int(os.getenv("SIMILARITY_DELTA_MAX", "200000"))
+SIMILARITY_MAX_SEGMENTS = int(os.getenv("SIMILARITY_MAX_SEGMENTS", "8"))
+
+_PRIME = (1 << 61) - 1
+_BASE = 1_000_003
+_BASE_POW = pow(_BASE, SHINGLE_WORDS - 1, _PRIME)
+_MINHASH_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(20240607)  # fixed: signatures must stay comparable across restarts
+_MINHASH_A = _rng.randint(1, _MINHASH_PRIME, size=(MINHASH_PERMUTATIONS, 1)).astype(np.uint64)
+_MINHASH_B = _rng.randint(0, _MINHASH_PRIME, size=(MINHASH_PERMUTATIONS, 1)).astype(np.uint64)
+
+_BIBLIOGRAPHY_RE = re.compile(r"^\s*(references|bibliography|works cited|reference list|sources cited)\s*:?\s*$", re.I | re.M)
+_QUOTED_RE = re.compile(r"“[^”]{0,2000}”|\"[^\"\n]{0,2000}\"")
+_CITATION_RE = re.compile(r"\((?:[^()]*?\b(?:19|20)\d{2}[a-z]?\b[^()]*?)\)|\[\d+(?:\s*[,–-]\s*\d+)*\]")
+
+
+class Winnower:
+    """Streaming winnowing over a sequence of text blocks"""
+
+    def __init__(self):
+        self.fingerprints = set()
+        self._words = deque()
+        self._hash = 0
+        self._window = deque()  # (hash, position), increasing hashes
+        self._position = 0
+        self._selected = -1
+
+    def feed(self, text):
+        words = self._words
+        for word in WORD_RE.findall(text.lower()):
+            word_hash = zlib.crc32(word.encode("utf-8"))
+            if len(words) == SHINGLE_WORDS:
+                self._hash = (self._hash - words.popleft() * _BASE_POW) % _PRIME
+            words.append(word_hash)
+            self._hash = (self._hash * _BASE + word_hash) % _PRIME
+            if len(words) == SHINGLE_WORDS:
+                self._push(self._hash)
+
+    def _push(self, value):
+        window = self._window
+        position = self._position
+        while window and window[-1][0] >= value:
+            window.pop()
+        window.append((value, position))
+        if window[0][1] <= position - WINNOW_WINDOW:
+            window.popleft()
+        if position >= WINNOW_WINDOW - 1 and window[0][1] != self._selected:
+            self._selected = window[0][1]
+            self.fingerprints.add(window[0][0])
+        self._position += 1
+
+    def array(self):
+        return np.fromiter(self.fingerprints, dtype=np.uint64, count=len(self.fingerprints))
+
+
+class DocumentFingerprinter:
+    """Fingerprints a document twice in one pass: the full text for the
+    index, and the text left after the report options' exclusions for
+    matching."""
+
+    def __init__(self, options=None):
+        options = options or {}
+        self.exclude_quoted = bool(options.get("exclude_quoted_text"))
+        self.exclude_cited = bool(options.get("exclude_cited_text"))
+        self.exclude_bibliography = bool(options.get("exclude_bibliography"))
+        self.full = Winnower()
+        self.filtered = self.full
+        if self.exclude_quoted or self.exclude_cited or self.exclude_bibliography:
+            self.filtered = Winnower()
+        self._in_bibliography = False
+
+    def feed(self, text):
+        self.full.feed(text)
+        if self.filtered is self.full or self._in_bibliography:
+            return
+        if self.exclude_bibliography:
+            heading = _BIBLIOGRAPHY_RE.search(text)
+            if heading:
+                text = text[:heading.start()]
+                self._in_bibliography = True
+        if self.exclude_quoted:
+            text = _QUOTED_RE.sub(" ", text)
+        if self.exclude_cited:
+            text = _CITATION_RE.sub(" ", text)
+        self.filtered.feed(text)
+
+
+def minhash_signature(fingerprints):
+    """MinHash signature (MINHASH_PERMUTATIONS uint32 values) of a fingerprint array"""
+    if not len(fingerprints):
+        return np.full(MINHASH_PERMUTATIONS, _MINHASH_PRIME, dtype=np.uint32)
+    values = (fingerprints % np.uint64(_MINHASH_PRIME))[np.newaxis, :]
+    return ((_MINHASH_A * values + _MINHASH_B) % np.uint64(_MINHASH_PRIME)).min(axis=1).astype(np.uint32)
+
+
+def lsh_buckets(signature):
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [
+        (band, int.from_bytes(hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest(), "big") >> 1)
+        for band in range(LSH_BANDS)
+    ]
+
+
+def cross_match(documents, limit=5, chunk=20000):
+    """Pairwise overlap inside a set of documents (e.g. one batch).
+
+    `documents` maps a key to its fingerprint array. Returns, for every key,
+    up to `limit` (other key, percent) pairs, best first, where percent is
+    the share of the document's fingerprints also found in the other one.
+    Shared fingerprints are turned into a document x fingerprint incidence
+    matrix, a chunk of columns at a time, whose product with its transpose
+    counts the fingerprints every pair has in common.
+    """
+    keys = list(documents)
+    arrays = [np.unique(np.asarray(documents[k], dtype=np.uint64)) for k in keys]
+    sizes = np.array([len(a) for a in arrays], dtype=np.int64)
+    result = {k: [] for k in keys}
+    if len(keys) < 2 or not sizes.sum():
+        return result
+
+    fps = np.concatenate(arrays)
+    owners = np.repeat(np.arange(len(keys)), sizes)
+    order = np.argsort(fps, kind="stable")
+    fps, owners = fps[order], owners[order]
+    _, group, counts = np.unique(fps, return_inverse=True, return_counts=True)
+    # Only fingerprints in 2+ documents matter; in larger sets, drop the ones
+    # most documents share (assignment prompt, template headings)
+    common = max(2, len(keys) // 2) if len(keys) >= 10 else len(keys)
+    keep = (counts[group] > 1) & (counts[group] <= common)
+    owners = owners[keep]
+    _, columns = np.unique(group[keep], return_inverse=True)
+
+    shared = np.zeros((len(keys), len(keys)), dtype=np.float32)
+    for start in range(0, int(columns.max()) + 1 if len(columns) else 0, chunk):
+        in_chunk = (columns >= start) & (columns < start + chunk)
+        incidence = np.zeros((len(keys), chunk), dtype=np.float32)
+        incidence[owners[in_chunk], columns[in_chunk] - start] = 1
+        shared += incidence @ incidence.T
+    np.fill_diagonal(shared, 0)
+
+    percent = np.rint(100 * shared / np.maximum(sizes, 1)[:, np.newaxis]).astype(np.int64)
+    for i, key in enumerate(keys):
+        best = np.argsort(-percent[i], kind="stable")[:limit]
+        result[key] = [(keys[j], int(percent[i, j])) for j in best if percent[i, j] >= 1]
+    return result
+
+
+class Segment:
+    """Immutable sorted postings, memory-mapped from <name>.fps.npy / <name>.docs.npy"""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.fps = np.load(os.path.join(directory, f"{name}.fps.npy"), mmap_mode="r")
+        self.docs = np.load(os.path.join(directory, f"{name}.docs.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.fps)
+
+    def lookup(self, query):
+        """(query index, doc id) pairs for every posting of the sorted query fingerprints"""
+        lo = np.searchsorted(self.fps, query, side="left")
+        hi = np.searchsorted(self.fps, query, side="right")
+        counts = hi - lo
+        keep = (counts > 0) & (counts <= MAX_POSTINGS_PER_FINGERPRINT)
+        if not keep.any():
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        lo, counts = lo[keep], counts[keep]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.repeat(lo, counts) + offsets
+        return np.repeat(np.nonzero(keep)[0], counts), self.docs[positions].astype(np.int64)
+
+
+def write_segment(directory, name, fps, docs):
+    """Sort postings by fingerprint and write them as a segment (atomically, via rename)"""
+    order = np.argsort(fps, kind="stable")
+    for suffix, values in ((".fps.npy", fps[order]), (".docs.npy", docs[order])):
+        tmp = os.path.join(directory, f"{name}{suffix}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp, os.path.join(directory, f"{name}{suffix}"))
+
+
+class SimilarityIndex:
+    """The corpus: documents in SQLite, postings in delta rows plus mmapped segments.
+
+    `connect` returns this thread's SQLite connection and `transaction` is
+    a context manager yielding one inside BEGIN IMMEDIATE, so compactions in
+    different workers or processes never overlap.
+    """
+
+    def __init__(self, directory, connect, transaction):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.connect = connect
+        self.transaction = transaction
+        self._segments = []
+        self._segments_version = None
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.query_ms = 0.0
+
+    # Segments
+    def segments(self):
+        conn = self.connect()
+        version = tuple(conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM similarity_segments").fetchone())
+        with self._lock:
+            if version != self._segments_version:
+                names = [r["name"] for r in conn.execute("SELECT name FROM similarity_segments ORDER BY id")]
+                loaded = {s.name: s for s in self._segments}
+                self._segments = [loaded.get(name) or Segment(self.directory, name) for name in names]
+                self._segments_version = version
+            return list(self._segments)
+
+    def compact(self):
+        """Move delta postings into a new segment, merging the smallest segments when there are too many"""
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT rowid, fp, doc_id FROM fingerprint_delta").fetchall()
+            if rows:
+                data = np.array([(r["rowid"], r["fp"], r["doc_id"]) for r in rows], dtype=np.int64)
+                name = f"seg_{int(time.time() * 1000)}_{os.getpid()}"
+                write_segment(self.directory, name, data[:, 1].astype(np.uint64), data[:, 2].astype(np.uint32))
+                conn.execute("INSERT INTO similarity_segments(name, postings, created_at) VALUES(?,?,?)",
+                             (name, len(data), int(time.time())))
+                conn.execute("DELETE FROM fingerprint_delta WHERE rowid <= ?", (int(data[:, 0].max()),))
+                print(f"🗂️ Compacted {len(data)} postings into similarity segment {name}")
+
+            segments = conn.execute("SELECT id, name, postings FROM similarity_segments ORDER BY postings").fetchall()
+            if len(segments) > SIMILARITY_MAX_SEGMENTS:
+                small = segments[:2]
+                parts = [Segment(self.directory, r["name"]) for r in small]
+                name = f"seg_{int(time.time() * 1000)}_{os.getpid()}_m"
+                write_segment(self.directory, name,
+                              np.concatenate([np.asarray(p.fps) for p in parts]),
+                              np.concatenate([np.asarray(p.docs) for p in parts]))
+                conn.execute("INSERT INTO similarity_segments(name, postings, created_at) VALUES(?,?,?)",
+                             (name, sum(r["postings"] for r in small), int(time.time())))
+                conn.executemany("DELETE FROM similarity_segments WHERE id=?", [(r["id"],) for r in small])
+                for r in small:
+                    for suffix in (".fps.npy", ".docs.npy"):
+                        try:
+                            # Readers holding the old mmaps keep working until they reload
+                            os.remove(os.path.join(self.directory, r["name"] + suffix))
+                        except OSError:
+                            pass
+                print(f"🗂️ Merged similarity segments {small[0]['name']} and {small[1]['name']}")
+
+    # Documents
+    def add(self, file_hash, submission_id, fingerprints, signature=None):
+        """Index a processed document (once per distinct file)"""
+        if not file_hash or not len(fingerprints):
+            return None
+        signature = minhash_signature(fingerprints) if signature is None else signature
+        with self.transaction() as conn:
+            row = conn.execute(
+                "INSERT INTO corpus_documents(file_hash, submission_id, fingerprints, signature, created_at) VALUES(?,?,?,?,?) "
+                "ON CONFLICT(file_hash) DO NOTHING RETURNING id",
+                (file_hash, submission_id, len(fingerprints), signature.tobytes(), int(time.time()))
+            ).fetchone()
+            if not row:
+                return None
+            doc_id = row["id"]
+            conn.executemany("INSERT OR IGNORE INTO lsh_buckets(band, bucket, doc_id) VALUES(?,?,?)",
+                             [(band, bucket, doc_id) for band, bucket in lsh_buckets(signature)])
+            conn.executemany("INSERT INTO fingerprint_delta(fp, doc_id) VALUES(?,?)",
+                             ((int(fp), doc_id) for fp in fingerprints))
+            pending = conn.execute("SELECT MAX(rowid) - MIN(rowid) FROM fingerprint_delta").fetchone()[0] or 0
+        if pending >= SIMILARITY_DELTA_MAX:
+            self.compact()
+        return doc_id
+
+    def match(self, fingerprints, signature=None, exclude_submission_id=None, exclude_small_matches=False, limit=5):
+        """Score fingerprints against the corpus.
+
+        Returns the similarity score (percentage of fingerprints found in
+        other documents) and the top matching documents with their share.
+        exclude_submission_id leaves out the row a submission itself added
+        (when it is re-processed); earlier copies of the same file by
+        anyone else still match in full.
+        """
+        start = time.perf_counter()
+        query = np.unique(np.asarray(fingerprints, dtype=np.uint64))
+        total = len(query)
+        result = {"similarity_score": 0, "sources": [], "fingerprints": total}
+        if not total:
+            return result
+        conn = self.connect()
+
+        exclude_ids = set()
+        if exclude_submission_id is not None:
+            exclude_ids.update(r["id"] for r in conn.execute(
+                "SELECT id FROM corpus_documents WHERE submission_id=?", (exclude_submission_id,)))
+
+        # Inverted index: segments, then the not yet compacted delta
+        hit_query, hit_docs = [], []
+        for segment in self.segments():
+            q, d = segment.lookup(query)
+            hit_query.append(q)
+            hit_docs.append(d)
+        values = query.tolist()
+        for i in range(0, len(values), 900):
+            chunk = values[i:i + 900]
+            rows = conn.execute(
+                f"SELECT fp, doc_id FROM fingerprint_delta WHERE fp IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            if rows:
+                fps = np.array([r["fp"] for r in rows], dtype=np.uint64)
+                hit_query.append(np.searchsorted(query, fps))
+                hit_docs.append(np.array([r["doc_id"] for r in rows], dtype=np.int64))
+
+        matched = {}
+        if hit_query:
+            pairs = np.unique(np.concatenate(hit_query) * (1 << 32) + np.concatenate(hit_docs))
+            q_idx, docs = pairs >> 32, pairs & 0xFFFFFFFF
+            if exclude_ids:
+                keep = ~np.isin(docs, list(exclude_ids))
+                q_idx, docs = q_idx[keep], docs[keep]
+            doc_ids, counts = np.unique(docs, return_counts=True)
+            if exclude_small_matches:
+                large = counts >= SMALL_MATCH_FINGERPRINTS
+                doc_ids, counts = doc_ids[large], counts[large]
+                q_idx = q_idx[np.isin(docs, doc_ids)]
+            covered = len(np.unique(q_idx))
+            matched = dict(zip(doc_ids.tolist(), counts.tolist()))
+        else:
+            covered = 0
+
+        # LSH: near-duplicates whose fingerprints were too common for the postings
+        signature = minhash_signature(query) if signature is None else signature
+        buckets = lsh_buckets(signature)
+        candidates = conn.execute(
+            "SELECT DISTINCT d.id, d.fingerprints, d.signature FROM lsh_buckets b JOIN corpus_documents d ON d.id=b.doc_id "
+            f"WHERE {' OR '.join(['(b.band=? AND b.bucket=?)'] * len(buckets))}",
+            [v for pair in buckets for v in pair]
+        ).fetchall()
+        for c in candidates:
+            if c["id"] in exclude_ids:
+                continue
+            jaccard = float(np.mean(np.frombuffer(c["signature"], dtype=np.uint32) == signature))
+            # containment of the query in the candidate, from |A ∩ B| = J (|A| + |B|) / (1 + J)
+            shared = int(min(total, jaccard * (total + c["fingerprints"]) / (1 + jaccard)))
+            if shared > matched.get(c["id"], 0):
+                matched[c["id"]] = shared
+                covered = max(covered, shared)
+
+        top = sorted(matched.items(), key=lambda item: -item[1])[:limit]
+        if top:
+            meta = {r["id"]: r for r in conn.execute(
+                f"SELECT id, submission_id, created_at FROM corpus_documents WHERE id IN ({','.join('?' * len(top))})",
+                [doc_id for doc_id, _ in top]
+            )}
+            for doc_id, count in top:
+                percent = round(100 * count / total)
+                if percent < 1 or doc_id not in meta:
+                    continue
+                result["sources"].append({
+                    "document": doc_id,
+                    "submitted": time.strftime("%Y-%m-%d", time.gmtime(meta[doc_id]["created_at"])),
+                    "percent": percent
+                })
+
+        result["similarity_score"] = min(100, round(100 * covered / total))
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.queries += 1
+            self.query_ms += elapsed
+        return result
+
+    def stats(self):
+        conn = self.connect()
+        segments = self.segments()
+        with self._lock:
+            return {
+                "documents": conn.execute("SELECT COUNT(*) FROM corpus_documents").fetchone()[0],
+                "segments": len(segments),
+                "segment_postings": sum(len(s) for s in segments),
+                "delta_postings": conn.execute("SELECT COUNT(*) FROM fingerprint_delta").fetchone()[0],
+                "queries": self.queries,
+                "avg_query_ms": round(self.query_ms / self.queries, 1) if self.queries else 0.0
+            }
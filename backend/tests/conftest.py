@@ -0,0 +1,83 @@
+"""Shared setup: import the app against a throwaway database, with no background jobs."""
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="turnitq-tests-")
+os.environ.update(
+    TELEGRAM_BOT_TOKEN="123456:TEST",
+    PAYSTACK_PUBLIC_KEY="pk_test",
+    PAYSTACK_SECRET_KEY="sk_test",
+    DATABASE_URL=os.path.join(_tmp, "db.sqlite"),
+    TEMP_DIR=os.path.join(_tmp, "scratch"),
+    SIMILARITY_INDEX_DIR=os.path.join(_tmp, "similarity_index"),
+    TELEGRAM_API_BASE="http://127.0.0.1:9",
+    BACKGROUND_JOBS="0",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+WORDS = ("the of and research students analysis results data method study university "
+         "model theory evidence shows that this paper we").split()
+
+
+def sentence(rnd):
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(8, 16))).capitalize() + "."
+
+
+def write_pdf(path, pages, lines=40, seed=1):
+    """Write a minimal text PDF (Helvetica, `lines` sentences per page)"""
+    rnd = random.Random(seed)
+    objs = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for _ in range(pages):
+        text = b"BT /F1 10 Tf 50 750 Td 12 TL " + b" ".join(
+            b"(" + sentence(rnd).encode() + b") '" for _ in range(lines)) + b" ET"
+        objs.append(b"<< /Length %d >>\nstream\n" % len(text) + text + b"\nendstream")
+        objs.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                    b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objs)))
+        kids.append(len(objs))
+    objs[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objs[1] = b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % k for k in kids) + b"] /Count %d >>" % pages
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+    return path
+
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    return lambda pages, name="doc.pdf", seed=1: write_pdf(str(tmp_path / name), pages, seed=seed)
+
+
+@pytest.fixture
+def submit():
+    """Queue a submission of a file for a user, as the upload handler would; returns (id, scratch path)"""
+    import app
+
+    def submit(user_id, source_path, filename="paper.pdf"):
+        app.provision_user(user_id)
+        ingest = app.digest_file(source_path)
+        with app.db_transaction() as conn:
+            sub_id = conn.execute(
+                "INSERT INTO submissions(user_id, filename, status, created_at, options, file_hash, file_size, file_type) "
+                "VALUES(?,?,?,?,?,?,?,?)",
+                (user_id, filename, "queued", app.now_ts(), json.dumps({}),
+                 ingest["file_hash"], ingest["file_size"], ingest["file_type"])
+            ).lastrowid
+        path = app.scratch.path_for(sub_id, filename)
+        shutil.copyfile(source_path, path)
+        return sub_id, path
+    return submit
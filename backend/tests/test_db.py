@@ -0,0 +1,11 @@
+def test_db_transaction_rolls_back_writes_left_uncommitted(capsys):
+    import app
+
+    app.db.execute("INSERT INTO meta(k, v) VALUES('leaked', 'x')")
+    assert app.get_db().in_transaction
+    with app.db_transaction() as conn:
+        conn.execute("INSERT INTO meta(k, v) VALUES('scoped', 'y')")
+
+    keys = {r["k"] for r in app.db.execute("SELECT k FROM meta WHERE k IN ('leaked', 'scoped')")}
+    assert keys == {"scoped"}
+    assert "Rolled back an uncommitted transaction" in capsys.readouterr().out
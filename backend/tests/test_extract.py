@@ -0,0 +1,28 @@
+import multiprocessing
+
+import pytest
+
+import extract
+
+pytestmark = pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+
+
+def test_text_stats_in_process_engine_after_extract_pool(make_pdf):
+    import app
+
+    path = make_pdf(64)
+    expected = extract.text_stats(path, "pdf")
+    assert expected["words"] > 0 and not expected["truncated"]
+
+    extract.start_pool(2)
+    engine = app.ProcessingEngine(2, "process")
+    engine.start()
+    try:
+        # The engine's children inherit extract._pool but not its manager thread
+        stats = engine.run_cpu(extract.text_stats, path, "pdf", 8)
+    finally:
+        engine._cpu_pool.shutdown(cancel_futures=True)
+
+    assert not stats["truncated"]
+    assert stats["words"] == expected["words"]
+    assert extract.text_stats(path, "pdf")["words"] == expected["words"]
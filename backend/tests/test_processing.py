@@ -0,0 +1,27 @@
+import os
+
+
+def test_result_is_dropped_when_the_lease_was_taken_over(make_pdf, submit, monkeypatch):
+    import app
+
+    sub_id, path = submit(920001, make_pdf(2, seed=11))
+    app.db.execute("INSERT INTO capacity_reservations(submission_id, window_start, status, created_at) VALUES(?, 0, 'held', 0)",
+                   (sub_id,))
+    app.db.commit()
+    analyse = app.submit_to_turnitin_simulation
+
+    def released_and_reclaimed(*args):
+        # The lease sweep requeues the row and another worker claims it while we analyse
+        with app.db_transaction() as conn:
+            conn.execute("UPDATE submissions SET attempts=attempts+1 WHERE id=?", (sub_id,))
+        return analyse(*args)
+
+    monkeypatch.setattr(app, "submit_to_turnitin_simulation", released_and_reclaimed)
+    app.process_document(sub_id, path, {})
+
+    row = app.db.execute("SELECT status, similarity_score FROM submissions WHERE id=?", (sub_id,)).fetchone()
+    assert row["status"] == "processing" and row["similarity_score"] is None
+    reservation = app.db.execute("SELECT status FROM capacity_reservations WHERE submission_id=?", (sub_id,)).fetchone()
+    assert reservation["status"] == "held"
+    assert not app.db.execute("SELECT 1 FROM turnitin_logs WHERE submission_id=? AND success=1", (sub_id,)).fetchone()
+    assert os.path.exists(path)  # the new owner still needs the upload
@@ -0,0 +1,14 @@
+def test_identical_copy_from_another_user_matches_in_full(make_pdf, submit):
+    import app
+
+    original = make_pdf(3, seed=7)
+    first, path = submit(910001, original)
+    app.process_document(first, path, {})
+    row = app.db.execute("SELECT status FROM submissions WHERE id=?", (first,)).fetchone()
+    assert row["status"] == "done"
+
+    second, path = submit(910002, original)
+    app.process_document(second, path, {})
+    row = app.db.execute("SELECT status, similarity_score FROM submissions WHERE id=?", (second,)).fetchone()
+    assert row["status"] == "done"
+    assert row["similarity_score"] == 100